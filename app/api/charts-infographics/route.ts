@@ -416,11 +416,12 @@ export async function POST(request: NextRequest) {
           )
           console.log(`📝 Replaced pd.read_json with read_json_flexible for .${fileExt} file`)
         } else {
+          // read_data (Modal) sniffs the format and caches the parsed frame by file hash
           chartCodeResult.pythonCode = chartCodeResult.pythonCode.replace(
             /pd\.(read_excel|read_csv|read_parquet)\s*\(/g,
-            `${correctReadFunction}(`
+            'read_data('
           )
-          console.log(`📝 Replaced read function with ${correctReadFunction} for .${fileExt} file`)
+          console.log(`📝 Replaced ${correctReadFunction} with cached read_data for .${fileExt} file`)
         }
       }
     }
@@ -0,0 +1,314 @@
+"""
+Benchmark suite for chart_render.py
+
+Runs the generate_chart body locally, without Modal, over a corpus of
+representative chart programs and reports p50/p95 latency, output size and
+peak RSS per case. Results are written as JSON and can be compared against
+a saved baseline to catch regressions.
+
+By default each request goes through render_chart_budgeted, the path the
+endpoint serves (budget worker dispatch under rlimits); --path direct
+times render_chart in-process instead.
+
+Usage:
+    pip install modal matplotlib seaborn pandas numpy pyarrow orjson openpyxl
+    python modal_functions/benchmark_chart_render.py --output results.json
+    python modal_functions/benchmark_chart_render.py --baseline results.json --tolerance 0.15
+
+Each case runs in its own spawned process so peak RSS is per case. Caches
+live in a temporary directory and are bypassed on every iteration (unique
+code per iteration, frame cache cleared, budget worker replaced outside the
+timed call) unless --warm-caches is given.
+"""
+
+import argparse
+import base64
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+# Scatter sizes (rows) for the large-CSV cases
+DEFAULT_SCATTER_SIZES = (10_000, 100_000, 1_000_000)
+
+LINE_CODE = """
+x = np.linspace(0, 20, 2000)
+plt.figure(figsize=(10, 6))
+for k in range(5):
+    plt.plot(x, np.sin(x + k) * (k + 1), linewidth=2, label=f'series {k}')
+plt.title('Line chart')
+plt.xlabel('X')
+plt.ylabel('Y')
+plt.legend()
+plt.grid(True, alpha=0.3)
+"""
+
+BAR_CODE = """
+categories = [f'Category {i}' for i in range(24)]
+values = np.random.default_rng(0).integers(10, 100, size=len(categories))
+plt.figure(figsize=(12, 6))
+plt.bar(categories, values, color='steelblue')
+plt.xticks(rotation=45, ha='right')
+plt.title('Bar chart')
+plt.tight_layout()
+"""
+
+HEATMAP_CODE = """
+data = np.random.default_rng(1).standard_normal((40, 40))
+plt.figure(figsize=(10, 8))
+sns.heatmap(data, cmap='viridis', annot=False)
+plt.title('Heatmap')
+"""
+
+PAIRPLOT_CODE = """
+iris_like = pd.DataFrame(np.random.default_rng(2).standard_normal((300, 4)), columns=['a', 'b', 'c', 'd'])
+iris_like['group'] = np.repeat(['x', 'y', 'z'], 100)
+sns.pairplot(iris_like, hue='group')
+"""
+
+SCATTER_CODE = """
+df = read_data('/mnt/data/{filename}')
+plt.figure(figsize=(10, 8))
+plt.scatter(df['x'], df['y'], s=2, alpha=0.5, c=df['value'], cmap='plasma')
+plt.colorbar()
+plt.title('Scatter ({rows} rows)')
+"""
+
+
+def make_scatter_csv(rows: int) -> bytes:
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.default_rng(rows)
+    df = pd.DataFrame({
+        "x": rng.standard_normal(rows),
+        "y": rng.standard_normal(rows),
+        "value": rng.random(rows),
+    })
+    return df.to_csv(index=False).encode("utf-8")
+
+
+def build_corpus(scatter_sizes) -> list[dict]:
+    """Benchmark cases as render_chart request bodies."""
+    corpus = [
+        {"name": "line", "request": {"code": LINE_CODE}},
+        {"name": "bar", "request": {"code": BAR_CODE}},
+        {"name": "heatmap", "request": {"code": HEATMAP_CODE}},
+        {"name": "seaborn_pairplot", "request": {"code": PAIRPLOT_CODE}},
+    ]
+    for rows in scatter_sizes:
+        filename = f"scatter_{rows}.csv"
+        corpus.append({
+            "name": f"scatter_csv_{rows}",
+            "request": {
+                "code": SCATTER_CODE.format(filename=filename, rows=rows),
+                "dataFile": {
+                    "filename": filename,
+                    "buffer": base64.b64encode(make_scatter_csv(rows)).decode("utf-8"),
+                },
+            },
+        })
+    return corpus
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if len(ordered) == 1:
+        return ordered[0]
+    position = (len(ordered) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def run_case(case: dict, iterations: int, warmup: int, warm_caches: bool, path: str) -> dict:
+    """Run one case in the current process (called inside a spawned worker)."""
+    # Set before import so budget workers spawned from here use the same caches
+    cache_root = tempfile.mkdtemp(prefix="chart-bench-")
+    os.environ["CHART_CACHE_ROOT"] = cache_root
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import chart_render
+
+    if path == "served":
+        render = chart_render.render_chart_budgeted
+    else:
+        render = chart_render.render_chart
+
+    latencies = []
+    phases = {}
+    sizes = []
+    peak_rss = []
+    try:
+        for i in range(warmup + iterations):
+            request = dict(case["request"])
+            if not warm_caches:
+                # Unique code per iteration defeats the render cache
+                request["code"] = request["code"] + f"\n# iteration {i}"
+                chart_render.frame_cache._memory.clear()
+                shutil.rmtree(chart_render.frame_cache.directory, ignore_errors=True)
+                if path == "served":
+                    # A fresh, already warm worker: no frames in memory, no cold start in the timing
+                    chart_render.budget_pool.shutdown()
+                    chart_render.render_chart_budgeted({"code": f"# warm worker {i}"})
+
+            started = time.perf_counter()
+            result = render(request, encode=True)
+            elapsed = time.perf_counter() - started
+
+            if not result.get("success"):
+                return {"error": result.get("error", "unknown error")}
+            if i < warmup:
+                continue
+
+            latencies.append(elapsed)
+            sizes.append(result["size"])
+            # Reported by whichever process rendered (a budget worker on the served path)
+            peak_rss.append(result["timings"]["peak_rss_bytes"])
+            for phase, seconds in result["timings"]["phases"].items():
+                phases.setdefault(phase, []).append(seconds)
+    finally:
+        chart_render.budget_pool.shutdown()
+        # Data file links point into the temporary store; remove them with it
+        for filename in list(chart_render._materialized_data_files):
+            try:
+                os.remove(os.path.join(chart_render.DATA_DIR, filename))
+            except OSError:
+                pass
+        shutil.rmtree(cache_root, ignore_errors=True)
+
+    return {
+        "iterations": iterations,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 3),
+        "output_bytes": int(statistics.median(sizes)),
+        "peak_rss_bytes": max(peak_rss),
+        "phases_p50_ms": {
+            phase: round(percentile(values, 0.50) * 1000, 3) for phase, values in sorted(phases.items())
+        },
+    }
+
+
+def _case_process_main(conn, *case_args):
+    conn.send(run_case(*case_args))
+    conn.close()
+
+
+def run_case_in_process(context, *case_args) -> dict:
+    """
+    Run a case in a fresh spawned process. Not a Pool worker: those are
+    daemonic and could not start the budget workers of the served path.
+    """
+    parent_conn, child_conn = context.Pipe(duplex=False)
+    process = context.Process(target=_case_process_main, args=(child_conn, *case_args))
+    process.start()
+    child_conn.close()
+    try:
+        return parent_conn.recv()
+    except EOFError:
+        return {"error": "case process exited without a result"}
+    finally:
+        process.join()
+
+
+def run_suite(args) -> dict:
+    corpus = build_corpus(args.scatter_sizes)
+    if args.cases:
+        corpus = [case for case in corpus if case["name"] in args.cases]
+
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for case in corpus:
+        print(f"⏱️  {case['name']} ({args.iterations} iterations)...", flush=True)
+        results[case["name"]] = run_case_in_process(context, case, args.iterations, args.warmup, args.warm_caches, args.path)
+        summary = results[case["name"]]
+        if "error" in summary:
+            print(f"   ❌ {summary['error']}")
+        else:
+            print(f"   p50 {summary['p50_ms']:.1f} ms, p95 {summary['p95_ms']:.1f} ms, "
+                  f"{summary['output_bytes']} bytes, peak RSS {summary['peak_rss_bytes'] / 1e6:.1f} MB")
+
+    import matplotlib
+    import pandas
+
+    return {
+        "meta": {
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "matplotlib": matplotlib.__version__,
+            "pandas": pandas.__version__,
+            "iterations": args.iterations,
+            "warm_caches": args.warm_caches,
+            "path": args.path,
+        },
+        "cases": results,
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Return regression messages for metrics that got worse by more than tolerance."""
+    regressions = []
+    baseline_path = baseline.get("meta", {}).get("path", "direct")
+    if baseline_path != results["meta"]["path"]:
+        print(f"⚠️  Baseline measured the {baseline_path} path, this run the {results['meta']['path']} path")
+    for name, current in results["cases"].items():
+        previous = baseline.get("cases", {}).get(name)
+        if not previous or "error" in previous:
+            continue
+        if "error" in current:
+            regressions.append(f"{name}: now fails ({current['error']})")
+            continue
+        for metric in ("p50_ms", "p95_ms", "output_bytes", "peak_rss_bytes"):
+            before, after = previous.get(metric), current.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            marker = "❌" if change > tolerance else "✅"
+            print(f"{marker} {name:<24} {metric:<15} {before:>14} -> {after:>14} ({change:+.1%})")
+            if change > tolerance:
+                regressions.append(f"{name}: {metric} {before} -> {after} ({change:+.1%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark chart_render.render_chart locally")
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--scatter-sizes", type=int, nargs="+", default=list(DEFAULT_SCATTER_SIZES))
+    parser.add_argument("--cases", nargs="+", help="Only run these case names")
+    parser.add_argument("--warm-caches", action="store_true", help="Let render/frame caches hit between iterations")
+    parser.add_argument("--path", choices=("served", "direct"), default="served",
+                        help="served: render_chart_budgeted as the endpoint runs it; direct: render_chart in-process")
+    parser.add_argument("--output", help="Write results JSON to this path")
+    parser.add_argument("--baseline", help="Compare against a previously saved results JSON")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed relative slowdown/growth (default 0.10)")
+    args = parser.parse_args()
+
+    results = run_suite(args)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"📝 Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"❌ {len(regressions)} regression(s) beyond {args.tolerance:.0%}:")
+            for regression in regressions:
+                print(f"   - {regression}")
+            sys.exit(1)
+        print("✅ No regressions against baseline")
+
+
+if __name__ == "__main__":
+    main()
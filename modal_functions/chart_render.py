@@ -1,4 +1,11 @@
+import time
+
+# Container start reference for cold-start reporting (taken before heavy imports)
+_MODULE_IMPORT_STARTED = time.perf_counter()
+
 import modal
+import matplotlib
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 import seaborn as sns
 import pandas as pd
@@ -6,129 +13,3058 @@ import numpy as np
 import base64
 import os
 import json
+import hashlib
+import ast
+import threading
+import contextlib
+import resource
+import multiprocessing
+import signal
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from io import BytesIO
+from fastapi import Request, Response
+from fastapi.responses import PlainTextResponse
+
+try:
+    import python_multipart as multipart
+    from python_multipart.multipart import parse_options_header
+except ImportError:
+    # Older python-multipart releases only install the "multipart" package
+    import multipart
+    from multipart.multipart import parse_options_header
+
+try:
+    import orjson
+
+    def json_loads(data):
+        return orjson.loads(data)
+except ImportError:
+    def json_loads(data):
+        return json.loads(data)
+
+app = modal.App("chart-generator")
+
+# Persistent cache volume shared by all chart-generator containers
+cache_volume = modal.Volume.from_name("chart-generator-cache", create_if_missing=True)
+# Overridable so local runs (benchmarks, budget workers they spawn) can use a scratch directory
+CACHE_ROOT = os.environ.get("CHART_CACHE_ROOT", "/cache")
+RENDER_CACHE_DIR = f"{CACHE_ROOT}/renders"
+DATASET_DIR = f"{CACHE_ROOT}/datasets"
+FRAME_CACHE_DIR = f"{CACHE_ROOT}/frames"
+
+# Directory chart code reads data files from
+DATA_DIR = "/mnt/data"
+
+# Uploaded datasets are kept until unused for a week or the store outgrows its cap
+DATASET_TTL_SECONDS = 7 * 24 * 3600
+DATASET_MAX_BYTES = 20 * 1024 * 1024 * 1024
+
+# Streamed uploads are written to the dataset store in chunks of this size
+STREAM_UPLOAD_CHUNK_BYTES = 1024 * 1024
+STREAM_UPLOAD_MAX_BYTES = 4 * 1024 * 1024 * 1024
+STREAM_FORM_FIELD_MAX_BYTES = 16 * 1024 * 1024
+
+# Output options used when a request does not ask for anything else (part of the cache key)
+DEFAULT_RENDER_OPTIONS = {"format": "png", "dpi": 300}
+
+# Supported output formats and their content types
+OUTPUT_CONTENT_TYPES = {
+    "png": "image/png",
+    "svg": "image/svg+xml",
+    "webp": "image/webp",
+    "jpeg": "image/jpeg",
+}
+MIN_DPI = 20
+MAX_DPI = 600
+MAX_PIXEL_SIZE = 8000
+
+# PNG post-processing: "lossless" re-encodes (metadata stripped, opaque RGBA
+# flattened to RGB), "palette" quantizes to at most "colors" colors, "auto"
+# uses an exact palette when the chart has few enough colors
+PNG_OPTIMIZE_MODES = ("off", "lossless", "palette", "auto")
+PNG_DEFAULT_COLORS = 256
+
+# Direct-to-storage uploads (upload_url): at most this many targets per request
+UPLOAD_MAX_TARGETS = 8
+UPLOAD_TIMEOUT_SECONDS = 120
+# Options that only make sense for one output format; dropped when an upload target picks another format
+FORMAT_SPECIFIC_OPTIONS = ("quality", "optimize", "colors", "compress_level")
+
+# Automatic downsampling kicks in when an artist has this many times more
+# points than its axes have output pixel columns
+DOWNSAMPLE_MODES = ("off", "auto", "lttb")
+AUTO_DOWNSAMPLE_FACTOR = 4
+
+# Compiled chart programs kept per process, keyed by source hash
+CODE_CACHE_ENTRIES = 256
+
+# Per-request budgets for generate_chart: requests may ask for less (or up
+# to the cap) via "limits": {"cpu_seconds": ..., "memory_mb": ...}
+CHART_CPU_SECONDS_DEFAULT = 60
+CHART_CPU_SECONDS_MAX = 300
+CHART_MEMORY_MB_DEFAULT = 2048
+CHART_MEMORY_MB_MAX = 8192
+# Wall-clock allowance on top of the CPU budget (sleeps, I/O, worker start)
+CHART_WALL_SECONDS_SLACK = 30
+# Idle budget workers started with the container / kept between requests
+BUDGET_WORKERS_PREWARM = 2
+# In-memory frame cache of each budget worker; the render cache stays in the
+# serving process, and parsed frames are shared through the Volume tier
+BUDGET_WORKER_FRAME_MEMORY_BYTES = 128 * 1024 * 1024
+
+# Async job API: finished jobs are kept this long, long-polls wait at most this long
+JOB_RESULT_TTL_SECONDS = 24 * 3600
+JOB_MAX_WAIT_SECONDS = 50
+# Unfinished jobs older than this are assumed lost and swept
+JOB_STALE_SECONDS = 2 * JOB_RESULT_TTL_SECONDS
+JOB_SWEEP_INTERVAL_HOURS = 1
+JOB_TERMINAL_STATES = ("succeeded", "failed", "cancelled")
+# Job ids are 32 lowercase hex characters (see JobQueue.submit)
+JOB_ID_LENGTH = 32
+# How often wait() re-reads a just-submitted job whose call id isn't recorded yet
+JOB_CALL_ID_POLL_SECONDS = 0.25
+
+# Batch rendering limits (worker count matches the batch function's CPU request)
+BATCH_MAX_ITEMS = 50
+BATCH_MAX_WORKERS = 4
+
+# Image with chart libraries; the matplotlib font cache is built at image
+# build time into a fixed MPLCONFIGDIR so containers never rebuild it.
+image = (
+    modal.Image.debian_slim()
+    .pip_install(
+        "matplotlib",
+        "seaborn", 
+        "pandas",
+        "numpy",
+        "pyarrow",
+        "orjson",
+        "openpyxl",
+        "requests",
+        "fastapi[standard]"
+    )
+    .env({"MPLBACKEND": "Agg", "MPLCONFIGDIR": "/opt/matplotlib"})
+    .run_commands(
+        "mkdir -p /opt/matplotlib",
+        "python -c \"import matplotlib.font_manager as fm; fm.findfont('DejaVu Sans'); import seaborn\""
+    )
+)
+
+# Concurrent single-chart requests served by one ChartGenerator container
+CHART_MAX_CONCURRENT_INPUTS = 8
+
+_MODULE_IMPORT_SECONDS = time.perf_counter() - _MODULE_IMPORT_STARTED
+
+# Job records shared by every container serving the job endpoints, and the
+# cancel markers run() checks (kept apart so no job_id can reach a marker)
+job_dict = modal.Dict.from_name("chart-generator-jobs", create_if_missing=True)
+job_cancel_dict = modal.Dict.from_name("chart-generator-job-cancels", create_if_missing=True)
+
+# Per-container metrics snapshots, keyed by container, read by the metrics endpoint
+metrics_dict = modal.Dict.from_name("chart-generator-metrics", create_if_missing=True)
+METRICS_PUSH_INTERVAL_SECONDS = 15
+METRICS_STALE_SECONDS = 3600
+
+# Per-container startup/warm-state numbers reported on every response
+container_stats = {
+    "import_seconds": round(_MODULE_IMPORT_SECONDS, 4),
+    "warmup_seconds": None,
+    "requests_served": 0,
+}
+
+
+# Per-thread state for the render currently running on this thread
+_request_local = threading.local()
+
+
+class PhaseTimer:
+    """
+    Accumulates wall time per named phase of a render. Nested phases are
+    subtracted from their parent, so each phase reports its own time only.
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self._stack = []
+        self._rss_before = current_rss_bytes()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        self._stack.append([name, 0.0])
+        try:
+            yield
+        finally:
+            _, nested = self._stack.pop()
+            elapsed = time.perf_counter() - started
+            self.phases[name] = self.phases.get(name, 0.0) + elapsed - nested
+            if self._stack:
+                self._stack[-1][1] += elapsed
+
+    def summary(self, total_seconds: float) -> dict:
+        return {
+            "total_seconds": round(total_seconds, 6),
+            "phases": {name: round(seconds, 6) for name, seconds in self.phases.items()},
+            # Process-wide high-water mark; per-request growth is the RSS delta
+            "peak_rss_bytes": peak_rss_bytes(),
+            "rss_delta_bytes": current_rss_bytes() - self._rss_before,
+        }
+
+
+def timed_phase(name):
+    """Time a block against the render running on this thread, if any."""
+    timer = getattr(_request_local, "timer", None)
+    return timer.phase(name) if timer is not None else contextlib.nullcontext()
+
+
+def current_rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def peak_rss_bytes() -> int:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def prune_directory(directory, max_bytes, suffix):
+    """Delete least-recently-touched files ending in suffix until the directory fits max_bytes."""
+    entries = []
+    total = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if not name.endswith(suffix):
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+    if total <= max_bytes:
+        return
+
+    entries.sort()
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+
+class RenderCache:
+    """
+    Content-addressed cache of rendered chart images.
+    Tier 1 is an in-process LRU bounded by total bytes, tier 2 is a
+    directory on the cache Volume bounded by total bytes (oldest access first).
+    """
+
+    def __init__(self, directory, max_memory_bytes=256 * 1024 * 1024, max_disk_bytes=4 * 1024 * 1024 * 1024):
+        self.directory = directory
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(code, dataset_id=None, filename=None, options=None):
+        """Hash the chart code, data file identity (content hash) and output options."""
+        digest = hashlib.sha256()
+        digest.update(code.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update((filename or "").encode("utf-8"))
+        digest.update(b"\0")
+        digest.update((dataset_id or "").encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(json.dumps(options or {}, sort_keys=True).encode("utf-8"))
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.bin")
+
+    def _remember(self, key, value):
+        with self._lock:
+            if key in self._memory:
+                self._memory_bytes -= len(self._memory.pop(key))
+            if len(value) > self.max_memory_bytes:
+                return
+            self._memory[key] = value
+            self._memory_bytes += len(value)
+            while self._memory_bytes > self.max_memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    def get(self, key):
+        """Return (image_bytes, tier) or (None, None) on a miss."""
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+                return value, "memory"
+
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                value = f.read()
+        except OSError:
+            return None, None
+
+        try:
+            # Refresh access time so disk eviction is least-recently-used
+            os.utime(path)
+        except OSError:
+            pass
+        self._remember(key, value)
+        return value, "volume"
+
+    def put(self, key, value):
+        """Store image bytes in both tiers."""
+        self._remember(key, value)
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(value)
+            os.replace(tmp_path, path)
+            self._evict_disk()
+        except OSError as e:
+            print(f"⚠️ Could not persist render cache entry {key[:12]}: {e}")
+
+    def _evict_disk(self):
+        prune_directory(self.directory, self.max_disk_bytes, ".bin")
+
+
+render_cache = RenderCache(RENDER_CACHE_DIR)
+
+
+class DatasetStore:
+    """
+    Content-addressed store of uploaded data files on the cache Volume.
+    Files are named by their SHA-256 so clients can upload once and refer to
+    the hash afterwards. Eviction drops files unused for longer than the TTL,
+    then least-recently-used files until the store fits its byte cap.
+    """
+
+    EVICTION_INTERVAL_SECONDS = 600
+
+    def __init__(self, directory, ttl_seconds=DATASET_TTL_SECONDS, max_bytes=DATASET_MAX_BYTES):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._last_eviction = 0.0
+
+    @staticmethod
+    def digest(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    @staticmethod
+    def is_valid_id(dataset_id) -> bool:
+        return (
+            isinstance(dataset_id, str)
+            and len(dataset_id) == 64
+            and all(c in "0123456789abcdef" for c in dataset_id)
+        )
+
+    def path(self, dataset_id: str) -> str:
+        return os.path.join(self.directory, dataset_id[:2], dataset_id)
+
+    def resolve(self, dataset_id: str):
+        """Return the stored file path for a dataset id, or None if unknown."""
+        path = self.path(dataset_id)
+        if not os.path.exists(path):
+            # Another container may have uploaded it since this one started
+            try:
+                if not modal.is_local():
+                    cache_volume.reload()
+            except Exception as e:
+                print(f"⚠️ Cache volume reload skipped: {e}")
+            if not os.path.exists(path):
+                return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return path
+
+    def put(self, data: bytes, dataset_id: str = None) -> tuple[str, bool]:
+        """Store bytes if not already present. Returns (dataset_id, created)."""
+        dataset_id = dataset_id or self.digest(data)
+        path = self.path(dataset_id)
+        if os.path.exists(path):
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            return dataset_id, False
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self.evict()
+        return dataset_id, True
+
+    def writer(self, max_bytes: int = STREAM_UPLOAD_MAX_BYTES) -> "DatasetWriter":
+        """Start a chunked upload into the store (see DatasetWriter)."""
+        return DatasetWriter(self, max_bytes)
+
+    def evict(self, force: bool = False):
+        now = time.time()
+        if not force and now - self._last_eviction < self.EVICTION_INTERVAL_SECONDS:
+            return
+        self._last_eviction = now
+
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not self.is_valid_id(name):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if now - stat.st_mtime > self.ttl_seconds:
+                    try:
+                        os.remove(path)
+                        print(f"🧹 Evicted expired dataset {name[:12]}")
+                    except OSError:
+                        pass
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                print(f"🧹 Evicted dataset {os.path.basename(path)[:12]} (store over {self.max_bytes} bytes)")
+            except OSError:
+                pass
+
+
+class DatasetWriter:
+    """
+    Streams an upload into the dataset store chunk by chunk, hashing as it
+    goes, so the payload is never held in memory as a whole. commit() moves
+    the file to its content address; abort() drops a partial upload.
+    """
+
+    def __init__(self, store: DatasetStore, max_bytes: int):
+        self.store = store
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._digest = hashlib.sha256()
+        os.makedirs(store.directory, exist_ok=True)
+        self._tmp_path = os.path.join(store.directory, f"upload.{os.getpid()}.{threading.get_ident()}.{time.time_ns()}.tmp")
+        self._file = open(self._tmp_path, "wb")
+
+    def write(self, chunk: bytes):
+        if not chunk:
+            return
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise ValueError(f"Upload exceeds {self.max_bytes} bytes")
+        self._digest.update(chunk)
+        self._file.write(chunk)
+
+    def commit(self) -> tuple[str, bool]:
+        """Finish the upload. Returns (dataset_id, created) like DatasetStore.put."""
+        self._file.close()
+        dataset_id = self._digest.hexdigest()
+        path = self.store.path(dataset_id)
+        if os.path.exists(path):
+            os.remove(self._tmp_path)
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            return dataset_id, False
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(self._tmp_path, path)
+        self.store.evict()
+        return dataset_id, True
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.remove(self._tmp_path)
+        except OSError:
+            pass
+
+
+dataset_store = DatasetStore(DATASET_DIR)
+
+# filename -> dataset id currently linked into DATA_DIR by this process
+_materialized_data_files = {}
+
+
+def materialize_data_file(dataset_id: str, filename: str) -> bool:
+    """
+    Make a stored dataset visible to chart code as DATA_DIR/filename.
+    Uses a symlink into the store, so nothing is copied; skipped entirely
+    when the same dataset is already linked under that name.
+    Returns True if the link was (re)created.
+    """
+    target = os.path.join(DATA_DIR, filename)
+    if _materialized_data_files.get(filename) == dataset_id and os.path.exists(target):
+        return False
+
+    os.makedirs(DATA_DIR, exist_ok=True)
+    tmp_link = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+    os.symlink(dataset_store.path(dataset_id), tmp_link)
+    os.replace(tmp_link, target)
+    _materialized_data_files[filename] = dataset_id
+    return True
+
+
+def resolve_data_file(data_file_info: dict) -> dict:
+    """
+    Turn a request's dataFile into {dataset_id, filename, stored}.
+    Accepts either {"datasetId", "filename"} referencing an uploaded dataset
+    or the inline {"buffer", "filename"} form, which is stored on the way in.
+    Raises LookupError for unknown dataset ids and ValueError for bad input.
+    """
+    filename = data_file_info.get("filename")
+    if not filename or os.path.basename(filename) != filename:
+        raise ValueError("dataFile.filename must be a plain file name")
+
+    dataset_id = data_file_info.get("datasetId")
+    if dataset_id is not None:
+        if not DatasetStore.is_valid_id(dataset_id):
+            raise ValueError("dataFile.datasetId must be a SHA-256 hex digest")
+        with timed_phase("dataset_lookup"):
+            path = dataset_store.resolve(dataset_id)
+        if path is None:
+            raise LookupError(f"Unknown dataset {dataset_id}")
+        return {"dataset_id": dataset_id, "filename": filename, "stored": False, "size": os.path.getsize(path)}
+
+    with timed_phase("decode"):
+        file_buffer = base64.b64decode(data_file_info["buffer"])
+    with timed_phase("dataset_store"):
+        dataset_id, stored = dataset_store.put(file_buffer)
+    return {"dataset_id": dataset_id, "filename": filename, "stored": stored, "size": len(file_buffer)}
+
+
+def commit_cache_volume():
+    """Persist cache writes so other containers and restarts can see them."""
+    if modal.is_local():
+        return
+    try:
+        cache_volume.commit()
+    except Exception as e:
+        print(f"⚠️ Cache volume commit skipped: {e}")
+
+
+# Parsed DataFrames, cached by content hash + reader + reader kwargs
+FRAME_MEMORY_ENTRIES = 8
+FRAME_MEMORY_BYTES = 1024 * 1024 * 1024
+FRAME_DISK_BYTES = 10 * 1024 * 1024 * 1024
+# Bumped when parsing changes the frames it produces, so stale cached frames are not reused
+FRAME_CACHE_VERSION = 2
+
+# Column names pandas.read_json converts to datetimes by default
+_DEFAULT_DATE_COLUMNS = ("date", "datetime", "modified")
+_DEFAULT_DATE_SUFFIXES = ("_at", "_time")
+
+# file identity (realpath, size, mtime) -> content hash, for files not in the dataset store
+_file_hashes = {}
+
+
+def file_content_hash(file_path: str) -> str:
+    """
+    Content hash of a data file. Files linked from the dataset store are
+    already named by their hash, so no bytes are read for them.
+    """
+    real_path = os.path.realpath(file_path)
+    if os.path.dirname(os.path.dirname(real_path)) == os.path.realpath(dataset_store.directory):
+        name = os.path.basename(real_path)
+        if DatasetStore.is_valid_id(name):
+            return name
+
+    stat = os.stat(real_path)
+    identity = (real_path, stat.st_size, stat.st_mtime_ns)
+    cached = _file_hashes.get(identity)
+    if cached:
+        return cached
+
+    digest = hashlib.sha256()
+    with open(real_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    _file_hashes[identity] = digest.hexdigest()
+    return _file_hashes[identity]
+
+
+def sniff_data_format(file_path: str) -> str:
+    """Classify a data file as parquet, arrow, excel, json or csv from its leading bytes and extension."""
+    with open(file_path, "rb") as f:
+        head = f.read(512)
+
+    if head.startswith(b"PAR1"):
+        return "parquet"
+    if head.startswith(b"ARROW1"):
+        return "arrow"
+    if head.startswith(b"PK\x03\x04") or head.startswith(b"\xd0\xcf\x11\xe0"):
+        return "excel"
+
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension in (".parquet", ".pq"):
+        return "parquet"
+    if extension in (".arrow", ".feather", ".ipc"):
+        return "arrow"
+    if extension in (".xlsx", ".xls"):
+        return "excel"
+    if extension in (".json", ".jsonl", ".ndjson"):
+        return "json"
+    if extension in (".csv", ".tsv", ".txt"):
+        return "csv"
+
+    return "json" if head.lstrip()[:1] in (b"[", b"{") else "csv"
+
+
+def sniff_json_layout(raw: bytes) -> str:
+    """
+    Decide how a JSON payload is laid out without parsing it more than once:
+    "array" ([...]), "lines" (one object per line) or "object" ({...}).
+    """
+    stripped = raw.lstrip()
+    if stripped[:1] == b"[":
+        return "array"
+    if stripped[:1] == b"{":
+        first_line, _, rest = stripped.partition(b"\n")
+        if rest.strip() and first_line.rstrip().endswith(b"}"):
+            try:
+                json_loads(first_line)
+                return "lines"
+            except ValueError:
+                pass
+        return "object"
+    raise ValueError("JSON data must be an array, an object or JSON Lines")
+
+
+def convert_default_date_columns(df):
+    """Apply pandas.read_json's default date conversion to the usual date-like column names."""
+    for column in df.columns:
+        name = str(column).lower()
+        if not (
+            name in _DEFAULT_DATE_COLUMNS
+            or name.startswith("timestamp")
+            or name.endswith(_DEFAULT_DATE_SUFFIXES)
+        ):
+            continue
+        if not pd.api.types.is_string_dtype(df[column]):
+            continue
+        try:
+            df[column] = pd.to_datetime(df[column])
+        except (TypeError, ValueError):
+            pass
+    return df
+
+
+def infer_json_dtypes(df):
+    """
+    Apply pandas.read_json's dtype inference (dtype=True) to a frame built
+    from decoded JSON: numeric strings become float64, and float or object
+    columns holding only whole numbers become int64.
+    """
+    for column in df.columns:
+        original = data = df[column]
+        if pd.api.types.is_datetime64_any_dtype(data):
+            continue
+        converted = False
+        if pd.api.types.is_string_dtype(data.dtype):
+            try:
+                data = data.astype("float64")
+                converted = True
+            except (TypeError, ValueError):
+                pass
+        if data.dtype.kind == "f" and data.dtype != "float64":
+            data = data.astype("float64")
+            converted = True
+        if len(data) and data.dtype in ("float", "object"):
+            try:
+                as_int = original.astype("int64")
+                if (as_int == data).all():
+                    data = as_int
+                    converted = True
+            except (TypeError, ValueError, OverflowError):
+                pass
+        if converted:
+            df[column] = data
+    return df
+
+
+def parse_json_frame(file_path: str):
+    """Parse a JSON / JSON Lines file into a DataFrame with a single decode pass."""
+    with open(file_path, "rb") as f:
+        raw = f.read()
+
+    layout = sniff_json_layout(raw)
+    if layout == "lines":
+        df = pd.DataFrame([json_loads(line) for line in raw.splitlines() if line.strip()])
+    else:
+        data = json_loads(raw)
+        if layout == "array":
+            df = pd.DataFrame(data)
+        elif all(isinstance(v, (list, dict)) for v in data.values()):
+            # Dict of columns ({"col": [...]}) or nested ({"col": {"row": v}})
+            try:
+                df = pd.DataFrame(data)
+            except ValueError:
+                # Ragged columns: treat top-level keys as rows instead
+                df = pd.DataFrame.from_dict(data, orient="index")
+        else:
+            df = pd.DataFrame([data])
+
+    # Same column types pd.read_json would have produced
+    return infer_json_dtypes(convert_default_date_columns(df))
+
+
+class FrameCache:
+    """
+    Cache of parsed DataFrames. Tier 1 is a small in-process LRU, tier 2 is
+    Parquet files on the cache Volume so other containers skip parsing too.
+    Frames are handed out as copies so chart code cannot mutate the cache.
+    """
+
+    def __init__(self, directory, max_entries=FRAME_MEMORY_ENTRIES, max_memory_bytes=FRAME_MEMORY_BYTES, max_disk_bytes=FRAME_DISK_BYTES):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.parquet")
+
+    def _remember(self, key, df):
+        size = int(df.memory_usage(deep=False).sum())
+        if size > self.max_memory_bytes:
+            return
+        with self._lock:
+            self._memory[key] = (df, size)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries or sum(s for _, s in self._memory.values()) > self.max_memory_bytes:
+                self._memory.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                return entry[0].copy(), "memory"
+
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None, None
+        try:
+            df = pd.read_parquet(path, memory_map=True)
+        except Exception as e:
+            print(f"⚠️ Ignoring unreadable frame cache entry {key[:12]}: {e}")
+            return None, None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self._remember(key, df)
+        return df.copy(), "volume"
+
+    def put(self, key, df):
+        self._remember(key, df)
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            df.to_parquet(tmp_path)
+            os.replace(tmp_path, path)
+            prune_directory(self.directory, self.max_disk_bytes, ".parquet")
+        except Exception as e:
+            # Mixed-type object columns and similar cannot be stored as Parquet
+            print(f"⚠️ Frame not persisted as Parquet: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
+frame_cache = FrameCache(FRAME_CACHE_DIR)
+
+
+def read_data(file_path, **kwargs):
+    """
+    Load a CSV, Excel, Parquet, Arrow/Feather or JSON data file into a DataFrame.
+    The format is sniffed once and the parsed frame is cached by file hash,
+    so later charts on the same data skip parsing. Keyword arguments are
+    passed to the matching pandas reader and are part of the cache key.
+    """
+    with timed_phase("data_load"):
+        return _read_data(file_path, **kwargs)
+
+
+def _read_data(file_path, **kwargs):
+    data_format = sniff_data_format(file_path)
+
+    try:
+        kwargs_key = json.dumps(kwargs, sort_keys=True)
+    except TypeError:
+        kwargs_key = None  # Non-serializable arguments (callables etc.) bypass the cache
+
+    key = None
+    if kwargs_key is not None:
+        key = hashlib.sha256(f"{FRAME_CACHE_VERSION}:{file_content_hash(file_path)}:{data_format}:{kwargs_key}".encode("utf-8")).hexdigest()
+        df, tier = frame_cache.get(key)
+        if df is not None:
+            print(f"⚡ Frame cache hit ({tier}): {os.path.basename(file_path)}")
+            return df
+
+    # Columnar and CSV files are read memory-mapped, so the raw bytes stay in
+    # the page cache instead of being copied onto the heap before parsing
+    if data_format == "parquet":
+        if kwargs.get("engine", "pyarrow") in ("pyarrow", "auto"):
+            kwargs.setdefault("memory_map", True)
+        df = pd.read_parquet(file_path, **kwargs)
+    elif data_format == "arrow":
+        import pyarrow.feather as feather
+        df = feather.read_table(file_path, memory_map=True, **kwargs).to_pandas()
+    elif data_format == "excel":
+        df = pd.read_excel(file_path, **kwargs)
+    elif data_format == "json" and not kwargs:
+        df = parse_json_frame(file_path)
+    elif data_format == "json":
+        df = pd.read_json(file_path, **kwargs)
+    else:
+        if "sep" not in kwargs and "delimiter" not in kwargs and file_path.lower().endswith(".tsv"):
+            kwargs = dict(kwargs, sep="\t")
+        if kwargs.get("engine") != "pyarrow":
+            kwargs.setdefault("memory_map", True)
+        df = pd.read_csv(file_path, **kwargs)
+
+    if key is not None:
+        frame_cache.put(key, df)
+    return df
+
+
+def read_json_flexible(file_path):
+    """Read a JSON array, JSON Lines, dict-of-columns or nested JSON file (cached)."""
+    try:
+        return read_data(file_path)
+    except Exception as e:
+        raise ValueError(f"Could not read JSON file {file_path}: {str(e)}")
+
+
+def normalize_render_options(raw_options) -> tuple[dict, dict]:
+    """
+    Validate request "options" into (render options, delivery). The render
+    options drive savefig and the cache key; delivery only affects how the
+    result is returned. Raises ValueError with a client-facing message.
+
+    format:   png | svg | webp | jpeg (jpg)          default png
+    dpi:      explicit DPI                           default 300
+    width / height: target pixel size; DPI is derived from the figure's tight bbox
+    quality:  1-95 for jpeg/webp
+    downsample: off (default) | auto (min/max lines, pixel-thinned scatters) | lttb
+    optimize: off (default) | lossless | palette | auto   PNG post-processing
+    colors:   2-256 palette size for optimize=palette (lower = smaller, coarser)
+    compress_level: 0-9 zlib level for optimized PNGs  default 9
+    response: json (base64, default) | binary
+    timings:  true to include the per-phase timing breakdown in the response
+    """
+    raw_options = raw_options or {}
+    if not isinstance(raw_options, dict):
+        raise ValueError("options must be an object")
+
+    output_format = str(raw_options.get("format", DEFAULT_RENDER_OPTIONS["format"])).lower()
+    if output_format == "jpg":
+        output_format = "jpeg"
+    if output_format not in OUTPUT_CONTENT_TYPES:
+        raise ValueError(f"Unsupported format '{output_format}' (use one of: {', '.join(OUTPUT_CONTENT_TYPES)})")
+
+    options = {"format": output_format}
+
+    if raw_options.get("width") is not None or raw_options.get("height") is not None:
+        for key in ("width", "height"):
+            if raw_options.get(key) is None:
+                continue
+            value = int(raw_options[key])
+            if not 1 <= value <= MAX_PIXEL_SIZE:
+                raise ValueError(f"{key} must be between 1 and {MAX_PIXEL_SIZE} pixels")
+            options[key] = value
+    else:
+        dpi = int(raw_options.get("dpi", DEFAULT_RENDER_OPTIONS["dpi"]))
+        if not MIN_DPI <= dpi <= MAX_DPI:
+            raise ValueError(f"dpi must be between {MIN_DPI} and {MAX_DPI}")
+        options["dpi"] = dpi
+
+    if raw_options.get("quality") is not None:
+        if output_format not in ("jpeg", "webp"):
+            raise ValueError("quality only applies to jpeg and webp output")
+        quality = int(raw_options["quality"])
+        if not 1 <= quality <= 95:
+            raise ValueError("quality must be between 1 and 95")
+        options["quality"] = quality
+
+    downsample = str(raw_options.get("downsample", "off")).lower()
+    if downsample not in DOWNSAMPLE_MODES:
+        raise ValueError(f"downsample must be one of: {', '.join(DOWNSAMPLE_MODES)}")
+    if downsample != "off":
+        options["downsample"] = downsample
+
+    optimize = str(raw_options.get("optimize", "off")).lower()
+    if optimize not in PNG_OPTIMIZE_MODES:
+        raise ValueError(f"optimize must be one of: {', '.join(PNG_OPTIMIZE_MODES)}")
+    if optimize != "off":
+        if output_format != "png":
+            raise ValueError("optimize only applies to png output")
+        options["optimize"] = optimize
+        if raw_options.get("colors") is not None:
+            if optimize != "palette":
+                raise ValueError("colors only applies to optimize=palette")
+            colors = int(raw_options["colors"])
+            if not 2 <= colors <= 256:
+                raise ValueError("colors must be between 2 and 256")
+            options["colors"] = colors
+        if raw_options.get("compress_level") is not None:
+            compress_level = int(raw_options["compress_level"])
+            if not 0 <= compress_level <= 9:
+                raise ValueError("compress_level must be between 0 and 9")
+            options["compress_level"] = compress_level
+    elif raw_options.get("colors") is not None or raw_options.get("compress_level") is not None:
+        raise ValueError("colors and compress_level require optimize")
+
+    response_mode = str(raw_options.get("response", "json")).lower()
+    if response_mode not in ("json", "binary"):
+        raise ValueError("response must be 'json' or 'binary'")
+
+    delivery = {"mode": response_mode, "timings": bool(raw_options.get("timings", False))}
+    return options, delivery
+
+
+def downsample_lttb(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets: reduce a line to `threshold` points while
+    keeping its visual shape. Expects finite values in drawing order.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(x)
+    threshold = int(threshold)
+    if threshold >= n or threshold < 3:
+        return x, y
+
+    every = (n - 2) / (threshold - 2)
+    indexes = np.zeros(threshold, dtype=np.int64)
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+
+        area = np.abs(
+            (x[a] - avg_x) * (y[start:end] - y[a])
+            - (x[a] - x[start:end]) * (avg_y - y[a])
+        )
+        a = start + int(np.argmax(area))
+        indexes[i + 1] = a
+
+    indexes[-1] = n - 1
+    return x[indexes], y[indexes]
+
+
+def downsample_minmax(x, y, n_buckets):
+    """
+    Min/max bucketing: split x into n_buckets equal-width columns and keep
+    the first, lowest, highest and last point of each. At one bucket per
+    output pixel column this draws the same image as the full line.
+    Expects finite values with x sorted ascending.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(x)
+    n_buckets = int(n_buckets)
+    if n <= 4 * n_buckets or n_buckets < 1 or x[-1] <= x[0]:
+        return x, y
+
+    edges = np.searchsorted(x, np.linspace(x[0], x[-1], n_buckets + 1)[1:-1])
+    bounds = np.concatenate(([0], edges, [n]))
+    keep = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        if end <= start:
+            continue
+        segment = y[start:end]
+        keep.extend((start, start + int(np.argmin(segment)), start + int(np.argmax(segment)), end - 1))
+
+    indexes = np.unique(np.asarray(keep, dtype=np.int64))
+    return x[indexes], y[indexes]
+
+
+def density_bin(x, y, bins=200):
+    """
+    Bin a scatter into a bins x bins grid. Returns (x_centers, y_centers, counts)
+    for non-empty cells, e.g. for plt.scatter(xc, yc, c=counts) or sizes.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    finite = np.isfinite(x) & np.isfinite(y)
+    counts, x_edges, y_edges = np.histogram2d(x[finite], y[finite], bins=bins)
+    x_centers = (x_edges[:-1] + x_edges[1:]) / 2
+    y_centers = (y_edges[:-1] + y_edges[1:]) / 2
+    xi, yi = np.nonzero(counts)
+    return x_centers[xi], y_centers[yi], counts[xi, yi]
+
+
+def _axes_pixel_size(ax, dpi):
+    bbox = ax.get_position()
+    fig_width, fig_height = ax.figure.get_size_inches()
+    return max(int(bbox.width * fig_width * dpi), 1), max(int(bbox.height * fig_height * dpi), 1)
+
+
+def _thin_line(line, method, pixel_width):
+    xy = line.get_xydata()
+    if len(xy) <= AUTO_DOWNSAMPLE_FACTOR * pixel_width:
+        return None
+    if line.get_marker() not in (None, "", "None", " ", "none"):
+        return None  # Markers are individual glyphs; thinning would change the picture
+    x, y = xy[:, 0], xy[:, 1]
+    if not (np.isfinite(x).all() and np.isfinite(y).all()) or np.any(np.diff(x) < 0):
+        return None
+
+    if method == "lttb":
+        x, y = downsample_lttb(x, y, 2 * pixel_width)
+    else:
+        x, y = downsample_minmax(x, y, pixel_width)
+    line.set_data(x, y)
+    return len(x)
+
+
+def _thin_scatter(ax, collection, pixel_size):
+    offsets = np.asarray(collection.get_offsets())
+    n = len(offsets)
+    if n <= AUTO_DOWNSAMPLE_FACTOR * pixel_size[0]:
+        return None
+    if collection.get_offset_transform() is not ax.transData:
+        return None
+
+    # Axes-fraction coordinates -> output pixel grid; keep the first point in each pixel
+    axes_xy = ax.transAxes.inverted().transform(ax.transData.transform(offsets))
+    cells = np.floor(axes_xy * np.asarray(pixel_size)).astype(np.int64)
+    finite = np.isfinite(axes_xy).all(axis=1)
+    cell_ids = cells[:, 0] * (pixel_size[1] + 2) + cells[:, 1]
+    _, first = np.unique(np.where(finite, cell_ids, -1 - np.arange(n)), return_index=True)
+    keep = np.sort(first)
+    if len(keep) >= n:
+        return None
+
+    collection.set_offsets(offsets[keep])
+    for getter, setter in (
+        (collection.get_sizes, collection.set_sizes),
+        (collection.get_facecolors, collection.set_facecolors),
+        (collection.get_edgecolors, collection.set_edgecolors),
+        (collection.get_linewidths, collection.set_linewidths),
+    ):
+        values = np.asarray(getter())
+        if len(values) == n:
+            setter(values[keep])
+    values = collection.get_array()
+    if values is not None and len(values) == n:
+        collection.set_array(np.asarray(values)[keep])
+    return len(keep)
+
+
+def apply_downsampling(fig, mode: str, dpi: float) -> dict:
+    """
+    Count the points a figure will draw and, unless mode is "off", thin
+    lines (min/max or LTTB) and scatters (one point per output pixel) whose
+    point count is far above the axes' pixel width at the output DPI.
+    Returns {"input", "drawn", "downsampled_artists"}.
+    """
+    from matplotlib.collections import PathCollection
+
+    stats = {"input": 0, "drawn": 0, "downsampled_artists": 0}
+    for ax in fig.get_axes():
+        pixel_size = _axes_pixel_size(ax, dpi)
+        # Resolve autoscaled limits first so thinning cannot move them
+        limits = (ax.get_xlim(), ax.get_ylim())
+        changed = False
+
+        for line in ax.get_lines():
+            count = len(line.get_xydata())
+            stats["input"] += count
+            drawn = _thin_line(line, mode, pixel_size[0]) if mode != "off" else None
+            stats["drawn"] += count if drawn is None else drawn
+            if drawn is not None:
+                stats["downsampled_artists"] += 1
+                changed = True
+
+        for collection in ax.collections:
+            if not isinstance(collection, PathCollection):
+                continue
+            count = len(collection.get_offsets())
+            stats["input"] += count
+            drawn = _thin_scatter(ax, collection, pixel_size) if mode != "off" else None
+            stats["drawn"] += count if drawn is None else drawn
+            if drawn is not None:
+                stats["downsampled_artists"] += 1
+                changed = True
+
+        if changed:
+            ax.set_xlim(limits[0])
+            ax.set_ylim(limits[1])
+
+    return stats
+
+
+def resolve_dpi(fig, options: dict) -> float:
+    """Pick the savefig DPI, deriving it from a pixel-size target when given."""
+    if "dpi" in options:
+        return options["dpi"]
+
+    # Size of the tight bounding box plus padding in inches, which is what savefig will emit
+    bbox = fig.get_tightbbox(fig.canvas.get_renderer())
+    pad = 2 * float(plt.rcParams["savefig.pad_inches"])
+    candidates = []
+    if options.get("width"):
+        candidates.append(options["width"] / max(bbox.width + pad, 1e-6))
+    if options.get("height"):
+        candidates.append(options["height"] / max(bbox.height + pad, 1e-6))
+    return min(max(min(candidates), MIN_DPI), MAX_DPI)
+
+
+def save_figure(fig, options: dict, dpi: float = None) -> bytes:
+    """Serialize a figure in the requested format."""
+    if dpi is None:
+        dpi = resolve_dpi(fig, options)
+    savefig_kwargs = {"format": options["format"], "dpi": dpi, "bbox_inches": "tight"}
+    if "quality" in options:
+        savefig_kwargs["pil_kwargs"] = {"quality": options["quality"]}
+
+    buf = BytesIO()
+    fig.savefig(buf, **savefig_kwargs)
+    return buf.getvalue()
+
+
+def optimize_png(png_bytes: bytes, options: dict) -> tuple[bytes, dict]:
+    """
+    Re-encode a PNG according to options["optimize"]. Text chunks written by
+    matplotlib are dropped, fully opaque RGBA becomes RGB, and palette modes
+    store one byte per pixel. Returns (png_bytes, stats); the original is
+    kept when re-encoding does not make it smaller.
+    """
+    from PIL import Image
+
+    mode = options["optimize"]
+    image = Image.open(BytesIO(png_bytes))
+    image.load()
+
+    if image.mode == "RGBA" and image.getextrema()[3] == (255, 255):
+        image = image.convert("RGB")
+
+    colors = None
+    if mode == "palette":
+        colors = options.get("colors", PNG_DEFAULT_COLORS)
+    elif mode == "auto" and image.getcolors(PNG_DEFAULT_COLORS) is not None:
+        colors = PNG_DEFAULT_COLORS  # Exact: the chart has no more colors than the palette holds
+
+    if colors is not None:
+        # Flat chart colors quantize cleanly; dithering would only add noise (and bytes)
+        method = Image.Quantize.FASTOCTREE if image.mode == "RGBA" else Image.Quantize.MEDIANCUT
+        image = image.quantize(colors=colors, method=method, dither=Image.Dither.NONE)
+
+    save_kwargs = {"format": "PNG"}
+    if "compress_level" in options:
+        save_kwargs["compress_level"] = options["compress_level"]
+    else:
+        save_kwargs["optimize"] = True
+    buf = BytesIO()
+    image.save(buf, **save_kwargs)
+    optimized = buf.getvalue()
+
+    if len(optimized) >= len(png_bytes):
+        optimized = png_bytes
+    return optimized, {
+        "mode": mode,
+        "palette_colors": colors,
+        "original_bytes": len(png_bytes),
+        "optimized_bytes": len(optimized),
+        "bytes_saved": len(png_bytes) - len(optimized),
+    }
+
+
+# Per-thread pyplot state: figures registered with pyplot and rcParams
+# written inside an isolated_pyplot() block only exist for that thread.
+_pyplot_local = threading.local()
+
+
+class _ThreadLocalFigs:
+    """Stand-in for Gcf.figs that hands each isolated thread its own figure registry."""
+
+    def __init__(self, shared):
+        self._shared = shared
+
+    def _figs(self):
+        figs = getattr(_pyplot_local, "figs", None)
+        return self._shared if figs is None else figs
+
+    def __getattr__(self, name):
+        return getattr(self._figs(), name)
+
+    def __getitem__(self, key):
+        return self._figs()[key]
+
+    def __setitem__(self, key, value):
+        self._figs()[key] = value
+
+    def __delitem__(self, key):
+        del self._figs()[key]
+
+    def __contains__(self, key):
+        return key in self._figs()
+
+    def __iter__(self):
+        return iter(self._figs())
+
+    def __reversed__(self):
+        return reversed(self._figs())
+
+    def __len__(self):
+        return len(self._figs())
+
+    def __bool__(self):
+        return bool(self._figs())
+
+
+class _ThreadLocalRcParams(matplotlib.RcParams):
+    """
+    Class swapped onto the global rcParams: while a thread is inside
+    isolated_pyplot() its reads and writes go to a private copy.
+    """
+
+    def _params(self):
+        if self is matplotlib.rcParams:
+            return getattr(_pyplot_local, "rc", None)
+        return None
+
+    def _get(self, key):
+        params = self._params()
+        return dict.__getitem__(self, key) if params is None else params[key]
+
+    def _set(self, key, val):
+        params = self._params()
+        if params is None:
+            dict.__setitem__(self, key, val)
+        else:
+            params[key] = val
+
+    def _update_raw(self, other_params):
+        params = self._params()
+        if params is None:
+            return super()._update_raw(other_params)
+        if isinstance(other_params, matplotlib.RcParams):
+            other_params = {k: other_params._get(k) for k in other_params}
+        params.update(other_params)
+
+    def __iter__(self):
+        params = self._params()
+        if params is None:
+            yield from super().__iter__()
+        else:
+            yield from sorted(params)
+
+    def __len__(self):
+        params = self._params()
+        return dict.__len__(self) if params is None else len(params)
+
+
+def install_pyplot_isolation():
+    """Patch pyplot's figure registry and rcParams for per-thread state (idempotent)."""
+    from matplotlib import _pylab_helpers
+
+    if not isinstance(_pylab_helpers.Gcf.figs, _ThreadLocalFigs):
+        _pylab_helpers.Gcf.figs = _ThreadLocalFigs(_pylab_helpers.Gcf.figs)
+    if type(matplotlib.rcParams) is not _ThreadLocalRcParams:
+        matplotlib.rcParams.__class__ = _ThreadLocalRcParams
+
+
+@contextlib.contextmanager
+def isolated_pyplot():
+    """
+    Give the calling thread a private pyplot: its own figure registry and a
+    snapshot of rcParams. Chart code can use plt.* freely while other
+    requests render concurrently in the same process; all figures created
+    in the block are closed on exit.
+    """
+    install_pyplot_isolation()
+    if getattr(_pyplot_local, "figs", None) is not None:
+        # Already isolated (nested call) - reuse the outer context
+        yield
+        return
+
+    _pyplot_local.figs = OrderedDict()
+    _pyplot_local.rc = dict(dict.items(matplotlib.rcParams))
+    try:
+        yield
+    finally:
+        try:
+            plt.close('all')
+        finally:
+            _pyplot_local.figs = None
+            _pyplot_local.rc = None
+
+
+# filename -> [dataset id, active renders] for data files currently in use
+_data_file_leases = {}
+_data_file_leases_cond = threading.Condition()
+
+
+@contextlib.contextmanager
+def data_file_lease(dataset_id: str, filename: str):
+    """
+    Hold DATA_DIR/filename pointing at dataset_id for the duration of a render.
+    Concurrent renders of the same dataset share the file; a render that needs
+    a different dataset under the same name waits until it is released.
+    """
+    with timed_phase("link"), _data_file_leases_cond:
+        while True:
+            lease = _data_file_leases.get(filename)
+            if lease is None or lease[0] == dataset_id:
+                break
+            _data_file_leases_cond.wait()
+        # Linking under the condition keeps two first users from racing
+        linked = materialize_data_file(dataset_id, filename)
+        if lease is None:
+            lease = [dataset_id, 0]
+            _data_file_leases[filename] = lease
+        lease[1] += 1
+
+    try:
+        yield linked
+    finally:
+        with _data_file_leases_cond:
+            lease[1] -= 1
+            if lease[1] == 0:
+                del _data_file_leases[filename]
+                _data_file_leases_cond.notify_all()
+
+
+class CodeCache:
+    """
+    LRU of compiled chart programs keyed by the SHA-256 of the source.
+    Syntax errors are cached too, so a broken template fails fast every time.
+    """
+
+    def __init__(self, max_entries=CODE_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def compile(self, code: str):
+        """Return (code_object, None) or (None, syntax_error_details)."""
+        key = hashlib.sha256(code.encode("utf-8")).hexdigest()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        entry = precheck_code(code)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+
+def precheck_code(code: str):
+    """
+    Parse chart code into an AST and compile it from the tree (one parse).
+    Returns (code_object, None), or (None, {"line", "column", "message", "text"})
+    when the code cannot even be parsed.
+    """
+    try:
+        tree = ast.parse(code, filename="<chart>", mode="exec")
+        return compile(tree, "<chart>", "exec"), None
+    except SyntaxError as e:
+        return None, {
+            "line": e.lineno,
+            "column": e.offset,
+            "message": e.msg,
+            "text": e.text.rstrip("\n") if e.text else None,
+        }
+    except ValueError as e:
+        # e.g. source containing null bytes
+        return None, {"line": None, "column": None, "message": str(e), "text": None}
+
+
+code_cache = CodeCache()
+
+
+def render_chart(request_body: dict, encode: bool = True, cache_mode: str = "use") -> dict:
+    """
+    Execute validated Python chart code and return the encoded image.
+    Code is already validated by Code Interpreter.
+    Identical code + data + options are served from the render cache.
+    Plain function so it can run in-process, in batch workers or locally.
+    With encode=False the raw bytes are returned under "image_bytes"
+    instead of base64 under "image". Every result carries "timings"
+    (per-phase seconds and memory); endpoints strip it unless requested.
+    cache_mode is "use" (look up and store), "lookup" (return None on a
+    miss instead of rendering) or "bypass" (render without the cache).
+    """
+    started = time.perf_counter()
+    timer = PhaseTimer()
+    _request_local.timer = timer
+    try:
+        result = _render_chart(request_body, encode, cache_mode)
+    finally:
+        _request_local.timer = None
+    if result is not None:
+        result["timings"] = timer.summary(time.perf_counter() - started)
+    return result
+
+
+def _render_chart(request_body: dict, encode: bool, cache_mode: str = "use") -> dict:
+    # Extract code from request body
+    code = request_body.get("code", "")
+    
+    if not code:
+        return {"error": "No code provided in request body"}
+    
+    # Reject code that does not parse before touching any data files
+    with timed_phase("compile"):
+        compiled, syntax_error = code_cache.compile(code)
+    if syntax_error:
+        location = f"line {syntax_error['line']}, column {syntax_error['column']}" if syntax_error["line"] else "unknown location"
+        return {
+            "success": False,
+            "error": f"Chart code has a syntax error at {location}: {syntax_error['message']}",
+            "error_code": "syntax_error",
+            "syntax_error": syntax_error
+        }
+    
+    try:
+        options, _ = normalize_render_options(request_body.get("options"))
+        # Further formats saved from the same figure (used by upload_url lists)
+        extra_options = [normalize_render_options(raw)[0] for raw in request_body.get("extra_outputs") or []]
+    except (TypeError, ValueError) as e:
+        return {
+            "success": False,
+            "error": f"Invalid options: {str(e)}"
+        }
+    
+    def output_entry(output_options, image_bytes):
+        entry = {
+            "size": len(image_bytes),
+            "format": output_options["format"],
+            "content_type": OUTPUT_CONTENT_TYPES[output_options["format"]],
+        }
+        if encode:
+            with timed_phase("encode"):
+                entry["image"] = base64.b64encode(image_bytes).decode('utf-8')
+        else:
+            entry["image_bytes"] = image_bytes
+        return entry
+    
+    def image_result(image_bytes, extra_images=(), **extra):
+        result = {"success": True, **output_entry(options, image_bytes)}
+        if extra_images:
+            result["extra_outputs"] = [
+                dict(output_entry(extra_opts, extra_bytes), cache_key=extra_key)
+                for extra_opts, extra_key, extra_bytes in zip(extra_options, extra_keys, extra_images)
+            ]
+        if data_file:
+            result["data_bytes"] = data_file["size"]
+        result.update(extra)
+        return result
+    
+    # Resolve the data file to its content hash so it can be part of the cache key
+    data_file_info = request_body.get("dataFile")
+    data_file = None
+    if data_file_info:
+        try:
+            data_file = resolve_data_file(data_file_info)
+        except LookupError as e:
+            return {
+                "success": False,
+                "error": str(e),
+                "error_code": "dataset_not_found"
+            }
+        except Exception as e:
+            return {
+                "success": False,
+                "error": f"Failed to save data file: {str(e)}"
+            }
+    
+    dataset_extra = {}
+    if data_file:
+        dataset_extra = {"dataset_id": data_file["dataset_id"], "dataset_stored": data_file["stored"]}
+    
+    cache_key = RenderCache.make_key(
+        code,
+        data_file and data_file["dataset_id"],
+        data_file and data_file["filename"],
+        options
+    )
+    extra_keys = [
+        RenderCache.make_key(code, data_file and data_file["dataset_id"], data_file and data_file["filename"], extra)
+        for extra in extra_options
+    ]
+    if cache_mode != "bypass":
+        with timed_phase("cache_lookup"):
+            cached_bytes, cache_tier = render_cache.get(cache_key)
+            cached_extras = [render_cache.get(key)[0] for key in extra_keys] if cached_bytes is not None else []
+        if cached_bytes is not None and all(extra is not None for extra in cached_extras):
+            print(f"⚡ Render cache hit ({cache_tier}): {cache_key[:12]}")
+            return image_result(cached_bytes, cached_extras, cached=True, cache_tier=cache_tier, cache_key=cache_key, **dataset_extra)
+        if cache_mode == "lookup":
+            return None
+    
+    # Create a namespace for execution
+    namespace = {
+        'plt': plt,
+        'sns': sns,
+        'pd': pd,
+        'pandas': pd,
+        'np': np,
+        'numpy': np,
+        'read_json_flexible': read_json_flexible,
+        'read_data': read_data,
+        'downsample_lttb': downsample_lttb,
+        'downsample_minmax': downsample_minmax,
+        'density_bin': density_bin,
+    }
+    
+    # Link the data file into /mnt/data (if it is not already there) and keep
+    # it pinned to this dataset until the render finishes
+    lease = contextlib.nullcontext(None)
+    if data_file:
+        lease = data_file_lease(data_file["dataset_id"], data_file["filename"])
+    
+    try:
+        with lease as linked:
+            if linked:
+                print(f"📁 Linked data file: {DATA_DIR}/{data_file['filename']} -> {data_file['dataset_id'][:12]}")
+            elif data_file:
+                print(f"📁 Data file already present: {DATA_DIR}/{data_file['filename']}")
+            
+            # Each render gets its own figures and rcParams, so concurrent
+            # requests in one process cannot draw on each other's charts
+            with isolated_pyplot():
+                try:
+                    # Execute the validated code (data reads are timed as data_load)
+                    with timed_phase("exec"):
+                        exec(compiled, namespace)
+                    
+                    fig = plt.gcf()
+                    with timed_phase("savefig"):
+                        dpi = resolve_dpi(fig, options)
+                    
+                    # Count (and optionally thin) the points that will actually be drawn
+                    with timed_phase("downsample"):
+                        points = apply_downsampling(fig, options.get("downsample", "off"), dpi)
+                    if points["downsampled_artists"]:
+                        print(f"📉 Downsampled {points['input']} points to {points['drawn']}")
+                    
+                    # Save the current figure in the requested format
+                    with timed_phase("savefig"):
+                        image_bytes = save_figure(fig, options, dpi)
+                    
+                    optimization = {}
+                    if "optimize" in options:
+                        with timed_phase("optimize"):
+                            image_bytes, stats = optimize_png(image_bytes, options)
+                        optimization = {"optimization": stats}
+                        print(f"🗜️ PNG {stats['original_bytes']} -> {stats['optimized_bytes']} bytes ({stats['mode']})")
+                    
+                    extra_images = []
+                    for extra in extra_options:
+                        with timed_phase("savefig"):
+                            extra_bytes = save_figure(fig, extra)
+                        if "optimize" in extra:
+                            with timed_phase("optimize"):
+                                extra_bytes, _ = optimize_png(extra_bytes, extra)
+                        extra_images.append(extra_bytes)
+                except Exception as e:
+                    return {
+                        "success": False,
+                        "error": f"Chart execution failed: {str(e)}",
+                        "error_type": type(e).__name__
+                    }
+    except OSError as e:
+        return {
+            "success": False,
+            "error": f"Failed to save data file: {str(e)}"
+        }
+    
+    if cache_mode != "bypass":
+        with timed_phase("cache_store"):
+            render_cache.put(cache_key, image_bytes)
+            for extra_key, extra_bytes in zip(extra_keys, extra_images):
+                render_cache.put(extra_key, extra_bytes)
+    
+    return image_result(image_bytes, extra_images, cached=False, cache_key=cache_key, points=points, **optimization, **dataset_extra)
+
+
+def normalize_limits(raw_limits) -> dict:
+    """Validate request limits against the server caps. Returns {cpu_seconds, memory_bytes}."""
+    raw_limits = raw_limits or {}
+    if not isinstance(raw_limits, dict):
+        raise TypeError("limits must be an object")
+
+    unknown = set(raw_limits) - {"cpu_seconds", "memory_mb"}
+    if unknown:
+        raise ValueError(f"Unsupported limits: {', '.join(sorted(unknown))}")
+
+    cpu_seconds = raw_limits.get("cpu_seconds", CHART_CPU_SECONDS_DEFAULT)
+    memory_mb = raw_limits.get("memory_mb", CHART_MEMORY_MB_DEFAULT)
+    for name, value, cap in (("cpu_seconds", cpu_seconds, CHART_CPU_SECONDS_MAX), ("memory_mb", memory_mb, CHART_MEMORY_MB_MAX)):
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+            raise ValueError(f"{name} must be a positive number")
+        if value > cap:
+            raise ValueError(f"{name} must be at most {cap}")
+
+    return {"cpu_seconds": float(cpu_seconds), "memory_bytes": int(memory_mb * 1024 * 1024)}
+
+
+def _cpu_seconds_used() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _proc_status_bytes(field: str) -> int:
+    """Read a kB field (VmSize, VmHWM, ...) from /proc/self/status."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+def _reset_peak_rss() -> bool:
+    """Reset VmHWM so the next reading is the peak of this request only."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _budget_worker_main(conn):
+    """
+    Loop of a budget worker process: receive (request_body, limits), render
+    under RLIMIT_CPU / RLIMIT_AS, send back (result, usage). Going over the
+    CPU budget kills the process with SIGXCPU; going over the memory budget
+    surfaces as MemoryError, after which the worker retires. The render
+    cache is left to the serving process, which looks up and stores around
+    the worker.
+    """
+    warm_chart_runtime()
+    frame_cache.max_memory_bytes = BUDGET_WORKER_FRAME_MEMORY_BYTES
+    cpu_soft_default, cpu_hard = resource.getrlimit(resource.RLIMIT_CPU)
+    as_soft_default, as_hard = resource.getrlimit(resource.RLIMIT_AS)
+
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return
+        if message is None:
+            return
+        request_body, limits = message
+
+        cpu_before = _cpu_seconds_used()
+        address_space_before = _proc_status_bytes("VmSize")
+        rss_before = current_rss_bytes()
+        peak_reset = _reset_peak_rss()
+
+        # RLIMIT_CPU counts the whole process lifetime, so the budget is added to what was used so far
+        cpu_soft = int(cpu_before + limits["cpu_seconds"]) + 1
+        as_soft = address_space_before + limits["memory_bytes"]
+        if cpu_hard != resource.RLIM_INFINITY:
+            cpu_soft = min(cpu_soft, cpu_hard)
+        if as_hard != resource.RLIM_INFINITY:
+            as_soft = min(as_soft, as_hard)
+        try:
+            resource.setrlimit(resource.RLIMIT_CPU, (cpu_soft, cpu_hard))
+            resource.setrlimit(resource.RLIMIT_AS, (as_soft, as_hard))
+            result = render_chart(request_body, encode=False, cache_mode="bypass")
+        except MemoryError:
+            result = {"success": False, "error_type": "MemoryError"}
+        finally:
+            resource.setrlimit(resource.RLIMIT_AS, (as_soft_default, as_hard))
+            resource.setrlimit(resource.RLIMIT_CPU, (cpu_soft_default, cpu_hard))
+
+        memory_exceeded = result.get("error_type") == "MemoryError"
+        if memory_exceeded:
+            # str(MemoryError()) is usually empty, so name the budget instead
+            result["error"] = f"Chart execution failed: memory budget of {limits['memory_bytes'] // (1024 * 1024)} MB exceeded"
+        usage = {
+            "cpu_seconds": round(_cpu_seconds_used() - cpu_before, 4),
+            "peak_memory_bytes": max(_proc_status_bytes("VmHWM") - rss_before, 0) if peak_reset else None,
+            "exceeded": "memory" if memory_exceeded else None,
+        }
+        conn.send((result, usage))
+        if memory_exceeded:
+            # Allocation failures can leave libraries in a bad state; start fresh next time
+            return
+
+
+class BudgetWorkerPool:
+    """
+    Warm worker processes that run one chart at a time under a CPU and memory
+    budget. A worker that blows its budget is killed (or retires) and the next
+    request gets a fresh one; the serving container itself is never affected.
+    """
+
+    def __init__(self, max_idle=CHART_MAX_CONCURRENT_INPUTS):
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+        self._context = multiprocessing.get_context("spawn")
+
+    def _start_worker(self):
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(target=_budget_worker_main, args=(child_conn,), daemon=True)
+        process.start()
+        child_conn.close()
+        return process, parent_conn
+
+    def prewarm(self, count: int):
+        workers = [self._start_worker() for _ in range(count)]
+        with self._lock:
+            self._idle.extend(workers)
+
+    def _acquire(self):
+        with self._lock:
+            while self._idle:
+                process, conn = self._idle.pop()
+                if process.is_alive():
+                    return process, conn
+        return self._start_worker()
+
+    def _release(self, worker):
+        process, conn = worker
+        with self._lock:
+            if process.is_alive() and len(self._idle) < self.max_idle:
+                self._idle.append(worker)
+                return
+        self._stop(worker)
+
+    @staticmethod
+    def _stop(worker):
+        process, conn = worker
+        if process.is_alive():
+            process.kill()
+        process.join(timeout=5)
+        conn.close()
+
+    def run(self, request_body: dict, limits: dict) -> tuple[dict, dict]:
+        """Render in a worker. Returns (result, usage); result is None when the worker was killed."""
+        worker = self._acquire()
+        process, conn = worker
+        wall_limit = limits["cpu_seconds"] + CHART_WALL_SECONDS_SLACK
+        started = time.perf_counter()
+        timed_out = False
+        try:
+            conn.send((request_body, limits))
+            # A killed worker closes its end of the pipe, which also ends the wait
+            timed_out = not conn.poll(wall_limit)
+            if not timed_out:
+                try:
+                    result, usage = conn.recv()
+                    if usage.get("exceeded"):
+                        self._stop(worker)  # retiring after a MemoryError
+                    else:
+                        self._release(worker)
+                    return result, usage
+                except EOFError:
+                    pass
+        except (BrokenPipeError, EOFError, ConnectionResetError):
+            pass
+
+        elapsed = time.perf_counter() - started
+        self._stop(worker)
+        if timed_out:
+            exceeded = "wall_time"
+        elif process.exitcode == -signal.SIGXCPU:
+            exceeded = "cpu"
+        elif process.exitcode == -signal.SIGKILL:
+            exceeded = "memory"  # OOM killer
+        else:
+            exceeded = None
+        # SIGXCPU is only delivered once the whole CPU budget has been spent
+        cpu_seconds = limits["cpu_seconds"] if exceeded == "cpu" else None
+        return None, {"cpu_seconds": cpu_seconds, "peak_memory_bytes": None, "exceeded": exceeded, "wall_seconds": round(elapsed, 4), "exitcode": process.exitcode}
+
+    def shutdown(self):
+        with self._lock:
+            workers, self._idle = self._idle, []
+        for worker in workers:
+            self._stop(worker)
+
+
+budget_pool = BudgetWorkerPool()
+
+
+def render_chart_budgeted(request_body: dict, encode: bool = True) -> dict:
+    """
+    render_chart with CPU time and memory budgets, run in a budget worker.
+    Code is syntax-checked, the data file stored and the render cache
+    checked here first, so cache hits never reach a worker and the worker
+    only receives a dataset id. Results carry a "budget" block with the
+    limits and what the render used.
+    """
+    started = time.perf_counter()
+    timer = PhaseTimer()
+    _request_local.timer = timer
+    try:
+        result = _render_chart_budgeted(request_body, encode)
+    finally:
+        _request_local.timer = None
+
+    worker_timings = result.pop("timings", None) or {}
+    summary = timer.summary(time.perf_counter() - started)
+    for phase, seconds in (worker_timings.get("phases") or {}).items():
+        summary["phases"][phase] = round(summary["phases"].get(phase, 0.0) + seconds, 6)
+    if "worker" in summary["phases"]:
+        # Only the hand-off overhead; the worker's own phases are listed above
+        summary["phases"]["worker"] = round(max(summary["phases"]["worker"] - worker_timings.get("total_seconds", 0.0), 0.0), 6)
+    if worker_timings:
+        # Memory is the worker's, where the chart actually ran
+        summary["peak_rss_bytes"] = worker_timings["peak_rss_bytes"]
+        summary["rss_delta_bytes"] = worker_timings["rss_delta_bytes"]
+    result["timings"] = summary
+    return result
+
+
+def _render_chart_budgeted(request_body: dict, encode: bool) -> dict:
+    code = request_body.get("code", "")
+    if not code:
+        return {"error": "No code provided in request body"}
+
+    try:
+        limits = normalize_limits(request_body.get("limits"))
+    except (TypeError, ValueError) as e:
+        return {"success": False, "error": f"Invalid limits: {str(e)}"}
+
+    budget = {
+        "cpu_seconds_limit": limits["cpu_seconds"],
+        "cpu_seconds_used": 0.0,
+        "memory_bytes_limit": limits["memory_bytes"],
+        "peak_memory_bytes": None,
+        "exceeded": None,
+    }
+
+    with timed_phase("compile"):
+        _, syntax_error = code_cache.compile(code)
+    if syntax_error:
+        # Rejected before the data file is stored; _render_chart builds the usual response
+        return dict(_render_chart({"code": code}, encode), budget=budget)
+
+    worker_request = {key: value for key, value in request_body.items() if key != "limits"}
+    data_file = None
+    lease = contextlib.nullcontext(None)
+    if request_body.get("dataFile"):
+        try:
+            data_file = resolve_data_file(request_body["dataFile"])
+        except LookupError as e:
+            return {"success": False, "error": str(e), "error_code": "dataset_not_found", "budget": budget}
+        except Exception as e:
+            return {"success": False, "error": f"Failed to save data file: {str(e)}", "budget": budget}
+        worker_request["dataFile"] = {"datasetId": data_file["dataset_id"], "filename": data_file["filename"]}
+        # Pin /mnt/data/<filename> to this dataset for as long as the worker runs
+        lease = data_file_lease(data_file["dataset_id"], data_file["filename"])
+
+    # Bad options and render cache hits are answered here without a worker round trip
+    result = _render_chart(worker_request, encode, cache_mode="lookup")
+    if result is None:
+        try:
+            with lease:
+                with timed_phase("worker"):
+                    result, usage = budget_pool.run(worker_request, limits)
+        except OSError as e:
+            return {"success": False, "error": f"Failed to save data file: {str(e)}", "budget": budget}
+
+        budget.update(
+            cpu_seconds_used=usage.get("cpu_seconds"),
+            peak_memory_bytes=usage.get("peak_memory_bytes"),
+            exceeded=usage.get("exceeded"),
+        )
+
+        if result is None:
+            if budget["exceeded"] == "cpu":
+                error = f"Chart exceeded its CPU time budget of {limits['cpu_seconds']:g}s"
+            elif budget["exceeded"] == "wall_time":
+                error = f"Chart did not finish within {limits['cpu_seconds'] + CHART_WALL_SECONDS_SLACK:g}s and was stopped"
+            elif budget["exceeded"] == "memory":
+                error = "Chart worker was killed for using too much memory"
+            else:
+                error = f"Chart worker crashed (exit code {usage.get('exitcode')})"
+            result = {"success": False, "error": error}
+        elif budget["exceeded"] == "memory":
+            result = {
+                "success": False,
+                "error": f"Chart exceeded its memory budget of {limits['memory_bytes'] // (1024 * 1024)} MB",
+                "timings": result.get("timings"),
+            }
+        elif result.get("success"):
+            # The worker rendered with the cache bypassed; store the images in this process
+            with timed_phase("cache_store"):
+                for output in [result] + result.get("extra_outputs", []):
+                    render_cache.put(output["cache_key"], output["image_bytes"])
+
+        if budget["exceeded"]:
+            result["error_code"] = "budget_exceeded"
+            print(f"⛔ Chart stopped: {budget['exceeded']} budget exceeded")
+
+        if encode:
+            for output in [result] + result.get("extra_outputs", []):
+                if "image_bytes" in output:
+                    with timed_phase("encode"):
+                        output["image"] = base64.b64encode(output.pop("image_bytes")).decode('utf-8')
+    if data_file:
+        result.setdefault("dataset_id", data_file["dataset_id"])
+        result["dataset_stored"] = data_file["stored"]
+    result["budget"] = budget
+    return result
+
+
+_batch_pool = None
+_batch_pool_lock = threading.Lock()
+
+
+def get_batch_pool():
+    """
+    Return the container's worker pool, creating it on first use.
+    Workers are spawned (not forked) so each has its own pyplot state and
+    no locks are inherited from the serving threads.
+    """
+    global _batch_pool
+    with _batch_pool_lock:
+        if _batch_pool is None:
+            _batch_pool = ProcessPoolExecutor(
+                max_workers=BATCH_MAX_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _batch_pool
+
+
+def reset_batch_pool():
+    """Drop a broken pool so the next batch starts fresh workers."""
+    global _batch_pool
+    with _batch_pool_lock:
+        if _batch_pool is not None:
+            _batch_pool.shutdown(wait=False, cancel_futures=True)
+        _batch_pool = None
+
+
+def plan_batch_waves(items: list) -> list[list[int]]:
+    """
+    Group item indexes into waves that can run at the same time.
+    All data files share /mnt/data, so two items that write the same filename
+    with different contents must not run concurrently.
+    """
+    waves = []
+    for index, item in enumerate(items):
+        # Malformed items get their error in render_batch; they touch no files
+        data_file = (item.get("dataFile") if isinstance(item, dict) else None) or {}
+        if not isinstance(data_file, dict):
+            data_file = {}
+        filename = data_file.get("filename")
+        fingerprint = data_file.get("datasetId") or hashlib.sha256(str(data_file.get("buffer", "")).encode("utf-8")).hexdigest()
+
+        for wave in waves:
+            if filename is None or wave["files"].get(filename, fingerprint) == fingerprint:
+                break
+        else:
+            wave = {"indexes": [], "files": {}}
+            waves.append(wave)
+
+        wave["indexes"].append(index)
+        if filename is not None:
+            wave["files"][filename] = fingerprint
+
+    return [wave["indexes"] for wave in waves]
+
+
+def render_batch(items: list) -> list[dict]:
+    """Render items across the process pool, returning results in input order."""
+    results = [None] * len(items)
+
+    for wave in plan_batch_waves(items):
+        pool = get_batch_pool()
+        futures = {}
+        for index in wave:
+            item = items[index]
+            if not isinstance(item, dict):
+                results[index] = {"success": False, "error": "Batch item must be an object"}
+                continue
+            futures[index] = pool.submit(render_chart, item)
+
+        broken = False
+        for index, future in futures.items():
+            try:
+                results[index] = future.result()
+            except BrokenProcessPool as e:
+                broken = True
+                results[index] = {"success": False, "error": f"Chart worker crashed: {str(e)}"}
+            except Exception as e:
+                results[index] = {"success": False, "error": f"Chart execution failed: {str(e)}"}
+
+        if broken:
+            print("⚠️ Chart worker pool broke - restarting workers")
+            reset_batch_pool()
+
+    for index, result in enumerate(results):
+        result["index"] = index
+
+    return results
 
-app = modal.App("chart-generator")
 
-# Image with chart libraries
-image = modal.Image.debian_slim().pip_install(
-    "matplotlib",
-    "seaborn", 
-    "pandas",
-    "numpy",
-    "fastapi[standard]"
+def warm_chart_runtime() -> float:
+    """
+    Import and exercise everything a first chart would touch: font lookup,
+    Agg canvas, seaborn styles and pandas readers. Returns seconds spent.
+    """
+    started = time.perf_counter()
+
+    from matplotlib import font_manager
+    from io import StringIO
+
+    font_manager.findfont("DejaVu Sans")
+    sns.set_theme()
+    sns.reset_orig()
+
+    fig, ax = plt.subplots(figsize=(2, 2))
+    ax.plot([0, 1], [0, 1])
+    ax.set_title("warmup")
+    fig.savefig(BytesIO(), format="png", dpi=50)
+    plt.close('all')
+
+    pd.read_csv(StringIO("a,b\n1,2\n"))
+    pd.read_json(StringIO('[{"a": 1}]'))
+
+    return time.perf_counter() - started
+
+
+def binary_response(result: dict) -> Response:
+    """Return rendered bytes with a proper content type; metadata goes in headers."""
+    headers = {
+        "X-Chart-Cached": str(bool(result.get("cached"))).lower(),
+        "X-Chart-Cache-Key": result.get("cache_key", ""),
+        "X-Chart-Format": result.get("format", ""),
+    }
+    if result.get("cache_tier"):
+        headers["X-Chart-Cache-Tier"] = result["cache_tier"]
+    if result.get("dataset_id"):
+        headers["X-Chart-Dataset-Id"] = result["dataset_id"]
+    if result.get("timings"):
+        headers["X-Chart-Timings"] = json.dumps(result["timings"], separators=(",", ":"))
+    if result.get("points"):
+        headers["X-Chart-Points-Input"] = str(result["points"]["input"])
+        headers["X-Chart-Points-Drawn"] = str(result["points"]["drawn"])
+    if result.get("container"):
+        headers["X-Chart-Cold-Start"] = str(result["container"]["cold_start"]).lower()
+        headers["X-Chart-Handler-Seconds"] = str(result["container"]["handler_seconds"])
+    return Response(content=result["image_bytes"], media_type=result["content_type"], headers=headers)
+
+
+_container_stats_lock = threading.Lock()
+
+
+def record_request(result: dict, started: float) -> dict:
+    """Attach cold/warm container timing to a response."""
+    with _container_stats_lock:
+        cold_start = container_stats["requests_served"] == 0
+        container_stats["requests_served"] += 1
+    result["container"] = {
+        "cold_start": cold_start,
+        "import_seconds": container_stats["import_seconds"],
+        "warmup_seconds": container_stats["warmup_seconds"],
+        "requests_served": container_stats["requests_served"],
+        "handler_seconds": round(time.perf_counter() - started, 4),
+    }
+    return result
+
+
+# Histogram buckets for phase durations (seconds) and output sizes (bytes)
+PHASE_SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+OUTPUT_BYTES_BUCKETS = (10_000, 50_000, 100_000, 250_000, 500_000, 1_000_000, 2_500_000, 5_000_000, 10_000_000)
+
+# Upper bounds of the data size buckets used as a metric label
+DATA_SIZE_BUCKETS = (
+    ("lt_100kb", 100 * 1024),
+    ("lt_1mb", 1024 * 1024),
+    ("lt_10mb", 10 * 1024 * 1024),
+    ("lt_100mb", 100 * 1024 * 1024),
 )
 
-@app.function(image=image)
-@modal.fastapi_endpoint(method="POST")
-def generate_chart(request_body: dict) -> dict:
+
+def data_size_bucket(size) -> str:
+    if not size:
+        return "none"
+    for label, limit in DATA_SIZE_BUCKETS:
+        if size < limit:
+            return label
+    return "ge_100mb"
+
+
+def container_id() -> str:
+    # Read per call: containers restored from a memory snapshot get their own task id
+    return os.environ.get("MODAL_TASK_ID", "local")
+
+
+class ChartMetrics:
     """
-    Execute validated Python chart code and return base64-encoded PNG.
-    Code is already validated by Code Interpreter.
+    Minimal Prometheus registry for chart renders. Each container counts in
+    memory and pushes a snapshot to metrics_dict (at most every
+    METRICS_PUSH_INTERVAL_SECONDS, and on exit); the metrics endpoint
+    exports every live container's snapshot with a container label, so a
+    scrape sees all containers whichever one answers it.
     """
-    # Extract code from request body
-    code = request_body.get("code", "")
-    
-    if not code:
-        return {"error": "No code provided in request body"}
-    
-    # Handle data file if provided
-    data_file_info = request_body.get("dataFile")
-    if data_file_info:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._last_push = 0.0
+
+    @staticmethod
+    def _labels(labels: dict) -> tuple:
+        return tuple(sorted(labels.items()))
+
+    def inc(self, name, labels, amount=1.0):
+        with self._lock:
+            key = (name, self._labels(labels))
+            self._counters[key] = self._counters.get(key, 0.0) + amount
+
+    def observe(self, name, labels, value, buckets):
+        with self._lock:
+            key = (name, self._labels(labels))
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = {"buckets": buckets, "counts": [0] * len(buckets), "sum": 0.0, "count": 0}
+                self._histograms[key] = histogram
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram["counts"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def record_render(self, result: dict):
+        """Record a render_chart result (from this process or a batch worker)."""
+        timings = result.get("timings") or {}
+        labels = {
+            "format": result.get("format", "unknown"),
+            "data_size": data_size_bucket(result.get("data_bytes")),
+        }
+        status = "success" if result.get("success") else "error"
+        self.inc("chart_requests_total", dict(labels, status=status, cached=str(bool(result.get("cached"))).lower()))
+
+        for phase, seconds in (timings.get("phases") or {}).items():
+            self.observe("chart_phase_seconds", dict(labels, phase=phase), seconds, PHASE_SECONDS_BUCKETS)
+        if "total_seconds" in timings:
+            self.observe("chart_render_seconds", labels, timings["total_seconds"], PHASE_SECONDS_BUCKETS)
+        if result.get("success"):
+            self.observe("chart_output_bytes", labels, result.get("size", 0), OUTPUT_BYTES_BUCKETS)
+        if result.get("optimization"):
+            self.inc("chart_png_bytes_saved_total", labels, result["optimization"]["bytes_saved"])
+        self.push()
+
+    def snapshot(self) -> dict:
+        """This container's series, as stored in metrics_dict."""
+        with self._lock:
+            return {
+                "updated": time.time(),
+                "counters": dict(self._counters),
+                "histograms": {key: dict(h, counts=list(h["counts"])) for key, h in self._histograms.items()},
+                "gauges": {
+                    ("chart_process_peak_rss_bytes", ()): peak_rss_bytes(),
+                },
+                "code_cache": {"hit": code_cache.hits, "miss": code_cache.misses},
+            }
+
+    def push(self, force: bool = False):
+        """Publish this container's snapshot for the metrics endpoint (throttled unless force)."""
+        if modal.is_local():
+            return
+        now = time.time()
+        if not force and now - self._last_push < METRICS_PUSH_INTERVAL_SECONDS:
+            return
+        self._last_push = now
         try:
-            # Create /mnt/data directory
-            os.makedirs('/mnt/data', exist_ok=True)
-            
-            # Decode base64 file data
-            file_buffer = base64.b64decode(data_file_info["buffer"])
-            filename = data_file_info["filename"]
-            file_path = f'/mnt/data/{filename}'
-            
-            # Save file to /mnt/data/
-            with open(file_path, 'wb') as f:
-                f.write(file_buffer)
-            
-            print(f"📁 Saved data file: {file_path} ({len(file_buffer)} bytes)")
-            
+            metrics_dict[container_id()] = self.snapshot()
         except Exception as e:
-            return {
-                "success": False,
-                "error": f"Failed to save data file: {str(e)}"
+            print(f"⚠️ Metrics push failed: {e}")
+
+    def collect(self) -> dict:
+        """Snapshots of every container that pushed within METRICS_STALE_SECONDS; stale ones are removed."""
+        if modal.is_local():
+            return {container_id(): self.snapshot()}
+        self.push(force=True)
+        snapshots = {}
+        try:
+            for container, snapshot in metrics_dict.items():
+                if time.time() - snapshot.get("updated", 0) > METRICS_STALE_SECONDS:
+                    metrics_dict.pop(container, None)
+                else:
+                    snapshots[container] = snapshot
+        except Exception as e:
+            print(f"⚠️ Metrics read failed, exporting this container only: {e}")
+            return {container_id(): self.snapshot()}
+        return snapshots
+
+    def render(self) -> str:
+        """Prometheus text exposition format, one set of series per container."""
+        def fmt(labels):
+            return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}" if labels else ""
+
+        snapshots = sorted(self.collect().items())
+        counters = {}
+        histograms = {}
+        gauges = {}
+        for container, snapshot in snapshots:
+            label = (("container", container),)
+            for (name, labels), value in snapshot["counters"].items():
+                counters.setdefault(name, []).append((label + labels, value))
+            for (name, labels), histogram in snapshot["histograms"].items():
+                histograms.setdefault(name, []).append((label + labels, histogram))
+            for (name, labels), value in snapshot["gauges"].items():
+                gauges.setdefault(name, []).append((label + labels, value))
+            for result, value in snapshot["code_cache"].items():
+                counters.setdefault("chart_code_cache_lookups_total", []).append((label + (("result", result),), value))
+
+        lines = [
+            f"# Series from {len(snapshots)} container(s) active in the last {METRICS_STALE_SECONDS}s; "
+            "each restarts from zero when its container starts"
+        ]
+        for name in sorted(counters):
+            lines.append(f"# TYPE {name} counter")
+            for labels, value in sorted(counters[name]):
+                lines.append(f"{name}{fmt(labels)} {value}")
+
+        for name in sorted(histograms):
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in sorted(histograms[name], key=lambda item: item[0]):
+                for bound, count in zip(histogram["buckets"], histogram["counts"]):
+                    lines.append(f"{name}_bucket{fmt(labels + (('le', str(bound)),))} {count}")
+                lines.append(f"{name}_bucket{fmt(labels + (('le', '+Inf'),))} {histogram['count']}")
+                lines.append(f"{name}_sum{fmt(labels)} {histogram['sum']}")
+                lines.append(f"{name}_count{fmt(labels)} {histogram['count']}")
+
+        for name in sorted(gauges):
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in sorted(gauges[name]):
+                lines.append(f"{name}{fmt(labels)} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+chart_metrics = ChartMetrics()
+
+
+def finish_render(result: dict, delivery: dict) -> dict:
+    """Record metrics for a render result and drop fields the client did not ask for."""
+    chart_metrics.record_render(result)
+    if not delivery.get("timings"):
+        result.pop("timings", None)
+    return result
+
+
+def normalize_upload_targets(raw_upload, raw_options) -> list[dict]:
+    """
+    Turn a request's upload_url into [{"url", "options"}]. A string uploads
+    the chart as rendered; a list may mix URLs and {"url", "format", ...}
+    objects whose keys override the request options for that upload.
+    """
+    entries = raw_upload if isinstance(raw_upload, list) else [raw_upload]
+    if not entries:
+        raise ValueError("upload_url list is empty")
+    if len(entries) > UPLOAD_MAX_TARGETS:
+        raise ValueError(f"At most {UPLOAD_MAX_TARGETS} upload targets are allowed")
+
+    base_options = raw_options or {}
+    if not isinstance(base_options, dict):
+        raise ValueError("options must be an object")
+
+    targets = []
+    for entry in entries:
+        if isinstance(entry, str):
+            url, overrides = entry, {}
+        elif isinstance(entry, dict):
+            url = entry.get("url")
+            overrides = {key: value for key, value in entry.items() if key != "url"}
+        else:
+            raise ValueError("upload targets must be URLs or {\"url\", ...} objects")
+        if not isinstance(url, str) or not url.startswith(("https://", "http://")):
+            raise ValueError("upload urls must be http(s) URLs")
+
+        raw = dict(base_options)
+        if "format" in overrides:
+            raw = {key: value for key, value in raw.items() if key not in FORMAT_SPECIFIC_OPTIONS}
+        raw.update(overrides)
+        options, _ = normalize_render_options(raw)
+        targets.append({"url": url, "options": options})
+    return targets
+
+
+def prepare_chart_uploads(request_body: dict) -> tuple[dict, list]:
+    """
+    Split a request with upload_url into the render request and its targets.
+    Each distinct set of output options is rendered once (the first one as
+    the main image, the rest as extra_outputs) from a single code run.
+    """
+    targets = normalize_upload_targets(request_body["upload_url"], request_body.get("options"))
+    outputs = []
+    for target in targets:
+        if target["options"] not in outputs:
+            outputs.append(target["options"])
+        target["output"] = outputs.index(target["options"])
+
+    render_body = {key: value for key, value in request_body.items() if key != "upload_url"}
+    render_body["options"] = outputs[0]
+    render_body["extra_outputs"] = outputs[1:]
+    return render_body, targets
+
+
+def upload_chart_outputs(result: dict, targets: list) -> dict:
+    """
+    PUT rendered images to their upload targets and replace the image data
+    in the result with per-upload metadata. Query strings (signatures) are
+    left out of the reported URLs.
+    """
+    import requests
+
+    outputs = [result] + result.get("extra_outputs", [])
+    uploads = []
+    started = time.perf_counter()
+    with requests.Session() as session:
+        for target in targets:
+            output = outputs[target["output"]]
+            upload = {
+                "url": target["url"].split("?", 1)[0],
+                "format": output["format"],
+                "content_type": output["content_type"],
+                "size": output["size"],
             }
-    
-    # Create a namespace for execution
-    def read_json_flexible(file_path):
-        """Try multiple methods to read JSON file"""
+            upload_started = time.perf_counter()
+            try:
+                response = session.put(
+                    target["url"],
+                    data=output["image_bytes"],
+                    headers={"Content-Type": output["content_type"]},
+                    timeout=UPLOAD_TIMEOUT_SECONDS,
+                )
+                upload["status_code"] = response.status_code
+                upload["success"] = response.ok
+                if not response.ok:
+                    upload["error"] = response.text[:200]
+            except requests.RequestException as e:
+                upload["success"] = False
+                upload["error"] = str(e)
+            upload["upload_seconds"] = round(time.perf_counter() - upload_started, 4)
+            uploads.append(upload)
+
+    for output in outputs:
+        output.pop("image_bytes", None)
+    result["uploads"] = uploads
+    if "timings" in result:
+        result["timings"]["phases"]["upload"] = round(time.perf_counter() - started, 6)
+
+    failed = [upload for upload in uploads if not upload["success"]]
+    if failed:
+        print(f"❌ {len(failed)} of {len(uploads)} chart uploads failed")
+        result["success"] = False
+        result["error"] = f"Upload failed for {len(failed)} of {len(uploads)} targets"
+        result["error_code"] = "upload_failed"
+    else:
+        print(f"📤 Uploaded {len(uploads)} chart image(s)")
+    return result
+
+
+def render_chart_request(request_body: dict, encode: bool, dataset_stored: bool = False) -> dict:
+    """
+    Budgeted render of an endpoint or job request, committing cache writes.
+    With upload_url the images go straight to storage and the result only
+    carries metadata.
+    """
+    targets = None
+    if request_body.get("upload_url") is not None:
+        try:
+            request_body, targets = prepare_chart_uploads(request_body)
+        except (TypeError, ValueError) as e:
+            return {"success": False, "error": f"Invalid upload_url: {str(e)}"}
+
+    result = render_chart_budgeted(request_body, encode=encode and targets is None)
+    if dataset_stored and "dataset_id" in result:
+        result["dataset_stored"] = True
+    if result.get("dataset_stored") or (result.get("success") and not result.get("cached")):
+        commit_cache_volume()
+
+    if targets is not None and result.get("success"):
+        result = upload_chart_outputs(result, targets)
+    return result
+
+
+def serve_chart_request(request_body: dict, started: float, dataset_stored: bool = False):
+    """Render one generate_chart request and build its JSON or binary response."""
+    try:
+        _, delivery = normalize_render_options(request_body.get("options"))
+    except (TypeError, ValueError):
+        delivery = {"mode": "json"}  # render_chart reports the validation error
+
+    result = render_chart_request(request_body, encode=delivery["mode"] == "json", dataset_stored=dataset_stored)
+    result = record_request(finish_render(result, delivery), started)
+
+    if delivery["mode"] == "binary" and result.get("success") and "uploads" not in result:
+        return binary_response(result)
+    return result
+
+
+async def stream_upload_to_store(source) -> tuple[str, bool, int]:
+    """
+    Write an upload into the dataset store without buffering it whole.
+    source is an async iterator of byte chunks (request.stream()) or an
+    UploadFile. Returns (dataset_id, created, size); raises ValueError when
+    the upload is over STREAM_UPLOAD_MAX_BYTES.
+    """
+    writer = dataset_store.writer()
+    try:
+        if hasattr(source, "read"):
+            while chunk := await source.read(STREAM_UPLOAD_CHUNK_BYTES):
+                writer.write(chunk)
+        else:
+            async for chunk in source:
+                writer.write(chunk)
+        if writer.size == 0:
+            writer.abort()
+            return None, False, 0
+        dataset_id, created = writer.commit()
+    except BaseException:
+        writer.abort()
+        raise
+    return dataset_id, created, writer.size
+
+
+class ChartUploadForm:
+    """
+    Streaming parser for generate_chart_upload's multipart body. The
+    "request" field is decoded and its code syntax-checked as soon as the
+    field ends, so when it precedes the file a request that cannot render
+    is answered without reading the upload. The "file" part is written
+    straight into the dataset store. Raises ValueError for bad input.
+    """
+
+    def __init__(self, content_type: str):
+        _, params = parse_options_header(content_type)
+        boundary = params.get(b"boundary")
+        if not boundary:
+            raise ValueError("Expected multipart/form-data with a boundary")
+        self.request_body = None
+        self.rejected = False  # code missing or not parseable; the upload was not read
+        self.filename = None
+        self.dataset = None  # (dataset_id, created, size) once the file part is stored
+        self._request_field = bytearray()
+        self._writer = None
+        self._part = None
+        self._header_field = b""
+        self._header_value = b""
+        self._disposition = {}
+        self._parser = multipart.MultipartParser(boundary, {
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+        })
+
+    def _on_part_begin(self):
+        self._part = None
+        self._disposition = {}
+
+    def _on_header_field(self, data, start, end):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data, start, end):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        if self._header_field.lower() == b"content-disposition":
+            _, self._disposition = parse_options_header(self._header_value)
+        self._header_field = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self):
+        name = self._disposition.get(b"name", b"").decode("utf-8", "replace")
+        if name == "file" and b"filename" in self._disposition:
+            self.filename = self._disposition[b"filename"].decode("utf-8", "replace")
+            self._writer = dataset_store.writer()
+        self._part = name
+
+    def _on_part_data(self, data, start, end):
+        if self._part == "request":
+            self._request_field += data[start:end]
+            if len(self._request_field) > STREAM_FORM_FIELD_MAX_BYTES:
+                raise ValueError(f"Request field exceeds {STREAM_FORM_FIELD_MAX_BYTES} bytes")
+        elif self._part == "file" and self._writer is not None:
+            self._writer.write(data[start:end])
+
+    def _on_part_end(self):
+        if self._part == "request":
+            self._parse_request()
+        elif self._part == "file" and self._writer is not None:
+            writer, self._writer = self._writer, None
+            if writer.size == 0:
+                writer.abort()
+                self.dataset = (None, False, 0)
+            else:
+                self.dataset = (*writer.commit(), writer.size)
+        self._part = None
+
+    def _parse_request(self):
+        try:
+            request_body = json_loads(bytes(self._request_field) or b"{}")
+        except ValueError as e:
+            raise ValueError(f"Invalid request field: {str(e)}")
+        if not isinstance(request_body, dict):
+            raise ValueError("Request field must be a JSON object")
+        self.request_body = request_body
+        code = request_body.get("code")
+        self.rejected = not code or code_cache.compile(code)[1] is not None
+
+    async def read(self, stream):
+        """Feed the request body through the parser, stopping early once the request is rejected."""
+        try:
+            async for chunk in stream:
+                self._parser.write(chunk)
+                if self.rejected:
+                    return
+            self._parser.finalize()
+        finally:
+            if self._writer is not None:
+                self._writer.abort()
+                self._writer = None
+        if self.request_body is None:
+            self._parse_request()
+
+
+def run_chart_job_body(request_body: dict) -> dict:
+    """Render a job's request. Jobs always return JSON (base64 image, or upload metadata)."""
+    try:
+        _, delivery = normalize_render_options(request_body.get("options"))
+    except (TypeError, ValueError):
+        delivery = {}
+    return finish_render(render_chart_request(request_body, encode=True), delivery)
+
+
+class JobQueue:
+    """
+    Submit/poll/cancel bookkeeping for chart renders that may outlive an
+    HTTP request. On Modal, renders are spawned onto ChartGenerator and job
+    records live in a shared modal.Dict; when running locally a thread pool
+    and an in-process dict stand in for both. Finished records expire after
+    JOB_RESULT_TTL_SECONDS and are removed by sweep(). A cancel also writes a
+    marker (in a separate Dict) that run() re-checks after each save, so a
+    render saving its status never overwrites a cancel that landed in between.
+    """
+
+    def __init__(self):
+        self._local_records = {}
+        self._local_cancels = {}
+        self._local_futures = {}
+        self._local_executor = None
+        self._cond = threading.Condition()
+
+    @property
+    def _records(self):
+        return self._local_records if modal.is_local() else job_dict
+
+    @property
+    def _cancels(self):
+        return self._local_cancels if modal.is_local() else job_cancel_dict
+
+    @staticmethod
+    def valid_job_id(job_id) -> bool:
+        return (
+            isinstance(job_id, str)
+            and len(job_id) == JOB_ID_LENGTH
+            and all(c in "0123456789abcdef" for c in job_id)
+        )
+
+    def _save(self, record: dict):
+        self._records[record["job_id"]] = record
+        if modal.is_local():
+            with self._cond:
+                self._cond.notify_all()
+
+    def _save_unless_cancelled(self, record: dict) -> bool:
+        """Save a record from run(); if the job was cancelled meanwhile, put the cancel back and return False."""
+        self._save(record)
+        cancelled = self._cancels.get(record["job_id"])
+        if cancelled is None:
+            return True
+        self._save(dict(record, **cancelled))
+        return False
+
+    def get(self, job_id: str):
+        """Return the job record, or None if unknown, expired or not a job id."""
+        if not self.valid_job_id(job_id):
+            return None
+        record = self._records.get(job_id)
+        if record is None:
+            return None
+        if record.get("expires_at") and record["expires_at"] < time.time():
+            try:
+                self._records.pop(job_id)
+            except KeyError:
+                pass
+            return None
+        return record
+
+    def submit(self, request_body: dict) -> dict:
+        job_id = hashlib.sha256(os.urandom(16)).hexdigest()[:JOB_ID_LENGTH]
+        record = {
+            "job_id": job_id,
+            "status": "queued",
+            "submitted_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "expires_at": None,
+            "call_id": None,
+            "result": None,
+        }
+        self._save(record)
+
+        if modal.is_local():
+            self.sweep()
+            if self._local_executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._local_executor = ThreadPoolExecutor(max_workers=CHART_MAX_CONCURRENT_INPUTS)
+            self._local_futures[job_id] = self._local_executor.submit(self.run, job_id, request_body)
+        else:
+            call = ChartGenerator().run_job.spawn(job_id, request_body)
+            record = dict(record, call_id=call.object_id)
+            # A job that already started records its own call id (see run)
+            current = self._records.get(job_id)
+            if current is not None and current["status"] == "queued":
+                self._save(dict(current, call_id=call.object_id))
+        return record
+
+    def run(self, job_id: str, request_body: dict, call_id: str = None):
+        """Execute a submitted job and store its result (runs on the render side)."""
+        record = self.get(job_id)
+        if record is None or record["status"] == "cancelled":
+            return
+        # The call id may not be recorded yet if the job started before submit() returned
+        record = dict(record, status="running", started_at=time.time(), call_id=call_id or record.get("call_id"))
+        if not self._save_unless_cancelled(record):
+            return
+
         try:
-            # Try standard pandas read_json
-            return pd.read_json(file_path)
-        except:
+            result = run_chart_job_body(request_body)
+        except Exception as e:
+            result = {"success": False, "error": f"Chart job failed: {str(e)}"}
+
+        record = self.get(job_id) or record
+        if record["status"] == "cancelled":
+            return
+        finished = time.time()
+        self._save_unless_cancelled(dict(
+            record,
+            status="succeeded" if result.get("success") else "failed",
+            finished_at=finished,
+            expires_at=finished + JOB_RESULT_TTL_SECONDS,
+            result=result,
+        ))
+
+    def wait(self, job_id: str, timeout: float):
+        """Block until the job is finished or timeout passes; returns the latest record."""
+        record = self.get(job_id)
+        if record is None or record["status"] in JOB_TERMINAL_STATES or timeout <= 0:
+            return record
+
+        if modal.is_local():
+            deadline = time.monotonic() + timeout
+            with self._cond:
+                while True:
+                    record = self.get(job_id)
+                    remaining = deadline - time.monotonic()
+                    if record is None or record["status"] in JOB_TERMINAL_STATES or remaining <= 0:
+                        return record
+                    self._cond.wait(remaining)
+
+        # A just-submitted job may not have its call id yet; keep re-reading
+        deadline = time.monotonic() + timeout
+        while not record.get("call_id"):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return record
+            time.sleep(min(JOB_CALL_ID_POLL_SECONDS, remaining))
+            record = self.get(job_id)
+            if record is None or record["status"] in JOB_TERMINAL_STATES:
+                return record
+
+        remaining = deadline - time.monotonic()
+        if remaining > 0:
             try:
-                # Try reading as JSON Lines (one JSON object per line)
-                return pd.read_json(file_path, lines=True)
-            except:
+                modal.FunctionCall.from_id(record["call_id"]).get(timeout=remaining)
+            except (TimeoutError, modal.exception.TimeoutError):
+                pass
+            except Exception as e:
+                # Cancelled or crashed calls surface here; the record says which
+                print(f"⚠️ Job {job_id} call ended: {e}")
+        return self.get(job_id)
+
+    def cancel(self, job_id: str):
+        """Cancel a queued or running job. Returns the updated record, or None if unknown."""
+        record = self.get(job_id)
+        if record is None or record["status"] in JOB_TERMINAL_STATES:
+            return record
+
+        if modal.is_local():
+            future = self._local_futures.get(job_id)
+            if future is not None:
+                future.cancel()  # Running local jobs finish, but their result is discarded
+        elif record.get("call_id"):
+            modal.FunctionCall.from_id(record["call_id"]).cancel()
+
+        finished = time.time()
+        cancelled = {"status": "cancelled", "finished_at": finished, "expires_at": finished + JOB_RESULT_TTL_SECONDS, "result": None}
+        # Marker first: a run() saving after this point restores the cancel
+        self._cancels[job_id] = cancelled
+        record = dict(record, **cancelled)
+        self._save(record)
+        return record
+
+    def sweep(self) -> int:
+        """
+        Remove expired records and cancel markers, plus jobs that never
+        finished (their container died) JOB_STALE_SECONDS after submission.
+        Returns the number of entries removed.
+        """
+        now = time.time()
+        removed = 0
+        for entries in (self._records, self._cancels):
+            for key, record in list(entries.items()):
+                expired = record.get("expires_at") and record["expires_at"] < now
+                stale = record.get("submitted_at") and record["submitted_at"] + JOB_STALE_SECONDS < now
+                if not (expired or stale):
+                    continue
                 try:
-                    # Try reading with different orient parameters
-                    return pd.read_json(file_path, orient='records')
-                except:
-                    try:
-                        # Try reading as nested JSON
-                        return pd.read_json(file_path, orient='index')
-                    except:
-                        try:
-                            # Try reading with json module and convert to DataFrame
-                            with open(file_path, 'r') as f:
-                                data = json.load(f)
-                                if isinstance(data, list):
-                                    return pd.DataFrame(data)
-                                elif isinstance(data, dict):
-                                    # Try to convert dict to DataFrame
-                                    if all(isinstance(v, (list, dict)) for v in data.values()):
-                                        return pd.DataFrame(data)
-                                    else:
-                                        return pd.DataFrame([data])
-                                else:
-                                    return pd.DataFrame(data)
-                        except Exception as e:
-                            raise ValueError(f"Could not read JSON file {file_path}: {str(e)}")
+                    entries.pop(key)
+                    removed += 1
+                except KeyError:
+                    pass
+                self._local_futures.pop(key, None)
+        return removed
 
-    namespace = {
-        'plt': plt,
-        'sns': sns,
-        'pd': pd,
-        'pandas': pd,
-        'np': np,
-        'numpy': np,
-        'read_json_flexible': read_json_flexible,
+
+job_queue = JobQueue()
+
+
+def job_response(record: dict) -> dict:
+    """Public view of a job record."""
+    response = {
+        "success": True,
+        "job_id": record["job_id"],
+        "status": record["status"],
+        "submitted_at": record["submitted_at"],
+        "started_at": record["started_at"],
+        "finished_at": record["finished_at"],
+        "expires_at": record["expires_at"],
     }
-    
-    try:
-        # Execute the validated code
-        exec(code, namespace)
-        
-        # Save to bytes
-        buf = BytesIO()
-        plt.savefig(buf, format='png', dpi=300, bbox_inches='tight')
-        buf.seek(0)
-        image_bytes = buf.read()
-        plt.close()
-        
-        # Convert to base64 for JSON response
-        image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-        
+    if record["status"] in ("succeeded", "failed"):
+        response["result"] = record["result"]
+    return response
+
+
+@app.cls(image=image, volumes={CACHE_ROOT: cache_volume}, enable_memory_snapshot=True)
+@modal.concurrent(max_inputs=CHART_MAX_CONCURRENT_INPUTS)
+class ChartGenerator:
+    """
+    Single-chart endpoint with libraries, fonts and Agg pre-warmed at container start.
+    Each render runs in a warm budget worker process under its CPU time and
+    memory limits, so one container serves several requests at once and a
+    runaway chart only costs its own worker.
+    """
+
+    @modal.enter(snap=True)
+    def warm(self):
+        container_stats["warmup_seconds"] = round(warm_chart_runtime(), 4)
+        print(f"🔥 Chart runtime warmed in {container_stats['warmup_seconds']}s")
+
+    @modal.enter(snap=False)
+    def start_workers(self):
+        # Budget workers are processes, so they start after snapshot restore
+        started = time.perf_counter()
+        budget_pool.prewarm(BUDGET_WORKERS_PREWARM)
+        print(f"🔥 {BUDGET_WORKERS_PREWARM} budget workers started in {time.perf_counter() - started:.2f}s")
+
+    @modal.exit()
+    def stop_workers(self):
+        budget_pool.shutdown()
+        chart_metrics.push(force=True)
+
+    # Label keeps the URL of the former generate_chart function
+    @modal.fastapi_endpoint(method="POST", label="chart-generator-generate-chart")
+    def generate_chart(self, request_body: dict) -> dict:
+        """
+        Execute validated Python chart code and return the chart image.
+        Code is already validated by Code Interpreter.
+        Returns JSON with a base64 image by default; options.response="binary"
+        returns the raw image bytes with their content type instead.
+        Optional limits={"cpu_seconds", "memory_mb"} tighten or raise the
+        render budget up to the server caps; usage is reported under "budget".
+        With upload_url (a presigned URL, or a list of URLs / {"url", "format",
+        ...} objects) the images are PUT to storage and only metadata is returned.
+        """
+        return serve_chart_request(request_body, time.perf_counter())
+
+    # Label follows the chart-generator-* naming of the other endpoints
+    @modal.fastapi_endpoint(method="POST", label="chart-generator-generate-chart-upload")
+    async def generate_chart_upload(self, request: Request):
+        """
+        multipart/form-data variant of generate_chart for large data files.
+        Fields: "request" (the generate_chart JSON body, without a dataFile
+        buffer) and "file" (the data file). The file is streamed into the
+        dataset store and linked into /mnt/data as dataFile.filename, or the
+        uploaded file's own name. Send "request" first: its code is checked
+        before the file is read, so a syntax error does not pay for the upload.
+        """
+        started = time.perf_counter()
+        try:
+            form = ChartUploadForm(request.headers.get("content-type", ""))
+            await form.read(request.stream())
+        except ValueError as e:
+            return {"success": False, "error": str(e)}
+        request_body = form.request_body
+
+        if form.rejected:
+            # Missing or unparseable code: answer with the usual error, without the upload
+            request_body.pop("dataFile", None)
+            return await asyncio.to_thread(serve_chart_request, request_body, started)
+
+        if form.dataset is None:
+            return {"success": False, "error": "No file provided in form data"}
+        dataset_id, created, size = form.dataset
+        if size == 0:
+            return {"success": False, "error": "Uploaded file is empty"}
+
+        data_file = request_body.get("dataFile") or {}
+        request_body["dataFile"] = {
+            "datasetId": dataset_id,
+            "filename": data_file.get("filename") or form.filename,
+        }
+        print(f"📦 Streamed dataset {dataset_id[:12]} ({size} bytes)")
+
+        # Rendering is blocking; keep it off the event loop like the sync endpoints
+        return await asyncio.to_thread(serve_chart_request, request_body, started, created)
+
+    @modal.method()
+    def run_job(self, job_id: str, request_body: dict):
+        """Render a job submitted through submit_job (spawned, not called directly)."""
+        job_queue.run(job_id, request_body, call_id=modal.current_function_call_id())
+
+    @modal.fastapi_endpoint(method="POST", label="chart-generator-submit-job")
+    def submit_job(self, request_body: dict) -> dict:
+        """
+        Queue a generate_chart request and return its job id immediately.
+        Poll job_status (optionally long-polling with wait=seconds) for the
+        result, which is kept for JOB_RESULT_TTL_SECONDS after completion.
+        """
+        if not request_body.get("code"):
+            return {"success": False, "error": "No code provided in request body"}
+
+        record = job_queue.submit(request_body)
+        print(f"🧾 Queued chart job {record['job_id']}")
+        return job_response(record)
+
+    @modal.fastapi_endpoint(method="GET", label="chart-generator-job-status")
+    def job_status(self, job_id: str, wait: float = 0) -> dict:
+        """Return a job's status and, once finished, its result. wait long-polls up to JOB_MAX_WAIT_SECONDS."""
+        wait = min(max(wait, 0), JOB_MAX_WAIT_SECONDS)
+        record = job_queue.wait(job_id, wait)
+        if record is None:
+            return {"success": False, "error": f"Unknown or expired job {job_id}", "error_code": "job_not_found"}
+        return job_response(record)
+
+    @modal.fastapi_endpoint(method="POST", label="chart-generator-cancel-job")
+    def cancel_job(self, request_body: dict) -> dict:
+        """Cancel a queued or running job by {"job_id"}."""
+        job_id = request_body.get("job_id")
+        record = job_queue.cancel(job_id) if job_id else None
+        if record is None:
+            return {"success": False, "error": f"Unknown or expired job {job_id}", "error_code": "job_not_found"}
+        return job_response(record)
+
+    @modal.fastapi_endpoint(method="GET", label="chart-generator-metrics")
+    def metrics(self):
+        """Prometheus metrics for renders served by every live chart-generator container."""
+        return PlainTextResponse(chart_metrics.render(), media_type="text/plain; version=0.0.4")
+
+    @modal.fastapi_endpoint(method="POST", label="chart-generator-upload-dataset")
+    def upload_dataset(self, request_body: dict) -> dict:
+        """
+        Store a data file once and return its dataset id (SHA-256 of the bytes).
+        Later chart requests pass dataFile={"datasetId": id, "filename": name}
+        instead of the base64 buffer.
+        """
+        buffer = request_body.get("buffer")
+        if not buffer:
+            return {"success": False, "error": "No buffer provided in request body"}
+
+        try:
+            file_buffer = base64.b64decode(buffer)
+        except Exception as e:
+            return {"success": False, "error": f"Invalid base64 buffer: {str(e)}"}
+
+        dataset_id, created = dataset_store.put(file_buffer)
+        if created:
+            commit_cache_volume()
+        print(f"📦 Dataset {dataset_id[:12]} {'stored' if created else 'already present'} ({len(file_buffer)} bytes)")
+
         return {
             "success": True,
-            "image": image_base64,
-            "size": len(image_bytes)
+            "dataset_id": dataset_id,
+            "size": len(file_buffer),
+            "created": created
         }
-        
-    except Exception as e:
-        plt.close()  # Clean up on error
+
+    @modal.fastapi_endpoint(method="POST", label="chart-generator-upload-dataset-stream")
+    async def upload_dataset_stream(self, request: Request) -> dict:
+        """
+        Store a data file sent as the raw request body (application/octet-stream).
+        The body is written to the dataset store as it arrives, so memory use
+        does not grow with the file size. Returns the same fields as upload_dataset.
+        """
+        try:
+            dataset_id, created, size = await stream_upload_to_store(request.stream())
+        except ValueError as e:
+            return {"success": False, "error": str(e)}
+
+        if size == 0:
+            return {"success": False, "error": "Empty request body"}
+        if created:
+            commit_cache_volume()
+        print(f"📦 Dataset {dataset_id[:12]} {'stored' if created else 'already present'} ({size} bytes, streamed)")
+
         return {
-            "success": False,
-            "error": f"Chart execution failed: {str(e)}"
+            "success": True,
+            "dataset_id": dataset_id,
+            "size": size,
+            "created": created
         }
 
+
+@app.function(image=image, schedule=modal.Period(hours=JOB_SWEEP_INTERVAL_HOURS))
+def sweep_jobs():
+    """Drop expired job records from the shared Dict; reads only purge the job being read."""
+    removed = job_queue.sweep()
+    print(f"🧹 Swept {removed} expired job record(s)")
+
+
+@app.cls(
+    image=image,
+    volumes={CACHE_ROOT: cache_volume},
+    cpu=float(BATCH_MAX_WORKERS),
+    timeout=600,
+    enable_memory_snapshot=True,
+)
+class ChartBatchGenerator:
+    """Batch endpoint; worker processes are started before the first batch arrives."""
+
+    @modal.enter(snap=True)
+    def warm(self):
+        container_stats["warmup_seconds"] = round(warm_chart_runtime(), 4)
+
+    @modal.enter(snap=False)
+    def start_workers(self):
+        # Processes cannot be snapshotted, so spawn and warm them after restore
+        started = time.perf_counter()
+        pool = get_batch_pool()
+        for future in [pool.submit(warm_chart_runtime) for _ in range(BATCH_MAX_WORKERS)]:
+            future.result()
+        print(f"🔥 {BATCH_MAX_WORKERS} chart workers ready in {time.perf_counter() - started:.2f}s")
+
+    @modal.exit()
+    def stop_workers(self):
+        reset_batch_pool()
+        chart_metrics.push(force=True)
+
+    @modal.fastapi_endpoint(method="POST", label="chart-generator-generate-charts-batch")
+    def generate_charts_batch(self, request_body: dict) -> dict:
+        """
+        Render a list of {code, dataFile, options} items in one container.
+        Each chart runs in a worker process; one failing chart does not fail the batch.
+        """
+        started = time.perf_counter()
+        items = request_body.get("items")
+
+        if not isinstance(items, list) or not items:
+            return {"success": False, "error": "No items provided in request body"}
+
+        if len(items) > BATCH_MAX_ITEMS:
+            return {
+                "success": False,
+                "error": f"Too many items in batch: {len(items)} (max {BATCH_MAX_ITEMS})"
+            }
+
+        print(f"📦 Rendering batch of {len(items)} charts")
+        results = render_batch(items)
+        for item, result in zip(items, results):
+            try:
+                _, delivery = normalize_render_options(item.get("options") if isinstance(item, dict) else None)
+            except (TypeError, ValueError, AttributeError):
+                delivery = {}
+            finish_render(result, delivery)
+
+        if any(r.get("dataset_stored") or (r.get("success") and not r.get("cached")) for r in results):
+            commit_cache_volume()
+
+        succeeded = sum(1 for r in results if r.get("success"))
+        print(f"✅ Batch complete: {succeeded}/{len(results)} succeeded")
+
+        return record_request({
+            "success": True,
+            "results": results,
+            "count": len(results),
+            "succeeded": succeeded,
+            "failed": len(results) - succeeded
+        }, started)
+
+
 # For local testing
 if __name__ == "__main__":
     # Test with sample code
@@ -151,8 +3087,43 @@ plt.grid(True, alpha=0.3)
 """
     }
     
-    result = generate_chart.remote(test_request)
-    if result.get("success"):
-        print(f"Generated chart: {result.get('size')} bytes")
-    else:
-        print(f"Error: {result.get('error')}")
+    import requests
+    from concurrent.futures import ThreadPoolExecutor
+
+    # generate_chart is a web endpoint, so it cannot be called with .remote()/.map();
+    # run the app and drive its URL over HTTP instead
+    with app.run(), requests.Session() as session:
+        url = ChartGenerator().generate_chart.get_web_url()
+        print(f"Endpoint: {url}")
+
+        def post_chart(body: dict) -> dict:
+            response = session.post(url, json=body, timeout=600)
+            response.raise_for_status()
+            return response.json()
+
+        # Two requests against the same container: the first reports the cold start
+        for attempt in range(2):
+            result = post_chart(dict(test_request, code=test_request["code"] + f"\n# run {attempt}"))
+            container = result.get("container", {})
+            if result.get("success"):
+                print(f"Generated chart: {result.get('size')} bytes "
+                      f"(cold_start={container.get('cold_start')}, handler={container.get('handler_seconds')}s, "
+                      f"import={container.get('import_seconds')}s, warmup={container.get('warmup_seconds')}s)")
+            else:
+                print(f"Error: {result.get('error')}")
+
+        # Throughput with several requests in flight per container (distinct code so nothing is cached)
+        requests_in_flight = [
+            dict(test_request, code=test_request["code"] + f"\n# concurrent {time.time()} {i}")
+            for i in range(CHART_MAX_CONCURRENT_INPUTS * 2)
+        ]
+        started = time.perf_counter()
+        for request in requests_in_flight[:CHART_MAX_CONCURRENT_INPUTS]:
+            post_chart(request)
+        sequential_rate = CHART_MAX_CONCURRENT_INPUTS / (time.perf_counter() - started)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=CHART_MAX_CONCURRENT_INPUTS) as pool:
+            list(pool.map(post_chart, requests_in_flight[CHART_MAX_CONCURRENT_INPUTS:]))
+        concurrent_rate = CHART_MAX_CONCURRENT_INPUTS / (time.perf_counter() - started)
+        print(f"Throughput: {sequential_rate:.2f} charts/s sequential, {concurrent_rate:.2f} charts/s concurrent")
@@ -0,0 +1,210 @@
+"""
+Self-checks for chart_render.py
+
+Exercises behaviour that is easy to break without noticing, locally and
+without Modal: the handlers run in-process, caches live in a temporary
+directory (CHART_CACHE_ROOT) and worker processes are real.
+
+Usage:
+    pip install modal matplotlib seaborn pandas numpy pyarrow orjson openpyxl
+    python modal_functions/chart_render_self_test.py
+    python modal_functions/chart_render_self_test.py --checks batch
+
+Exits non-zero when any check fails.
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import tempfile
+import threading
+
+chart_render = None
+
+
+def endpoint(cls, name: str):
+    """The plain function behind a Modal class endpoint, called with an instance."""
+    user_cls = cls._get_user_cls()
+    return lambda *args: getattr(user_cls, name)._get_raw_f()(user_cls(), *args)
+
+
+# Charts that change rcParams and style globally, rendered concurrently
+ISOLATION_CODES = [
+    "plt.rcParams['lines.linewidth'] = 8\nplt.rcParams['axes.facecolor'] = 'black'\nplt.plot([1, 3, 2], color='red')",
+    "plt.style.use('ggplot')\nplt.figure(figsize=(4, 3))\nplt.bar(['a', 'b', 'c'], [3, 1, 2])",
+    "fig, axes = plt.subplots(2, 1)\naxes[0].plot([1, 2])\naxes[1].scatter([1, 2], [2, 1])\nplt.rcParams['font.size'] = 20\nplt.title('big')",
+]
+
+
+def check_pyplot_isolation() -> list:
+    """Concurrent renders don't see each other's figures or rcParams changes."""
+    import matplotlib
+    import matplotlib.pyplot as plt
+
+    rc_before = {key: matplotlib.rcParams[key] for key in ("lines.linewidth", "axes.facecolor", "font.size")}
+    barrier = threading.Barrier(4, timeout=30)
+    seen = {}
+
+    def thread_state(index):
+        with chart_render.isolated_pyplot():
+            plt.rcParams["lines.linewidth"] = 10 + index
+            figure = plt.figure()
+            barrier.wait()  # Every thread has changed rcParams and opened a figure
+            seen[index] = (plt.rcParams["lines.linewidth"], plt.get_fignums(), plt.gcf() is figure)
+            barrier.wait()
+
+    threads = [threading.Thread(target=thread_state, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(60)
+
+    request = lambda code: {"code": code, "options": {"format": "png", "dpi": 50}}
+    serial = [chart_render.render_chart(request(code), cache_mode="bypass")["image"] for code in ISOLATION_CODES]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(ISOLATION_CODES) * 2) as pool:
+        concurrent_runs = list(pool.map(
+            lambda code: chart_render.render_chart(request(code), cache_mode="bypass")["image"],
+            ISOLATION_CODES * 4,
+        ))
+    rc_after = {key: matplotlib.rcParams[key] for key in rc_before}
+
+    return [
+        ("each thread keeps its own rcParams", all(seen.get(i, (None,))[0] == 10 + i for i in range(4))),
+        ("each thread sees only its own figure", all(len(seen.get(i, (0, []))[1]) == 1 and seen[i][2] for i in range(4))),
+        ("concurrent renders match serial ones", concurrent_runs == serial * 4),
+        ("global rcParams untouched", rc_after == rc_before),
+        ("no figures leak", plt.get_fignums() == []),
+    ]
+
+
+def check_budget_workers() -> list:
+    """Budget kills for CPU and memory, crash reporting, and recovery afterwards."""
+    render = chart_render.render_chart_budgeted
+    cpu = render({"code": "while True:\n    pass", "limits": {"cpu_seconds": 1}})
+    memory = render({"code": "hog = bytearray(1024 * 1024 * 1024)\nplt.plot([1, 2])", "limits": {"memory_mb": 256}})
+    crash = render({"code": "import os\nos._exit(3)"})
+    recovered = render({"code": "plt.plot([3, 1, 2])"})
+    return [
+        ("CPU budget stops the chart", cpu["budget"]["exceeded"] == "cpu" and cpu.get("error_code") == "budget_exceeded"),
+        ("memory budget stops the chart", memory["budget"]["exceeded"] == "memory" and memory.get("error_code") == "budget_exceeded"),
+        ("worker crash is reported", crash.get("success") is False and "exit code 3" in crash.get("error", "")),
+        ("next chart renders on a fresh worker", recovered.get("success") is True and recovered["budget"]["exceeded"] is None),
+        ("worker memory is reported", (recovered["budget"]["peak_memory_bytes"] or 0) > 0 or not os.path.exists("/proc/self/clear_refs")),
+    ]
+
+
+def check_batch() -> list:
+    """Malformed batch items fail on their own; the other charts still render."""
+    generate_charts_batch = endpoint(chart_render.ChartBatchGenerator, "generate_charts_batch")
+    response = generate_charts_batch({"items": [
+        {"code": "plt.plot([1, 2, 3])"},
+        "not an object",
+        None,
+        {"code": "plt.bar(['a', 'b'], [1, 2])", "dataFile": "not an object"},
+        {"code": "plt.bar(['a', 'b'], [3, 4])", "options": {"format": "svg"}},
+    ]})
+    results = response.get("results") or []
+    return [
+        ("batch response succeeds", response.get("success") is True and len(results) == 5),
+        ("object items render", [r["success"] for r in results[:1] + results[4:]] == [True, True]),
+        ("non-object items fail alone", all(r.get("error") == "Batch item must be an object" for r in results[1:3])),
+        ("malformed dataFile fails alone", results[3].get("success") is False if len(results) == 5 else False),
+        ("results keep input order", [r.get("index") for r in results] == list(range(5))),
+    ]
+
+
+# Rows covering read_json's conversions: numeric strings, whole floats,
+# nulls, booleans, default date columns and mixed types
+JSON_DTYPE_ROWS = [
+    {"id": 1, "price": 1.5, "qty": 2.0, "code": "007", "label": "a", "ok": True, "created_at": "2024-01-02", "mixed": 1, "sparse": None},
+    {"id": 2, "price": 2.25, "qty": 3.0, "code": "12", "label": "b", "ok": False, "created_at": "2024-02-03", "mixed": "x", "sparse": 4},
+    {"id": 3, "price": None, "qty": 5.0, "code": "3.5", "label": "c", "ok": True, "created_at": "2024-03-04", "mixed": 2.5, "sparse": None},
+]
+
+
+def check_json_dtypes() -> list:
+    """parse_json_frame yields the frame pd.read_json would, for every JSON layout."""
+    import pandas as pd
+
+    columns = {key: [row[key] for row in JSON_DTYPE_ROWS] for key in JSON_DTYPE_ROWS[0]}
+    layouts = {
+        "array": (json.dumps(JSON_DTYPE_ROWS), {}),
+        "lines": ("\n".join(json.dumps(row) for row in JSON_DTYPE_ROWS), {"lines": True}),
+        "columns": (json.dumps(columns), {}),
+    }
+    checks = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for layout, (text, read_json_kwargs) in layouts.items():
+            path = os.path.join(tmp, f"{layout}.json")
+            with open(path, "w") as f:
+                f.write(text)
+            expected = pd.read_json(path, **read_json_kwargs)
+            actual = chart_render.parse_json_frame(path)
+            try:
+                pd.testing.assert_frame_equal(actual, expected, check_index_type=False)
+                matches = True
+            except AssertionError as e:
+                print(f"   {layout}: {str(e).splitlines()[0]}")
+                matches = False
+            checks.append((f"{layout} layout matches pd.read_json", matches))
+    return checks
+
+
+def check_jobs() -> list:
+    """Cancel markers are never served as jobs, and a cancel sticks."""
+    job_status = endpoint(chart_render.ChartGenerator, "job_status")
+    cancel_job = endpoint(chart_render.ChartGenerator, "cancel_job")
+    record = chart_render.job_queue.submit({"code": "time.sleep(1)\nplt.plot([1, 2])"})
+    job_id = record["job_id"]
+    cancelled = cancel_job({"job_id": job_id})
+    # Let the (already running) render finish and try to save its result
+    future = chart_render.job_queue._local_futures.get(job_id)
+    if future is not None:
+        concurrent.futures.wait([future], timeout=60)
+    final = job_status(job_id, 0)
+    not_found = [job_status(f"cancel:{job_id}", 0), cancel_job({"job_id": f"cancel:{job_id}"}), job_status("../etc", 0)]
+    return [
+        ("cancel returns the cancelled job", cancelled.get("status") == "cancelled"),
+        ("cancel survives the render finishing", final.get("status") == "cancelled"),
+        ("malformed job ids are not found", all(r.get("error_code") == "job_not_found" for r in not_found)),
+    ]
+
+
+CHECKS = {
+    "json_dtypes": check_json_dtypes,
+    "pyplot_isolation": check_pyplot_isolation,
+    "budget_workers": check_budget_workers,
+    "batch": check_batch,
+    "jobs": check_jobs,
+}
+
+
+def main():
+    global chart_render
+    parser = argparse.ArgumentParser(description="Self-checks for chart_render.py")
+    parser.add_argument("--checks", nargs="+", choices=sorted(CHECKS), default=list(CHECKS))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="chart-self-test-") as cache_root:
+        os.environ["CHART_CACHE_ROOT"] = cache_root
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import chart_render as module
+        chart_render = module
+
+        failed = 0
+        for name in args.checks:
+            print(f"🧪 {name}")
+            for description, passed in CHECKS[name]():
+                print(f"{'✅' if passed else '❌'} {description}")
+                failed += not passed
+        chart_render.reset_batch_pool()
+        chart_render.budget_pool.shutdown()
+
+    print(f"{'✅ All checks passed' if not failed else f'❌ {failed} check(s) failed'}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
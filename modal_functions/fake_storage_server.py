@@ -0,0 +1,233 @@
+"""
+Local fake object storage for exercising the Manim upload path offline
+
+Serves the two upload styles manim_render.upload_file speaks:
+
+- presigned-style single PUT to any path: checks Content-MD5 when sent and
+  answers with the object's MD5 as ETag (like S3)
+- tus 1.0 resumable uploads: POST creates an upload (Location header),
+  PATCH appends a chunk at Upload-Offset (checking Upload-Checksum sha1),
+  HEAD reports the current offset
+
+Stored objects can be read back with GET. --fail-rate makes a fraction of
+PUT/PATCH/HEAD requests fail with 503 (after reading part of the body), so
+retries and resumption can be watched.
+
+Usage:
+    python modal_functions/fake_storage_server.py --port 9000 --fail-rate 0.2
+    # upload_url: "http://localhost:9000/bucket/video.mp4"
+    # or {"url": "http://localhost:9000/uploads", "protocol": "tus", "chunk_size": 1048576}
+
+    # Upload through manim_render against a flaky server and check the results
+    python modal_functions/fake_storage_server.py --self-test
+
+In-process, start_fake_storage() returns the server and its base URL.
+"""
+
+import argparse
+import base64
+import hashlib
+import os
+import random
+import sys
+import tempfile
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeStorage:
+    """Objects and in-progress resumable uploads, shared by handler threads."""
+
+    def __init__(self, fail_rate: float = 0.0, seed: int = None):
+        self.objects = {}
+        self.uploads = {}
+        self.fail_rate = fail_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        self.fail_next = 0  # Fail this many upcoming requests regardless of fail_rate
+
+    def should_fail(self) -> bool:
+        with self.lock:
+            self.requests += 1
+            fail = self.fail_next > 0 or self.random.random() < self.fail_rate
+            self.fail_next = max(0, self.fail_next - 1)
+            self.failures += fail
+            return fail
+
+
+class FakeStorageHandler(BaseHTTPRequestHandler):
+    storage: FakeStorage = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status: int, headers: dict = None, body: bytes = b""):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body and self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _fail_midway(self):
+        # Read part of the body so the client sees a failure mid-transfer
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length // 2)
+        self.close_connection = True
+        self._reply(503, body=b"injected failure")
+
+    def do_PUT(self):
+        if self.storage.should_fail():
+            return self._fail_midway()
+        body = self._read_body()
+        digest = hashlib.md5(body).digest()
+        sent_md5 = self.headers.get("Content-MD5")
+        if sent_md5 and base64.b64decode(sent_md5) != digest:
+            return self._reply(400, body=b"BadDigest")
+        self.storage.objects[self.path.split("?", 1)[0]] = body
+        self._reply(200, {"ETag": f'"{digest.hex()}"'})
+
+    def do_GET(self):
+        body = self.storage.objects.get(self.path.split("?", 1)[0])
+        if body is None:
+            return self._reply(404)
+        self._reply(200, {"Content-Type": "application/octet-stream"}, body)
+
+    def do_POST(self):
+        length = self.headers.get("Upload-Length")
+        if length is None:
+            return self._reply(400, body=b"Upload-Length required")
+        upload_id = uuid.uuid4().hex
+        metadata = {}
+        for pair in filter(None, self.headers.get("Upload-Metadata", "").split(",")):
+            key, _, value = pair.strip().partition(" ")
+            metadata[key] = base64.b64decode(value).decode("utf-8") if value else ""
+        self.storage.uploads[upload_id] = {"length": int(length), "data": bytearray(), "metadata": metadata}
+        self._reply(201, {"Location": f"/uploads/{upload_id}", "Tus-Resumable": "1.0.0"})
+
+    def _upload(self):
+        return self.storage.uploads.get(self.path.rsplit("/", 1)[-1])
+
+    def do_HEAD(self):
+        upload = self._upload()
+        if upload is None:
+            return self._reply(404)
+        if self.storage.should_fail():
+            return self._reply(503)
+        self._reply(200, {
+            "Upload-Offset": str(len(upload["data"])),
+            "Upload-Length": str(upload["length"]),
+            "Tus-Resumable": "1.0.0",
+            "Cache-Control": "no-store",
+        })
+
+    def do_PATCH(self):
+        upload = self._upload()
+        if upload is None:
+            return self._reply(404)
+        if self.storage.should_fail():
+            return self._fail_midway()
+        if int(self.headers.get("Upload-Offset", -1)) != len(upload["data"]):
+            self._read_body()
+            return self._reply(409, {"Upload-Offset": str(len(upload["data"]))})
+        chunk = self._read_body()
+        checksum = self.headers.get("Upload-Checksum")
+        if checksum:
+            algorithm, _, value = checksum.partition(" ")
+            if algorithm != "sha1" or base64.b64decode(value) != hashlib.sha1(chunk).digest():
+                return self._reply(460, body=b"Checksum mismatch")
+        upload["data"] += chunk
+        if len(upload["data"]) == upload["length"]:
+            name = upload["metadata"].get("objectName") or self.path
+            self.storage.objects["/" + name.lstrip("/")] = bytes(upload["data"])
+        self._reply(204, {"Upload-Offset": str(len(upload["data"])), "Tus-Resumable": "1.0.0"})
+
+
+def start_fake_storage(port: int = 0, fail_rate: float = 0.0, seed: int = None):
+    """Serve fake storage on a background thread. Returns (server, base_url); server.storage holds the objects."""
+    storage = FakeStorage(fail_rate, seed)
+    handler = type("Handler", (FakeStorageHandler,), {"storage": storage})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.storage = storage
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def self_test(fail_rate: float, seed: int) -> bool:
+    """
+    Upload through manim_render against a flaky fake storage: a retried PUT,
+    a tus upload that has to resume, and a render whose artifact can't be
+    made (the main upload must still succeed). Returns True when all pass.
+    """
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import manim_render
+
+    manim_render.UPLOAD_BACKOFF_SECONDS = 0.01
+    server, base_url = start_fake_storage(fail_rate=fail_rate, seed=seed)
+    storage = server.storage
+    payload = random.Random(seed).randbytes(3 * 1024 * 1024 + 123)
+    checks = []
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "render.mp4")
+        with open(path, "wb") as f:
+            f.write(payload)
+
+        storage.fail_next = 2
+        put = manim_render.upload_file(path, "video/mp4", f"{base_url}/bucket/put.mp4?sig=x")
+        checks.append(("put retried after failures", put["attempts"] >= 3))
+        checks.append(("put stored intact", storage.objects.get("/bucket/put.mp4") == payload))
+        checks.append(("put verified by ETag", put["verified"] is True))
+
+        # The first chunk fails, then the HEAD probe for its offset
+        storage.fail_next = 2
+        tus = manim_render.upload_file(path, "video/mp4", {
+            "url": f"{base_url}/uploads",
+            "protocol": "tus",
+            "metadata": {"objectName": "bucket/tus.mp4"},
+            "chunk_size": 256 * 1024,
+        })
+        checks.append(("tus stored intact", storage.objects.get("/bucket/tus.mp4") == payload))
+        checks.append(("tus resumed after failures", tus["attempts"] > 1))
+
+        # Not a real video, so the thumbnail can't be made
+        uploads = manim_render.upload_render_outputs(path, "video", f"{base_url}/bucket/main.mp4", {"thumbnail": f"{base_url}/bucket/thumb.png"})
+        checks.append(("main upload survives a failed artifact", storage.objects.get("/bucket/main.mp4") == payload))
+        checks.append(("artifact failure reported", "error" in uploads.get("thumbnail", {})))
+    server.shutdown()
+
+    print(f"🗄️  {storage.requests} requests, {storage.failures} injected failures")
+    for name, passed in checks:
+        print(f"{'✅' if passed else '❌'} {name}")
+    return storage.failures > 0 and all(passed for _, passed in checks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local fake object storage (PUT + tus)")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--fail-rate", type=float, default=None, help="Fraction of PUT/PATCH/HEAD requests answered with 503 (default 0, or 0.2 with --self-test)")
+    parser.add_argument("--seed", type=int, help="Seed for injected failures")
+    parser.add_argument("--self-test", action="store_true", help="Run manim_render's uploads against a flaky in-process server and exit")
+    args = parser.parse_args()
+
+    if args.self_test:
+        fail_rate = 0.2 if args.fail_rate is None else args.fail_rate
+        sys.exit(0 if self_test(fail_rate, 7 if args.seed is None else args.seed) else 1)
+    args.fail_rate = args.fail_rate or 0.0
+
+    server, base_url = start_fake_storage(args.port, args.fail_rate, args.seed)
+    print(f"🗄️  Fake storage listening on {base_url} (fail rate {args.fail_rate:.0%})")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
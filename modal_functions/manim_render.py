@@ -3,6 +3,20 @@ import subprocess
 import requests
 import os
 import re
+import ast
+import base64
+import builtins
+import glob
+import hashlib
+import importlib
+import importlib.util
+import json
+import random
+import time
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pydantic import BaseModel
 from fastapi import Request
 
@@ -212,16 +226,286 @@ def aggressive_syntax_cleanup(code):
 # Create Modal app
 app = modal.App("manim-explainer")
 
+# Persistent cache volume shared by all manim-explainer containers
+cache_volume = modal.Volume.from_name("manim-explainer-cache", create_if_missing=True)
+CACHE_ROOT = "/cache"
+
+# Partial movies (one MP4 per animation, named by Manim's animation hash)
+PARTIAL_MOVIE_CACHE_DIR = f"{CACHE_ROOT}/partial_movies"
+PARTIAL_MOVIE_CACHE_MAX_BYTES = 20 * 1024 * 1024 * 1024
+# Local directory Manim writes partial movies to when caching is enabled
+PARTIAL_MOVIE_DIR = "media/partial_movie_files"
+
+# Every render runs in its own temp work dir (scene files, manim.cfg,
+# --media_dir) and Manim writes the result to output/render.mp4 (or .png)
+# there, so concurrent renders in one container never see each other's files
+MEDIA_DIR = "media"
+RENDER_OUTPUT_DIR = "output"
+RENDER_OUTPUT_NAME = "render"
+
+# Renders run on ManimRenderer, one variant per CPU weight: a variant's
+# max_inputs is how many renders of that weight fit RENDER_CPUS, so Modal
+# never routes more to a container than it can run at once and scales out
+# instead (short low-resolution scenes still pack several per container)
+RENDER_CPUS = 4.0
+RENDER_CPU_WEIGHTS = {'480p': 1.0, '720p': 2.0, '1080p': 4.0}
+RENDER_TIMEOUT_SECONDS = 1800  # 30 minutes
+# Admission is only a safety net behind that routing; its wait stays short
+# so it can't push a 1200s Manim run past RENDER_TIMEOUT_SECONDS
+RENDER_ADMISSION_TIMEOUT_SECONDS = 30
+# render_manim only dispatches to ManimRenderer and waits for the result;
+# it outlives the render it waits on by the slack
+RENDER_DISPATCH_MAX_CONCURRENT_INPUTS = 50
+RENDER_DISPATCH_SLACK_SECONDS = 300
+
+# Voiceover (TTS) cache: one directory per utterance keyed on text, voice,
+# model and speed, holding the audio and the voiceover data Manim needs.
+TTS_CACHE_DIR = f"{CACHE_ROOT}/tts"
+# "local" swaps the speech service for an offline stand-in (a quiet tone
+# as long as the text takes to speak) so voiceover scenes render without
+# network access or an API key
+TTS_SERVICES = ("openai", "local")
+
+# Appended to voiceover scenes. Wraps SpeechService._wrap_generate_from_text
+# (the call every self.voiceover() block goes through) with a lookup in
+# MANIM_TTS_CACHE_DIR, and counts hits/misses into MANIM_TTS_STATS.
+TTS_CACHE_HOOK = '''
+
+import hashlib as _tts_hashlib
+import json as _tts_json
+import os as _tts_os
+import shutil as _tts_shutil
+
+try:
+    from manim_voiceover.services.base import SpeechService as _TTSSpeechService
+except ImportError:
+    _TTSSpeechService = None
+
+_TTS_CACHE_DIR = _tts_os.environ.get("MANIM_TTS_CACHE_DIR")
+_TTS_STATS_PATH = _tts_os.environ.get("MANIM_TTS_STATS")
+_TTS_STANDIN = _tts_os.environ.get("MANIM_TTS_STANDIN") == "1"
+_tts_stats = {"hits": 0, "misses": 0}
+
+
+def _tts_record(outcome):
+    _tts_stats[outcome] += 1
+    if _TTS_STATS_PATH:
+        with open(_TTS_STATS_PATH, "w") as _stats_file:
+            _tts_json.dump(_tts_stats, _stats_file)
+
+
+def _tts_standin_generate(service, text, **kwargs):
+    import array
+    import math
+    import wave
+    from manim_voiceover.tracker import AUDIO_OFFSET_RESOLUTION
+
+    words = text.split()
+    speed = float(kwargs.get("speed", 1.0)) * service.global_speed
+    seconds = max(0.5, len(words) / 2.5 / speed)  # About 150 words per minute
+    rate = 22050
+    samples = array.array("h", (int(800 * math.sin(2 * math.pi * 220 * n / rate)) for n in range(int(seconds * rate))))
+    name = "standin-" + _tts_hashlib.sha256(f"{text}|{speed}".encode("utf-8")).hexdigest()[:16] + ".wav"
+    with wave.open(_tts_os.path.join(str(service.cache_dir), name), "wb") as audio:
+        audio.setnchannels(1)
+        audio.setsampwidth(2)
+        audio.setframerate(rate)
+        audio.writeframes(samples.tobytes())
+
+    # Evenly spaced word boundaries, so bookmarks work and no transcription is needed
+    boundaries = []
+    text_offset = 0
+    for i, word in enumerate(words):
+        text_offset = text.find(word, text_offset)
+        boundaries.append({
+            "audio_offset": int(seconds * i / len(words) * AUDIO_OFFSET_RESOLUTION),
+            "text_offset": text_offset,
+            "word_length": len(word),
+            "text": word,
+            "boundary_type": "Word",
+        })
+        text_offset += len(word)
+    return {
+        "input_text": text,
+        "input_data": {"input_text": text, "service": "standin"},
+        "original_audio": name,
+        "final_audio": name,
+        "word_boundaries": boundaries,
+    }
+
+
+def _tts_cached_generate(self, text, **kwargs):
+    if "path" in kwargs:
+        return _tts_original_generate(self, text, **kwargs)
+    text = " ".join(text.split())
+    key_data = {
+        "text": text,
+        "service": "standin" if _TTS_STANDIN else type(self).__name__,
+        "voice": getattr(self, "voice", None),
+        "model": getattr(self, "model", None),
+        "speed": kwargs.get("speed", 1.0),
+        "global_speed": self.global_speed,
+        "transcription_model": self.transcription_model,
+        "kwargs": kwargs,
+    }
+    key = _tts_hashlib.sha256(_tts_json.dumps(key_data, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    entry_dir = _tts_os.path.join(_TTS_CACHE_DIR, key[:2], key) if _TTS_CACHE_DIR else None
+
+    if entry_dir and _tts_os.path.exists(_tts_os.path.join(entry_dir, "voiceover.json")):
+        try:
+            with open(_tts_os.path.join(entry_dir, "voiceover.json")) as f:
+                data = _tts_json.load(f)
+            for name in {data["original_audio"], data["final_audio"]}:
+                _tts_shutil.copyfile(_tts_os.path.join(entry_dir, _tts_os.path.basename(name)), _tts_os.path.join(str(self.cache_dir), name))
+            _tts_record("hits")
+            return data
+        except (OSError, ValueError, KeyError) as e:
+            print(f"TTS cache entry unreadable, regenerating: {e}")
+
+    _tts_record("misses")
+    if _TTS_STANDIN:
+        data = _tts_standin_generate(self, text, **kwargs)
+    else:
+        data = _tts_original_generate(self, text, **kwargs)
+
+    if entry_dir:
+        tmp_dir = f"{entry_dir}.{_tts_os.getpid()}.tmp"
+        try:
+            _tts_os.makedirs(tmp_dir, exist_ok=True)
+            for name in {data["original_audio"], data["final_audio"]}:
+                _tts_shutil.copyfile(_tts_os.path.join(str(self.cache_dir), name), _tts_os.path.join(tmp_dir, _tts_os.path.basename(name)))
+            with open(_tts_os.path.join(tmp_dir, "voiceover.json"), "w") as f:
+                _tts_json.dump(data, f)
+            _tts_os.rename(tmp_dir, entry_dir)
+        except OSError as e:
+            # Another render stored it first, or the cache is not writable
+            _tts_shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not _tts_os.path.exists(entry_dir):
+                print(f"TTS cache store failed: {e}")
+    return data
+
+
+def _tts_set_transcription(self, model=None, kwargs=None):
+    # The stand-in provides word boundaries itself; skip loading Whisper
+    _tts_original_set_transcription(self, None, kwargs)
+
+
+if _TTSSpeechService is not None:
+    _tts_original_generate = _TTSSpeechService._wrap_generate_from_text
+    _TTSSpeechService._wrap_generate_from_text = _tts_cached_generate
+    if _TTS_STANDIN:
+        _tts_original_set_transcription = _TTSSpeechService.set_transcription
+        _TTSSpeechService.set_transcription = _tts_set_transcription
+'''
+
+# Compiled LaTeX: Manim names each .tex/.svg by a hash of the full tex file
+# (expression plus template), so the SVGs are shared across renders as-is
+TEX_CACHE_DIR = f"{CACHE_ROOT}/tex"
+# Local tex_dir for a render; cached SVGs are symlinked in before it starts
+TEX_DIR = "media/Tex"
+# Compiled into TEX_CACHE_DIR at image build: digits and symbols DecimalNumber
+# and axis labels typeset one character at a time, plus common formulas
+COMMON_MATH_TEX = [
+    *"0123456789", "-", "+", "=", ".", ",", "x", "y", "z", "t", "n",
+    r"\pi", r"\theta", r"\alpha", r"\beta", r"\lambda", r"\infty", r"\%",
+    r"f(x)", r"x^2", r"\sqrt{2}", r"\frac{1}{2}", r"\frac{dy}{dx}",
+    r"a^2 + b^2 = c^2", r"E = mc^2", r"e^{i\pi} + 1 = 0", r"y = mx + b",
+    r"\sum_{i=1}^{n} i", r"\int_a^b f(x)\,dx", r"\lim_{x \to 0}",
+]
+
+# Uploads: a pooled session per thread, chunk size for checksums and
+# resumable (tus) uploads, retries with exponential backoff on transient failures
+UPLOAD_PROTOCOLS = ("put", "tus")
+UPLOAD_ARTIFACTS = ("thumbnail", "preview")
+UPLOAD_CHUNK_BYTES = 8 * 1024 * 1024
+UPLOAD_CONCURRENCY = 4
+UPLOAD_MAX_ATTEMPTS = 5
+UPLOAD_BACKOFF_SECONDS = 1.0
+UPLOAD_BACKOFF_MAX_SECONDS = 30.0
+UPLOAD_TIMEOUT_SECONDS = 300
+UPLOAD_RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+_upload_sessions = threading.local()
+
+
+def upload_session() -> requests.Session:
+    """
+    This thread's upload session. requests.Session isn't thread-safe and
+    concurrent renders (and upload_artifacts' workers) upload from their
+    own threads, so each thread keeps its own connection pool.
+    """
+    session = getattr(_upload_sessions, "session", None)
+    if session is None:
+        session = requests.Session()
+        _upload_sessions.session = session
+    return session
+
+# Progressive mode: the preview is rendered at -ql (854x480 at 15 fps for 16:9)
+PREVIEW_RESOLUTION = "480p"
+# Suggested delay between render_manim_progress polls
+PROGRESS_POLL_INTERVAL_SECONDS = 5
+
+# Parallel section rendering: at most this many section containers per render
+MAX_PARALLEL_SECTIONS = 16
+
+# Prepended to the scene for section renders. Every section except
+# MANIM_SECTION_TARGET is rendered with skip_animations, and the play count
+# per section is written to MANIM_SECTION_PLAN (used by the --dry_run plan).
+SECTION_RUNNER_PREAMBLE = '''
+import json as _section_json
+import os as _section_os
+from manim.scene.scene_file_writer import SceneFileWriter as _SectionFileWriter
+
+_SECTION_TARGET = int(_section_os.environ.get("MANIM_SECTION_TARGET", "-1"))
+_SECTION_PLAN = _section_os.environ.get("MANIM_SECTION_PLAN")
+_section_plays = {}
+_original_next_section = _SectionFileWriter.next_section
+_original_add_partial_movie_file = _SectionFileWriter.add_partial_movie_file
+
+
+def _section_next_section(self, name, type, skip_animations):
+    index = getattr(self, "_section_index", -1) + 1
+    self._section_index = index
+    if index == _SECTION_TARGET:
+        # Sounds are placed by renderer time; this movie starts at the section
+        self.renderer.time = 0
+    _original_next_section(self, name, type, skip_animations or index != _SECTION_TARGET)
+
+
+def _section_add_partial_movie_file(self, hash_animation):
+    index = getattr(self, "_section_index", 0)
+    _section_plays[index] = _section_plays.get(index, 0) + 1
+    if _SECTION_PLAN:
+        with open(_SECTION_PLAN, "w") as _plan_file:
+            _section_json.dump(_section_plays, _plan_file)
+    _original_add_partial_movie_file(self, hash_animation)
+
+
+_SectionFileWriter.next_section = _section_next_section
+_SectionFileWriter.add_partial_movie_file = _section_add_partial_movie_file
+'''
+
 # Request model
 class RenderRequest(BaseModel):
     code: str
     scene_name: str
-    upload_url: str = None
+    upload_url: str | dict = None
+    artifact_upload_urls: dict = None
     openai_api_key: str = None
     resolution: str = "720p"
     aspect_ratio: str = "16:9"
     duration: int = 8
     style: str = "auto"
+    cache_animations: bool = False
+    parallel_sections: bool = False
+    measure_speedup: bool = False
+    cache_voiceover: bool = True
+    tts_service: str = "openai"
+    cache_tex: bool = True
+    preflight: str = "strict"
+    dry_run: bool = True
+    progressive: bool = False
+    preview_upload_url: str | dict = None
 
 def validate_chart_completeness(code: str) -> list[str]:
     """Validate that charts have required elements."""
@@ -264,6 +548,1042 @@ def validate_text_latex_usage(code: str) -> list[str]:
     
     return warnings
 
+
+# Base classes preflight accepts for the scene to render
+SCENE_BASE_CLASSES = {
+    "Scene", "VoiceoverScene", "MovingCameraScene", "ThreeDScene", "SpecialThreeDScene",
+    "ZoomedScene", "VectorScene", "LinearTransformationScene",
+}
+# Scenes whose camera has a frame (self.camera.frame) in Manim 0.18.1
+MOVING_CAMERA_SCENES = {"MovingCameraScene", "ZoomedScene"}
+# "strict" rejects scenes with preflight errors; "warn" only reports them;
+# "off" skips it (the full pass of a progressive render, already checked)
+PREFLIGHT_MODES = ("strict", "warn", "off")
+
+_module_available = {}
+_star_import_names = {}
+
+
+def module_available(module: str) -> bool:
+    """Whether a top-level module can be imported in this image."""
+    if module not in _module_available:
+        try:
+            _module_available[module] = importlib.util.find_spec(module) is not None
+        except (ImportError, ValueError):
+            _module_available[module] = False
+    return _module_available[module]
+
+
+def star_import_names(module: str):
+    """Names `from module import *` binds, or None when the module cannot be imported."""
+    if module not in _star_import_names:
+        try:
+            imported = importlib.import_module(module)
+            names = getattr(imported, "__all__", None) or [name for name in dir(imported) if not name.startswith("_")]
+            _star_import_names[module] = set(names)
+        except Exception:
+            _star_import_names[module] = None
+    return _star_import_names[module]
+
+
+def apply_source_edits(code: str, edits: list) -> str:
+    """
+    Apply (lineno, col_offset, end_lineno, end_col_offset, text) replacements,
+    positioned as ast reports them (1-based lines, UTF-8 byte columns).
+    """
+    lines = code.split('\n')
+    line_starts = [0]
+    for line in lines:
+        line_starts.append(line_starts[-1] + len(line) + 1)
+
+    def offset(lineno, col):
+        return line_starts[lineno - 1] + len(lines[lineno - 1].encode('utf-8')[:col].decode('utf-8', errors='ignore'))
+
+    for lineno, col, end_lineno, end_col, text in sorted(edits, reverse=True):
+        start, end = offset(lineno, col), offset(end_lineno, end_col)
+        code = code[:start] + text + code[end:]
+    return code
+
+
+def preflight_manim_code(code: str, scene_name: str, style: str = "dark") -> dict:
+    """
+    Static checks on the scene before Manim starts: syntax, which class to
+    render, imports missing from the image, undefined names, and Manim
+    0.18.1 API misuse (camera.frame outside MovingCameraScene, get_graph,
+    config["style"]). API misuse is fixed in the returned code where possible.
+    Returns a report with structured diagnostics.
+    """
+    diagnostics = []
+    edits = []
+
+    def report(severity, kind, message, node=None, fixed=False):
+        diagnostics.append({
+            "severity": severity,
+            "code": kind,
+            "message": message,
+            "line": getattr(node, "lineno", None),
+            "column": getattr(node, "col_offset", None),
+            "fixed": fixed,
+        })
+
+    def finish(code):
+        errors = sum(1 for d in diagnostics if d["severity"] == "error" and not d["fixed"])
+        return {
+            "ok": errors == 0,
+            "scene_name": scene_name,
+            "code": code,
+            "errors": errors,
+            "warnings": sum(1 for d in diagnostics if d["severity"] == "warning"),
+            "fixes": len(edits),
+            "diagnostics": diagnostics,
+        }
+
+    try:
+        tree = ast.parse(code)
+    except SyntaxError as e:
+        diagnostics.append({
+            "severity": "error",
+            "code": "syntax_error",
+            "message": e.msg,
+            "line": e.lineno,
+            "column": e.offset,
+            "fixed": False,
+        })
+        return finish(code)
+
+    # Scene class: the requested one, else the only Scene subclass in the file
+    scenes = {}
+    for node in tree.body:
+        if isinstance(node, ast.ClassDef):
+            bases = [base.id if isinstance(base, ast.Name) else getattr(base, "attr", None) for base in node.bases]
+            if any(base in SCENE_BASE_CLASSES for base in bases):
+                scenes[node.name] = (node, bases)
+    if scene_name not in scenes:
+        if len(scenes) == 1:
+            detected = next(iter(scenes))
+            report("warning", "scene_renamed", f"Scene '{scene_name}' not found; rendering '{detected}'")
+            scene_name = detected
+        elif scenes:
+            report("error", "scene_not_found", f"Scene '{scene_name}' not found; candidates: {', '.join(sorted(scenes))}")
+        else:
+            report("error", "scene_not_found", "No Scene subclass found in the code")
+
+    # Imports, and everything that binds a name anywhere in the file
+    bound = set(dir(builtins)) | {"__name__", "__file__"}
+    names_known = True
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                if not module_available(alias.name.split('.')[0]):
+                    report("error", "missing_import", f"Module '{alias.name}' is not installed", node)
+                bound.add(alias.asname or alias.name.split('.')[0])
+        elif isinstance(node, ast.ImportFrom):
+            if node.level or not node.module:
+                continue
+            if not module_available(node.module.split('.')[0]):
+                report("error", "missing_import", f"Module '{node.module}' is not installed", node)
+                names_known = False
+                continue
+            for alias in node.names:
+                if alias.name == "*":
+                    star_names = star_import_names(node.module)
+                    if star_names is None:
+                        names_known = False
+                    else:
+                        bound |= star_names
+                else:
+                    bound.add(alias.asname or alias.name)
+        elif isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+            bound.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            bound.add(node.name)
+        elif isinstance(node, ast.arg):
+            bound.add(node.arg)
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            bound.update(node.names)
+        elif getattr(node, "name", None) and isinstance(node, (ast.ExceptHandler, ast.MatchAs, ast.MatchStar)):
+            bound.add(node.name)
+        elif isinstance(node, ast.MatchMapping) and node.rest:
+            bound.add(node.rest)
+
+    # Only names bound nowhere in the file are reported. The check ignores
+    # scopes and order, so it is a warning: the dry run catches real NameErrors
+    if names_known:
+        reported = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load) and node.id not in bound and node.id not in reported:
+                reported.add(node.id)
+                report("warning", "undefined_name", f"Name '{node.id}' is not defined", node)
+
+    def is_config_style(node):
+        return (
+            isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and node.value.id == "config"
+            and isinstance(node.slice, ast.Constant) and node.slice.value == "style"
+        ) or (isinstance(node, ast.Attribute) and node.attr == "style" and isinstance(node.value, ast.Name) and node.value.id == "config")
+
+    # Manim 0.18.1 API misuse
+    removed_targets = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Attribute) and node.attr == "get_graph":
+            edits.append((node.end_lineno, node.end_col_offset - len("get_graph"), node.end_lineno, node.end_col_offset, "plot"))
+            report("error", "get_graph", "Axes.get_graph() was renamed to plot() in Manim 0.18", node, fixed=True)
+        elif isinstance(node, ast.Assign) and len(node.targets) == 1 and is_config_style(node.targets[0]):
+            # Setting an unknown config key raises; the request style is applied anyway
+            edits.append((node.lineno, node.col_offset, node.end_lineno, node.end_col_offset, "pass"))
+            removed_targets.add(node.targets[0])
+            report("error", "config_style", 'Manim has no config["style"]; assignment removed', node, fixed=True)
+        elif is_config_style(node) and isinstance(node.ctx, ast.Load):
+            edits.append((node.lineno, node.col_offset, node.end_lineno, node.end_col_offset, repr(style)))
+            report("error", "config_style", f'Manim has no config["style"]; replaced with the request style {style!r}', node, fixed=True)
+        elif is_config_style(node) and node not in removed_targets:
+            report("error", "config_style", 'Manim has no config["style"]', node)
+
+    for class_name, (class_node, bases) in scenes.items():
+        uses_frame = [
+            node for node in ast.walk(class_node)
+            if isinstance(node, ast.Attribute) and node.attr == "frame"
+            and isinstance(node.value, ast.Attribute) and node.value.attr == "camera"
+        ]
+        if not uses_frame or any(base in MOVING_CAMERA_SCENES for base in bases):
+            continue
+        message = f"self.camera.frame needs a MovingCameraScene; '{class_name}' derives from {', '.join(b for b in bases if b)}"
+        if "MovingCameraScene" not in bound:
+            report("error", "camera_frame", message, uses_frame[0])
+        elif "Scene" in bases:
+            base = class_node.bases[bases.index("Scene")]
+            edits.append((base.lineno, base.col_offset, base.end_lineno, base.end_col_offset, "MovingCameraScene"))
+            report("error", "camera_frame", message, uses_frame[0], fixed=True)
+        elif "VoiceoverScene" in bases:
+            base = class_node.bases[-1]
+            edits.append((base.end_lineno, base.end_col_offset, base.end_lineno, base.end_col_offset, ", MovingCameraScene"))
+            report("error", "camera_frame", message, uses_frame[0], fixed=True)
+        else:
+            report("error", "camera_frame", message, uses_frame[0])
+
+    # The older substring checks, reported as warnings
+    for warning in validate_chart_completeness(code):
+        report("warning", "chart_completeness", warning)
+    for warning in validate_text_latex_usage(code):
+        report("warning", "text_latex", warning)
+
+    if edits:
+        fixed_code = apply_source_edits(code, edits)
+        try:
+            ast.parse(fixed_code)
+        except SyntaxError as e:
+            # Keep the original code and count the "fixes" as the errors they still are
+            for diagnostic in diagnostics:
+                diagnostic["fixed"] = False
+            edits.clear()
+            report("error", "autofix_failed", f"Automatic fixes would break the code ({e.msg} at line {e.lineno}); none applied")
+        else:
+            code = fixed_code
+    return finish(code)
+
+def write_manim_config(settings: dict, work_dir: str):
+    """
+    Write manim.cfg in the render's work dir, which Manim (run with that
+    as its cwd) reads on top of its defaults.
+    """
+    with open(os.path.join(work_dir, "manim.cfg"), "w", encoding='utf-8') as f:
+        f.write("[CLI]\n")
+        for key, value in settings.items():
+            f.write(f"{key} = {value}\n")
+
+
+def manim_render_settings(work_dir: str, cache_animations: bool, cache_tex: bool = False) -> tuple[dict, list]:
+    """
+    manim.cfg settings and CLI flags for a render in work_dir: a fixed media
+    dir and output file, with or without the partial movie and LaTeX caches.
+    """
+    output_dir = os.path.join(work_dir, RENDER_OUTPUT_DIR)
+    settings = {"video_dir": output_dir, "images_dir": output_dir}
+    flags = ["--media_dir", os.path.join(work_dir, MEDIA_DIR), "-o", RENDER_OUTPUT_NAME]
+    if cache_tex:
+        settings["tex_dir"] = os.path.join(work_dir, TEX_DIR)
+    if not cache_animations:
+        return settings, flags + ["--disable_caching"]
+    settings["partial_movie_dir"] = os.path.join(work_dir, PARTIAL_MOVIE_DIR)
+    settings["max_files_cached"] = -1  # The Volume cache does its own eviction
+    return settings, flags
+
+
+def render_output(work_dir: str) -> tuple:
+    """The (path, output_type) Manim wrote in work_dir, or (None, None)."""
+    for extension, output_type in ((".mp4", "video"), (".png", "image")):
+        path = os.path.join(work_dir, RENDER_OUTPUT_DIR, RENDER_OUTPUT_NAME + extension)
+        if os.path.exists(path):
+            return path, output_type
+    return None, None
+
+
+class CacheVolumeUsers:
+    """
+    Renders in this container using the cache Volume. Modal refuses a
+    reload while files on the Volume are open, so the Volume is reloaded
+    (to see entries other containers committed) only when a render starts
+    with no other render active; otherwise the reload is skipped and counted.
+    """
+
+    def __init__(self):
+        self.active = 0
+        self.reloads = 0
+        self.skipped = 0
+        self.lock = threading.Lock()
+
+    def reload(self) -> str:
+        """Reload the Volume. Call with the lock held. Returns "reloaded" or why it was skipped."""
+        try:
+            cache_volume.reload()
+            self.reloads += 1
+            return "reloaded"
+        except Exception as e:
+            self.skipped += 1
+            print(f"⚠️ Cache volume reload failed: {e}")
+            return f"failed: {e}"
+
+    def enter(self) -> dict:
+        # Holding the lock through the reload keeps renders starting
+        # meanwhile from opening Volume files until it is done
+        with self.lock:
+            if self.active == 0:
+                reload = self.reload()
+            else:
+                self.skipped += 1
+                reload = f"skipped: {self.active} other render(s) active"
+                print(f"⚠️ Cache volume reload {reload}")
+            self.active += 1
+            return {"reload": reload, "reloads": self.reloads, "skipped": self.skipped}
+
+    def leave(self):
+        with self.lock:
+            self.active -= 1
+
+
+cache_volume_users = CacheVolumeUsers()
+
+
+def seed_partial_movie_cache(work_dir: str) -> int:
+    """
+    Point the local partial movie directory at the cached partial movies.
+    Each cached file is symlinked, so Manim's is_already_cached check finds
+    it without anything being copied. Returns the number of cached files.
+    """
+    partial_movie_dir = os.path.join(work_dir, PARTIAL_MOVIE_DIR)
+    os.makedirs(partial_movie_dir, exist_ok=True)
+    if not os.path.isdir(PARTIAL_MOVIE_CACHE_DIR):
+        return 0
+
+    count = 0
+    for name in os.listdir(PARTIAL_MOVIE_CACHE_DIR):
+        if name.endswith(".mp4"):
+            os.symlink(os.path.join(PARTIAL_MOVIE_CACHE_DIR, name), os.path.join(partial_movie_dir, name))
+            count += 1
+    return count
+
+
+def prune_partial_movie_cache() -> int:
+    """Drop least recently used partial movies until the cache fits its byte cap. Returns files removed."""
+    entries = []
+    total = 0
+    for name in os.listdir(PARTIAL_MOVIE_CACHE_DIR):
+        path = os.path.join(PARTIAL_MOVIE_CACHE_DIR, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+        total += stat.st_size
+
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= PARTIAL_MOVIE_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+            total -= size
+            removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+def collect_partial_movie_cache(work_dir: str) -> dict:
+    """
+    After a cached render: count the animations Manim reused (symlinks into
+    the cache) and rendered (new files), store the new partial movies on the
+    Volume and evict old ones. Returns cache statistics for the response.
+    """
+    used = []
+    list_path = os.path.join(work_dir, PARTIAL_MOVIE_DIR, "partial_movie_file_list.txt")
+    if os.path.exists(list_path):
+        with open(list_path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith("file '"):
+                    used.append(line[len("file '"):-1].replace("file:", "", 1))
+
+    hits = 0
+    misses = 0
+    stored = 0
+    os.makedirs(PARTIAL_MOVIE_CACHE_DIR, exist_ok=True)
+    for path in used:
+        if os.path.islink(path):
+            hits += 1
+            try:
+                os.utime(os.path.realpath(path))  # Recently used, evicted last
+            except OSError:
+                pass
+            continue
+
+        misses += 1
+        target = os.path.join(PARTIAL_MOVIE_CACHE_DIR, os.path.basename(path))
+        if not os.path.exists(target):
+            tmp_path = f"{target}.{os.getpid()}.tmp"
+            shutil.copyfile(path, tmp_path)
+            os.replace(tmp_path, target)
+            stored += 1
+
+    evicted = prune_partial_movie_cache()
+    if stored or evicted:
+        try:
+            cache_volume.commit()
+        except Exception as e:
+            print(f"⚠️ Cache volume commit skipped: {e}")
+
+    total = hits + misses
+    stats = {
+        "enabled": True,
+        "animations": total,
+        "hits": hits,
+        "misses": misses,
+        "hit_ratio": round(hits / total, 4) if total else None,
+        "stored": stored,
+        "evicted": evicted,
+    }
+    print(f"💾 Animation cache: {hits}/{total} reused, {stored} stored, {evicted} evicted")
+    return stats
+
+
+def seed_tex_cache(work_dir: str) -> int:
+    """
+    Start the local tex_dir empty and symlink every cached SVG into it.
+    Manim skips latex/dvisvgm when the SVG for an expression exists.
+    Returns the number of SVGs available.
+    """
+    tex_dir = os.path.join(work_dir, TEX_DIR)
+    os.makedirs(tex_dir, exist_ok=True)
+    os.makedirs(TEX_CACHE_DIR, exist_ok=True)
+    seeded = 0
+    for name in os.listdir(TEX_CACHE_DIR):
+        if name.endswith(".svg"):
+            os.symlink(os.path.join(TEX_CACHE_DIR, name), os.path.join(tex_dir, name))
+            seeded += 1
+    return seeded
+
+
+def collect_tex_cache(work_dir: str) -> dict:
+    """
+    After a render: every expression Manim typeset left a .tex file. Its SVG
+    is a symlink when the compile was avoided, or a new file to store on
+    the Volume. Returns cache statistics for the response.
+    """
+    avoided = 0
+    compiled = 0
+    stored = 0
+    tex_dir = os.path.join(work_dir, TEX_DIR)
+    if os.path.isdir(tex_dir):
+        for name in os.listdir(tex_dir):
+            if not name.endswith(".tex"):
+                continue
+            svg_path = os.path.join(tex_dir, name[:-len(".tex")] + ".svg")
+            if os.path.islink(svg_path):
+                avoided += 1
+            elif os.path.exists(svg_path):
+                compiled += 1
+                target = os.path.join(TEX_CACHE_DIR, os.path.basename(svg_path))
+                if not os.path.exists(target):
+                    tmp_path = f"{target}.{os.getpid()}.tmp"
+                    shutil.copyfile(svg_path, tmp_path)
+                    os.replace(tmp_path, target)
+                    stored += 1
+
+    if stored:
+        try:
+            cache_volume.commit()
+        except Exception as e:
+            print(f"⚠️ Cache volume commit skipped: {e}")
+
+    total = avoided + compiled
+    stats = {
+        "enabled": True,
+        "expressions": total,
+        "compilations_avoided": avoided,
+        "compiled": compiled,
+        "hit_ratio": round(avoided / total, 4) if total else None,
+        "stored": stored,
+    }
+    if total:
+        print(f"🧮 LaTeX cache: {avoided}/{total} compilations avoided, {stored} stored")
+    return stats
+
+
+def build_tex_cache():
+    """Image build step: compile COMMON_MATH_TEX into the shared LaTeX cache."""
+    from manim import config, MathTex
+
+    os.makedirs(TEX_CACHE_DIR, exist_ok=True)
+    config.tex_dir = TEX_CACHE_DIR
+    for expression in COMMON_MATH_TEX:
+        try:
+            MathTex(expression)
+        except Exception as e:
+            print(f"⚠️ Could not pre-compile {expression!r}: {e}")
+    cache_volume.commit()
+    print(f"🧮 LaTeX cache holds {len(glob.glob(os.path.join(TEX_CACHE_DIR, '*.svg')))} SVGs")
+
+
+def add_tts_cache(code: str) -> str:
+    """Append TTS_CACHE_HOOK to scenes that use manim-voiceover."""
+    if "manim_voiceover" not in code:
+        return code
+    return code.rstrip('\n') + '\n' + TTS_CACHE_HOOK
+
+
+def tts_cache_env(cache_voiceover: bool, tts_service: str, stats_path: str = None) -> dict:
+    """Environment variables that configure TTS_CACHE_HOOK for one Manim run."""
+    env = {}
+    if cache_voiceover:
+        os.makedirs(TTS_CACHE_DIR, exist_ok=True)
+        env["MANIM_TTS_CACHE_DIR"] = TTS_CACHE_DIR
+    if tts_service == "local":
+        env["MANIM_TTS_STANDIN"] = "1"
+    if stats_path:
+        env["MANIM_TTS_STATS"] = stats_path
+    return env
+
+
+def read_tts_cache_stats(stats_path: str, cache_voiceover: bool, dry_run_stats_path: str = None) -> dict:
+    """
+    Read the hit/miss counts TTS_CACHE_HOOK wrote during a render (and its
+    dry run, which synthesizes the audio first and writes its own file),
+    sum them and commit newly stored audio to the Volume. Returns stats
+    for the response.
+    """
+    stats = {"enabled": cache_voiceover, "hits": 0, "misses": 0}
+    for path in (stats_path, dry_run_stats_path):
+        if path and os.path.exists(path):
+            with open(path) as f:
+                counts = json.load(f)
+            stats["hits"] += counts.get("hits", 0)
+            stats["misses"] += counts.get("misses", 0)
+
+    total = stats["hits"] + stats["misses"]
+    stats["voiceovers"] = total
+    stats["hit_ratio"] = round(stats["hits"] / total, 4) if total else None
+    if cache_voiceover and stats["misses"]:
+        try:
+            cache_volume.commit()
+        except Exception as e:
+            print(f"⚠️ Cache volume commit skipped: {e}")
+    if total:
+        print(f"🔊 Voiceover cache: {stats['hits']}/{total} reused")
+    return stats
+
+
+def insert_auto_sections(code: str, scene_name: str) -> tuple[str, int]:
+    """
+    Add self.next_section() after each top-level statement of construct()
+    that clears the screen (self.clear() or a FadeOut). Code that already
+    calls next_section is left alone. Returns (code, sections_added).
+    """
+    if "next_section(" in code:
+        return code, 0
+
+    tree = ast.parse(code)
+    construct = None
+    for node in tree.body:
+        if isinstance(node, ast.ClassDef) and node.name == scene_name:
+            construct = next((item for item in node.body if isinstance(item, ast.FunctionDef) and item.name == "construct"), None)
+    if construct is None:
+        return code, 0
+
+    def clears_screen(statement):
+        for node in ast.walk(statement):
+            if not isinstance(node, ast.Call):
+                continue
+            func = node.func
+            if isinstance(func, ast.Name) and func.id == "FadeOut":
+                return True
+            if isinstance(func, ast.Attribute) and func.attr == "clear" and isinstance(func.value, ast.Name) and func.value.id == "self":
+                return True
+        return False
+
+    lines = code.split('\n')
+    boundaries = [statement for statement in construct.body[:-1] if clears_screen(statement)]
+    for n, statement in enumerate(reversed(boundaries)):
+        indent = ' ' * statement.col_offset
+        lines.insert(statement.end_lineno, f'{indent}self.next_section("auto_{len(boundaries) - n}")')
+    return '\n'.join(lines), len(boundaries)
+
+
+def add_section_runner(code: str) -> str:
+    """Prepend SECTION_RUNNER_PREAMBLE, keeping any __future__ imports first."""
+    lines = code.split('\n')
+    insert_at = 0
+    for i, line in enumerate(lines):
+        if line.startswith("from __future__"):
+            insert_at = i + 1
+    return '\n'.join(lines[:insert_at] + [SECTION_RUNNER_PREAMBLE] + lines[insert_at:])
+
+
+def plan_sections(code: str, scene_name: str, render_flags: list, work_dir: str, extra_env: dict = None) -> list[int]:
+    """
+    Run the scene once with --dry_run (nothing is rendered) to learn which
+    sections contain animations. Returns their indexes in order.
+    """
+    with open(os.path.join(work_dir, "sections_plan.py"), "w", encoding='utf-8') as f:
+        f.write(add_section_runner(code))
+
+    plan_path = os.path.join(work_dir, "sections_plan.json")
+    if os.path.exists(plan_path):
+        os.remove(plan_path)
+    env = dict(os.environ, **(extra_env or {}), MANIM_SECTION_TARGET="-1", MANIM_SECTION_PLAN=plan_path)
+    result = subprocess.run(
+        ["manim", "--dry_run", "--disable_caching", "--media_dir", os.path.join(work_dir, MEDIA_DIR), "sections_plan.py", scene_name, *render_flags],
+        capture_output=True,
+        text=True,
+        timeout=600,
+        env=env,
+        cwd=work_dir,
+    )
+    if result.returncode != 0:
+        raise Exception(f"Section planning failed: {result.stderr}")
+    if not os.path.exists(plan_path):
+        return []
+
+    with open(plan_path) as f:
+        plays = json.load(f)
+    return sorted(int(index) for index, count in plays.items() if count > 0)
+
+
+def parse_manim_error(stderr: str, script: str) -> dict:
+    """Pull the exception and the line in script it was raised from out of Manim's traceback."""
+    name = re.escape(os.path.basename(script))
+    lines = re.findall(rf'{name}", line (\d+)|{name}:(\d+)', stderr)
+    line = int(next(n for n in lines[-1] if n)) if lines else None
+
+    message = None
+    for text in reversed(stderr.splitlines()):
+        match = re.match(r'^\s*([A-Za-z_][\w.]*(?:Error|Exception|Interrupt)\b.*)$', text)
+        if match:
+            message = match.group(1).strip()
+            break
+    if message is None:
+        message = next((text.strip() for text in reversed(stderr.splitlines()) if text.strip()), "Manim exited with an error")
+    return {"error": message, "line": line}
+
+
+def dry_run_scene(manim_cmd: list, script: str, work_dir: str, env: dict = None) -> tuple[dict, str]:
+    """
+    Run the Manim command with --dry_run: construct() executes with every
+    animation skipped and nothing rendered or encoded, so runtime errors
+    surface in seconds. Returns (report, stderr).
+    """
+    started = time.time()
+    result = subprocess.run(
+        [manim_cmd[0], "--dry_run", *manim_cmd[1:]],
+        capture_output=True,
+        text=True,
+        timeout=600,
+        env=env,
+        cwd=work_dir,
+    )
+    report = {"passed": result.returncode == 0, "seconds": round(time.time() - started, 2)}
+    if result.returncode != 0:
+        report.update(parse_manim_error(result.stderr, script))
+        print(f"❌ Dry run failed in {report['seconds']}s (line {report['line']}): {report['error']}")
+    else:
+        print(f"✅ Dry run passed in {report['seconds']}s")
+    return report, result.stderr
+
+
+def concat_videos(paths: list, output_path: str):
+    """Join MP4s with ffmpeg's concat demuxer (stream copy, no re-encode)."""
+    list_path = f"{output_path}.txt"
+    with open(list_path, "w", encoding='utf-8') as f:
+        for path in paths:
+            f.write(f"file '{os.path.abspath(path)}'\n")
+    result = subprocess.run(
+        ["ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", list_path, "-c", "copy", output_path],
+        capture_output=True,
+        text=True,
+        timeout=600,
+    )
+    if result.returncode != 0:
+        raise Exception(f"ffmpeg concat failed: {result.stderr}")
+
+
+def merge_cache_stats(stats: list, hits_key: str, total_key: str) -> dict:
+    """Sum cache statistics from several renders and recompute the hit ratio."""
+    merged = {"enabled": True}
+    for entry in stats:
+        for key, value in (entry or {}).items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool) and key != "hit_ratio":
+                merged[key] = merged.get(key, 0) + value
+    total = merged.get(total_key, 0)
+    merged["hit_ratio"] = round(merged.get(hits_key, 0) / total, 4) if total else None
+    return merged
+
+
+def render_sections_in_parallel(code: str, scene_name: str, render_flags: list, work_dir: str, cache_animations: bool, measure_speedup: bool, extra_env: dict = None, cache_tex: bool = True) -> tuple[str, dict]:
+    """
+    Render each section of the scene on its own container and join the
+    MP4s. Returns (output_path, report); raises when the scene does not
+    split into at least two sections.
+    """
+    extra_env = extra_env or {}
+    started = time.time()
+    code, auto_sections = insert_auto_sections(code, scene_name)
+    if auto_sections:
+        print(f"✂️ Inserted {auto_sections} automatic section breaks")
+
+    sections = plan_sections(code, scene_name, render_flags, work_dir, extra_env)
+    planned = time.time()
+    # The plan run already synthesized any voiceover; let the section containers reuse it
+    section_env = {name: value for name, value in extra_env.items() if name != "MANIM_TTS_STATS"}
+    if "MANIM_TTS_CACHE_DIR" in section_env:
+        cache_volume.commit()
+    tex_stats = []
+    if cache_tex:
+        # The plan run typeset every expression too; store them for the sections
+        tex_stats.append(collect_tex_cache(work_dir))
+    if len(sections) < 2:
+        raise Exception(f"Scene has {len(sections)} section(s) with animations - nothing to parallelize")
+    if len(sections) > MAX_PARALLEL_SECTIONS:
+        raise Exception(f"Scene has {len(sections)} sections (max {MAX_PARALLEL_SECTIONS} for parallel rendering)")
+    print(f"✂️ Rendering {len(sections)} sections in parallel: {sections}")
+
+    # The single-container reference render runs alongside, so it does not add wall time
+    single_call = None
+    if measure_speedup:
+        single_call = render_manim_section.spawn(code, scene_name, None, render_flags, cache_animations, section_env, cache_tex)
+
+    section_code = add_section_runner(code)
+    results = list(render_manim_section.map(
+        [section_code] * len(sections),
+        [scene_name] * len(sections),
+        sections,
+        [render_flags] * len(sections),
+        [cache_animations] * len(sections),
+        [section_env] * len(sections),
+        [cache_tex] * len(sections),
+    ))
+    rendered = time.time()
+
+    failed = [r for r in results if not r["success"]]
+    if failed:
+        raise Exception(f"Section {failed[0]['section']} failed: {failed[0]['error']}")
+
+    sections_dir = os.path.join(work_dir, MEDIA_DIR, "sections")
+    os.makedirs(sections_dir, exist_ok=True)
+    paths = []
+    for r in results:
+        path = os.path.join(sections_dir, f"section_{r['section']:03d}.mp4")
+        with open(path, "wb") as f:
+            f.write(r["video"])
+        paths.append(path)
+
+    output_path = os.path.join(sections_dir, f"{scene_name}.mp4")
+    concat_videos(paths, output_path)
+    finished = time.time()
+
+    section_seconds = [r["seconds"] for r in results]
+    report = {
+        "sections": len(sections),
+        "auto_sections": auto_sections,
+        "plan_seconds": round(planned - started, 2),
+        "render_seconds": round(rendered - planned, 2),
+        "concat_seconds": round(finished - rendered, 2),
+        "wall_seconds": round(finished - started, 2),
+        "section_seconds": section_seconds,
+        # Sum of section renders approximates one container doing all the work
+        "estimated_single_seconds": round(sum(section_seconds), 2),
+        "estimated_speedup": round(sum(section_seconds) / max(finished - started, 1e-6), 2),
+        # Summed over the section containers (and the plan run for LaTeX)
+        "animation_cache": merge_cache_stats([r["animation_cache"] for r in results], "hits", "animations") if cache_animations else {"enabled": False},
+        "tex_cache": merge_cache_stats(tex_stats + [r["tex_cache"] for r in results], "compilations_avoided", "expressions") if cache_tex else {"enabled": False},
+    }
+    if single_call is not None:
+        single = single_call.get()
+        if single["success"]:
+            report["single_seconds"] = single["seconds"]
+            report["speedup"] = round(single["seconds"] / max(finished - started, 1e-6), 2)
+        else:
+            report["single_error"] = single["error"]
+    print(f"⚡ Parallel render: {report['wall_seconds']}s wall for {len(sections)} sections (est. speedup {report['estimated_speedup']}x)")
+    return output_path, report
+
+
+def file_checksums(path: str) -> dict:
+    """Size, MD5 and SHA-256 of a file, in one read."""
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_BYTES), b""):
+            md5.update(chunk)
+            sha256.update(chunk)
+            size += len(chunk)
+    return {"size": size, "md5": md5.hexdigest(), "sha256": sha256.hexdigest()}
+
+
+def normalize_upload_target(target) -> dict:
+    """
+    An upload target is a presigned URL string (single PUT) or a dict:
+    {"url", "protocol": "put" | "tus", "headers", "metadata", "chunk_size"}.
+    "tus" uploads in resumable chunks (e.g. Supabase's resumable endpoint).
+    """
+    if isinstance(target, str):
+        target = {"url": target}
+    if not isinstance(target, dict) or not isinstance(target.get("url"), str):
+        raise ValueError("Upload target must be a URL or an object with a url")
+    protocol = target.get("protocol", "put")
+    if protocol not in UPLOAD_PROTOCOLS:
+        raise ValueError(f"Upload protocol must be one of: {', '.join(UPLOAD_PROTOCOLS)}")
+    return {
+        "url": target["url"],
+        "protocol": protocol,
+        "headers": dict(target.get("headers") or {}),
+        "metadata": dict(target.get("metadata") or {}),
+        "chunk_size": int(target.get("chunk_size") or UPLOAD_CHUNK_BYTES),
+    }
+
+
+def upload_backoff(attempt: int):
+    """Exponential backoff with jitter before retry number `attempt`."""
+    delay = min(UPLOAD_BACKOFF_MAX_SECONDS, UPLOAD_BACKOFF_SECONDS * 2 ** (attempt - 1))
+    time.sleep(delay * random.uniform(0.5, 1.0))
+
+
+def upload_retryable(error: Exception) -> bool:
+    if isinstance(error, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)):
+        return True
+    response = getattr(error, "response", None)
+    return response is not None and response.status_code in UPLOAD_RETRY_STATUSES
+
+
+def put_file(path: str, content_type: str, target: dict, checksums: dict) -> dict:
+    """Single PUT of the whole file, retried; verified against the ETag when the server returns an MD5 one."""
+    headers = {
+        "Content-Type": content_type,
+        "Content-Length": str(checksums["size"]),
+        "Content-MD5": base64.b64encode(bytes.fromhex(checksums["md5"])).decode("ascii"),
+        **target["headers"],
+    }
+    for attempt in range(1, UPLOAD_MAX_ATTEMPTS + 1):
+        try:
+            with open(path, "rb") as f:
+                response = upload_session().put(target["url"], data=f, headers=headers, timeout=UPLOAD_TIMEOUT_SECONDS)
+            response.raise_for_status()
+            etag = response.headers.get("ETag", "").strip('"')
+            verified = None
+            if re.fullmatch(r"[0-9a-f]{32}", etag):
+                verified = etag == checksums["md5"]
+                if not verified:
+                    raise requests.ConnectionError(f"Checksum mismatch: sent {checksums['md5']}, stored {etag}")
+            return {"attempts": attempt, "chunks": 1, "verified": verified}
+        except requests.RequestException as e:
+            if attempt == UPLOAD_MAX_ATTEMPTS or not upload_retryable(e):
+                raise
+            print(f"⚠️ Upload attempt {attempt} failed, retrying: {e}")
+            upload_backoff(attempt)
+
+
+def tus_offset(location: str, headers: dict) -> int:
+    """Server-side offset of a tus upload (HEAD), retried like the uploads themselves."""
+    for attempt in range(1, UPLOAD_MAX_ATTEMPTS + 1):
+        try:
+            head = upload_session().head(location, headers=headers, timeout=UPLOAD_TIMEOUT_SECONDS)
+            head.raise_for_status()
+            return int(head.headers["Upload-Offset"])
+        except requests.RequestException as e:
+            if attempt == UPLOAD_MAX_ATTEMPTS or not upload_retryable(e):
+                raise
+            print(f"⚠️ Offset check {attempt} failed, retrying: {e}")
+            upload_backoff(attempt)
+
+
+def tus_upload_file(path: str, content_type: str, target: dict, checksums: dict) -> dict:
+    """
+    Resumable upload (tus 1.0): create the upload, then PATCH chunks. After
+    a failed chunk the server's offset is re-read with HEAD and the upload
+    resumes from there. Each chunk carries an Upload-Checksum.
+    """
+    base_headers = {"Tus-Resumable": "1.0.0", **target["headers"]}
+    metadata = dict(target["metadata"], contentType=content_type)
+    encoded_metadata = ",".join(
+        f"{key} {base64.b64encode(str(value).encode('utf-8')).decode('ascii')}" for key, value in metadata.items()
+    )
+
+    attempts = 0
+    location = None
+    while location is None:
+        attempts += 1
+        try:
+            response = upload_session().post(
+                target["url"],
+                headers={**base_headers, "Upload-Length": str(checksums["size"]), "Upload-Metadata": encoded_metadata},
+                timeout=UPLOAD_TIMEOUT_SECONDS,
+            )
+            response.raise_for_status()
+            location = requests.compat.urljoin(target["url"], response.headers["Location"])
+        except requests.RequestException as e:
+            if attempts == UPLOAD_MAX_ATTEMPTS or not upload_retryable(e):
+                raise
+            upload_backoff(attempts)
+
+    offset = 0
+    chunks = 0
+    retries = 0
+    failures = 0  # Consecutive, reset whenever a chunk lands
+    with open(path, "rb") as f:
+        while offset < checksums["size"]:
+            f.seek(offset)
+            chunk = f.read(target["chunk_size"])
+            checksum = base64.b64encode(hashlib.sha1(chunk).digest()).decode("ascii")
+            try:
+                response = upload_session().patch(
+                    location,
+                    data=chunk,
+                    headers={
+                        **base_headers,
+                        "Content-Type": "application/offset+octet-stream",
+                        "Upload-Offset": str(offset),
+                        "Upload-Checksum": f"sha1 {checksum}",
+                    },
+                    timeout=UPLOAD_TIMEOUT_SECONDS,
+                )
+                response.raise_for_status()
+                offset = int(response.headers["Upload-Offset"])
+                chunks += 1
+                failures = 0
+            except requests.RequestException as e:
+                failures += 1
+                retries += 1
+                if failures == UPLOAD_MAX_ATTEMPTS or not (upload_retryable(e) or getattr(e.response, "status_code", None) in (409, 460)):
+                    raise
+                print(f"⚠️ Chunk at offset {offset} failed, resuming: {e}")
+                upload_backoff(failures)
+                offset = tus_offset(location, base_headers)
+
+    stored = tus_offset(location, base_headers)
+    verified = stored == checksums["size"]
+    if not verified:
+        raise Exception(f"Resumable upload incomplete: server has {stored} of {checksums['size']} bytes")
+    return {"attempts": attempts + retries, "chunks": chunks, "verified": verified}
+
+
+def upload_file(path: str, content_type: str, target) -> dict:
+    """Upload one file to a target (see normalize_upload_target). Returns an upload report."""
+    target = normalize_upload_target(target)
+    started = time.time()
+    checksums = file_checksums(path)
+    if target["protocol"] == "tus":
+        outcome = tus_upload_file(path, content_type, target, checksums)
+    else:
+        outcome = put_file(path, content_type, target, checksums)
+    return {
+        "url": target["url"].split("?", 1)[0],
+        "protocol": target["protocol"],
+        "content_type": content_type,
+        **checksums,
+        **outcome,
+        "seconds": round(time.time() - started, 2),
+    }
+
+
+def upload_artifacts(artifacts: dict) -> dict:
+    """
+    Upload {name: (path, content_type, target)} concurrently, each worker
+    thread over its own session. Returns {name: report}; a failed upload's report is
+    {"error": ...} so one artifact can't sink the others.
+    """
+    reports = {}
+    with ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY) as pool:
+        futures = {pool.submit(upload_file, *artifact): name for name, artifact in artifacts.items()}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                reports[name] = future.result()
+                print(f"✅ Uploaded {name} ({reports[name]['size']} bytes, {reports[name]['attempts']} attempt(s))")
+            except Exception as e:
+                print(f"⚠️ Upload of {name} failed: {e}")
+                reports[name] = {"error": str(e)}
+    return reports
+
+
+def make_thumbnail(video_path: str, output_path: str):
+    """Grab a PNG frame one second in (or the first frame of shorter videos)."""
+    result = subprocess.run(
+        ["ffmpeg", "-y", "-ss", "1", "-i", video_path, "-frames:v", "1", output_path],
+        capture_output=True, text=True, timeout=120,
+    )
+    if result.returncode != 0 or not os.path.exists(output_path):
+        result = subprocess.run(
+            ["ffmpeg", "-y", "-i", video_path, "-frames:v", "1", output_path],
+            capture_output=True, text=True, timeout=120,
+        )
+    if result.returncode != 0:
+        raise Exception(f"Thumbnail extraction failed: {result.stderr[-500:]}")
+
+
+def make_preview_video(video_path: str, output_path: str):
+    """Small 360p re-encode of the render for quick viewing."""
+    result = subprocess.run(
+        ["ffmpeg", "-y", "-i", video_path, "-vf", "scale=-2:360", "-c:v", "libx264", "-preset", "veryfast", "-crf", "30", "-c:a", "aac", output_path],
+        capture_output=True, text=True, timeout=600,
+    )
+    if result.returncode != 0:
+        raise Exception(f"Preview encode failed: {result.stderr[-500:]}")
+
+
+def upload_render_outputs(output_path: str, output_type: str, upload_url, artifact_urls: dict = None) -> dict:
+    """
+    Upload the render to upload_url, then any requested extra artifacts
+    ("thumbnail", "preview"; video renders only) to their targets. Only the
+    render's own upload can fail the request; an artifact that can't be
+    made or uploaded is reported as {"error": ...} under its name.
+    """
+    content_types = {"video": "video/mp4", "image": "image/png"}
+    uploads = {}
+    if upload_url:
+        print(f"☁️ Uploading {output_type}...")
+        uploads[output_type] = upload_file(output_path, content_types.get(output_type, "application/octet-stream"), upload_url)
+        print(f"✅ Uploaded {output_type} ({uploads[output_type]['size']} bytes, {uploads[output_type]['attempts']} attempt(s))")
+
+    artifacts = {}
+    for name, target in (artifact_urls or {}).items():
+        if output_type != "video":
+            print(f"⚠️ Skipping {name} upload for {output_type} output")
+            continue
+        artifact_path = f"{os.path.splitext(output_path)[0]}_{name}"
+        try:
+            if name == "thumbnail":
+                make_thumbnail(output_path, artifact_path + ".png")
+                artifacts[name] = (artifact_path + ".png", "image/png", target)
+            else:
+                make_preview_video(output_path, artifact_path + ".mp4")
+                artifacts[name] = (artifact_path + ".mp4", "video/mp4", target)
+        except Exception as e:
+            print(f"⚠️ Could not make {name}: {e}")
+            uploads[name] = {"error": str(e)}
+    if artifacts:
+        print(f"☁️ Uploading {', '.join(artifacts)}...")
+        uploads.update(upload_artifacts(artifacts))
+    return uploads
+
+
 # Define container image with all dependencies pre-installed
 image = (
     modal.Image.debian_slim(python_version="3.11")
@@ -315,26 +1635,131 @@ image = (
         "requests",
         "fastapi[standard]"
     )
+    .run_function(build_tex_cache, volumes={CACHE_ROOT: cache_volume})
 )
 
 @app.function(
     image=image,
-    timeout=1800,  # 30 minutes
+    volumes={CACHE_ROOT: cache_volume},
+    timeout=1800,
     cpu=4.0,
     memory=8192,
 )
-@modal.fastapi_endpoint(method="POST")
-def render_manim(request_body: dict) -> dict:
-    """Render Manim animation and optionally upload to Supabase."""
+def render_manim_section(code: str, scene_name: str, section, render_flags: list, cache_animations: bool = False, extra_env: dict = None, cache_tex: bool = True) -> dict:
+    """
+    Render one section of a scene (every other section skipped), or the
+    whole scene when section is None, in a fresh working directory.
+    Returns the MP4 bytes and how long the render took.
+    """
+    started = time.time()
+    work_dir = tempfile.mkdtemp(prefix="manim-section-")
+    try:
+        if cache_animations or cache_tex:
+            with cache_volume_users.lock:
+                cache_volume_users.reload()  # One section per container, nothing else holds Volume files
+        with open(os.path.join(work_dir, "scene.py"), "w", encoding='utf-8') as f:
+            f.write(code)
+
+        manim_settings, manim_flags = manim_render_settings(work_dir, cache_animations, cache_tex)
+        write_manim_config(manim_settings, work_dir)
+        if cache_animations:
+            seed_partial_movie_cache(work_dir)
+        if cache_tex:
+            seed_tex_cache(work_dir)
+
+        env = dict(os.environ, **(extra_env or {}))
+        tts_stats_path = os.path.join(work_dir, "tts_cache_stats.json")
+        if "MANIM_TTS_CACHE_DIR" in env:
+            env["MANIM_TTS_STATS"] = tts_stats_path
+        if section is not None:
+            env["MANIM_SECTION_TARGET"] = str(section)
+        result = subprocess.run(
+            ["manim", *manim_flags, "scene.py", scene_name, *render_flags],
+            capture_output=True,
+            text=True,
+            timeout=1200,
+            env=env,
+            cwd=work_dir,
+        )
+        if result.returncode != 0:
+            return {"success": False, "section": section, "error": result.stderr[-4000:], "seconds": round(time.time() - started, 2)}
+
+        animation_cache = collect_partial_movie_cache(work_dir) if cache_animations else None
+        tex_cache = collect_tex_cache(work_dir) if cache_tex else None
+        if "MANIM_TTS_CACHE_DIR" in env:
+            read_tts_cache_stats(tts_stats_path, True)
+        video, _ = render_output(work_dir)
+        if video is None:
+            return {"success": False, "section": section, "error": "Manim produced no video", "seconds": round(time.time() - started, 2)}
+
+        with open(video, "rb") as f:
+            data = f.read()
+        print(f"✅ Section {section} rendered in {time.time() - started:.1f}s ({len(data)} bytes)")
+        return {
+            "success": True,
+            "section": section,
+            "video": data,
+            "seconds": round(time.time() - started, 2),
+            "animation_cache": animation_cache,
+            "tex_cache": tex_cache,
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def run_preflight(code: str, scene_name: str, style: str, preflight_mode: str) -> tuple[dict, dict]:
+    """
+    Run preflight_manim_code and log its diagnostics. Returns (preflight,
+    rejection); rejection is the error response when strict mode refuses
+    the scene, else None.
+    """
+    preflight = preflight_manim_code(code, scene_name, style if style != 'auto' else 'dark')
+    for diagnostic in preflight["diagnostics"]:
+        marker = "🔧" if diagnostic["fixed"] else ("❌" if diagnostic["severity"] == "error" else "⚠️")
+        location = f"line {diagnostic['line']}: " if diagnostic["line"] else ""
+        print(f"{marker} Preflight {diagnostic['code']}: {location}{diagnostic['message']}")
+    if preflight["ok"] or preflight_mode != "strict":
+        return preflight, None
+
+    problems = [
+        (f"line {d['line']}: " if d["line"] else "") + d["message"]
+        for d in preflight["diagnostics"] if d["severity"] == "error" and not d["fixed"]
+    ]
+    return preflight, {
+        "success": False,
+        "error": "Preflight failed: " + "; ".join(problems),
+        "logs": "",
+        "stderr": "",
+        "preflight": {key: value for key, value in preflight.items() if key != "code"}
+    }
+
+
+def render_in_work_dir(request_body: dict, work_dir: str) -> dict:
+    """Render Manim animation in work_dir and optionally upload to Supabase."""
     
     # Extract parameters from request body
     code = request_body.get("code", "")
     scene_name = request_body.get("scene_name", "GeneratedScene")
     upload_url = request_body.get("upload_url")
+    # Extra artifacts made from the render and uploaded alongside it: {"thumbnail": target, "preview": target}
+    artifact_upload_urls = request_body.get("artifact_upload_urls") or {}
     resolution = request_body.get("resolution", "720p")
     aspect_ratio = request_body.get("aspect_ratio", "16:9")
     duration = request_body.get("duration", 8)
     style = request_body.get("style", "auto")
+    # Opt-in: reuse unchanged animations from earlier renders instead of --disable_caching
+    cache_animations = bool(request_body.get("cache_animations", False))
+    # Opt-in: render sections on separate containers; measure_speedup also times a single-container render
+    parallel_sections = bool(request_body.get("parallel_sections", False))
+    measure_speedup = bool(request_body.get("measure_speedup", False))
+    # Voiceover audio is reused across renders unless cache_voiceover is false
+    cache_voiceover = bool(request_body.get("cache_voiceover", True))
+    tts_service = request_body.get("tts_service", "openai")
+    # Compiled LaTeX SVGs are shared across renders unless cache_tex is false
+    cache_tex = bool(request_body.get("cache_tex", True))
+    # "strict" rejects scenes preflight finds broken; "warn" renders them anyway
+    preflight_mode = request_body.get("preflight", "strict")
+    # Run construct() once with --dry_run before paying for the full render
+    dry_run = bool(request_body.get("dry_run", True))
     
     if not code:
         return {
@@ -342,6 +1767,33 @@ def render_manim(request_body: dict) -> dict:
             "error": "No code provided in request body"
         }
     
+    try:
+        if upload_url:
+            normalize_upload_target(upload_url)
+        if not isinstance(artifact_upload_urls, dict):
+            raise ValueError("artifact_upload_urls must be an object")
+        for name, target in artifact_upload_urls.items():
+            if name not in UPLOAD_ARTIFACTS:
+                raise ValueError(f"Unknown artifact '{name}' (expected one of: {', '.join(UPLOAD_ARTIFACTS)})")
+            normalize_upload_target(target)
+    except ValueError as e:
+        return {
+            "success": False,
+            "error": f"Invalid upload target: {e}"
+        }
+    
+    if preflight_mode not in PREFLIGHT_MODES:
+        return {
+            "success": False,
+            "error": f"preflight must be one of: {', '.join(PREFLIGHT_MODES)}"
+        }
+    
+    if tts_service not in TTS_SERVICES:
+        return {
+            "success": False,
+            "error": f"tts_service must be one of: {', '.join(TTS_SERVICES)}"
+        }
+    
     # Map resolution to Manim quality flag
     quality_map = {
         '480p': '-ql',  # Low quality
@@ -367,52 +1819,91 @@ def render_manim(request_body: dict) -> dict:
     print(f"🎬 Rendering with: {quality_flag} (resolution: {resolution_str}, duration: {duration}s, style: {style})")
     
     result = None
+    animation_cache = {"enabled": False}
+    
+    section_report = None
+    voiceover_cache = None
+    preflight_report = None
+    dry_run_report = None
+    
+    # Voiceover cache/stand-in settings for the Manim subprocess
+    tts_stats_path = os.path.join(work_dir, "tts_cache_stats.json")
+    tts_env = tts_cache_env(cache_voiceover, tts_service, tts_stats_path)
+    # The dry run synthesizes voiceovers too; its counts go to their own file
+    # so the full render (mostly cache hits) does not overwrite them
+    tts_dry_run_stats_path = os.path.join(work_dir, "tts_cache_stats.dry_run.json")
+    
+    # Manim flags and config for the output location and caches
+    manim_settings, manim_flags = manim_render_settings(work_dir, cache_animations, cache_tex)
+    tex_cache = {"enabled": False}
     
     try:
         # Sanitize Unicode before writing
         code = sanitize_unicode(code)
         
+        # Static checks before Manim starts; API misuse is fixed in the code
+        if preflight_mode != "off":
+            preflight, rejection = run_preflight(code, scene_name, style, preflight_mode)
+            preflight_report = {key: value for key, value in preflight.items() if key != "code"}
+            if rejection:
+                return rejection
+            code = preflight["code"]
+            scene_name = preflight["scene_name"]
+        
         # Write scene.py
-        with open("scene.py", "w", encoding='utf-8') as f:
-            f.write(code)
+        with open(os.path.join(work_dir, "scene.py"), "w", encoding='utf-8') as f:
+            f.write(add_tts_cache(code))
         
         print(f"📝 Written scene.py with {len(code)} characters")
         
-        # Validate that the scene name exists in the code
-        if f"class {scene_name}" not in code:
-            print(f"⚠️ Warning: Scene name '{scene_name}' not found in code")
-            # Try to extract the actual scene name from the code
-            import re
-            scene_match = re.search(r'class\s+(\w+)\s*\(\s*(?:Voiceover)?Scene\s*\)', code)
-            if scene_match:
-                detected_name = scene_match.group(1)
-                print(f"   Detected scene name: '{detected_name}'")
-                scene_name = detected_name
-            else:
-                print(f"   Could not detect scene name, using: '{scene_name}'")
-        
-        # Validate chart completeness
-        chart_warnings = validate_chart_completeness(code)
-        if chart_warnings:
-            print("⚠️ Chart validation warnings:")
-            for warning in chart_warnings:
-                print(f"   - {warning}")
-        
-        # Validate text/LaTeX usage
-        text_warnings = validate_text_latex_usage(code)
-        if text_warnings:
-            print("⚠️ Text/LaTeX validation warnings:")
-            for warning in text_warnings:
-                print(f"   - {warning}")
+        write_manim_config(manim_settings, work_dir)
+        if cache_animations:
+            seeded = seed_partial_movie_cache(work_dir)
+            print(f"💾 Animation cache enabled ({seeded} cached partial movies available)")
+        if cache_tex:
+            seeded = seed_tex_cache(work_dir)
+            print(f"🧮 LaTeX cache enabled ({seeded} compiled expressions available)")
         
         print(f"🎬 Rendering scene: {scene_name}")
         
+        if parallel_sections:
+            render_flags = [quality_flag, "--format=mp4", f"--resolution={resolution_str}"]
+            if style in ['dark', 'cinematic']:
+                render_flags.extend(["--background_color", "BLACK"])
+            elif style == 'clean':
+                render_flags.extend(["--background_color", "WHITE"])
+            try:
+                output_path, section_report = render_sections_in_parallel(add_tts_cache(code), scene_name, render_flags, work_dir, cache_animations, measure_speedup, tts_env, cache_tex)
+                animation_cache = section_report.pop("animation_cache")
+                tex_cache = section_report.pop("tex_cache")
+            except Exception as e:
+                # Falls through to the regular single-container render (and its fallback)
+                print(f"⚠️ Parallel section render not used: {e}")
+                section_report = {"error": str(e)}
+            else:
+                uploads = upload_render_outputs(output_path, "video", upload_url, artifact_upload_urls)
+                if "manim_voiceover" in code:
+                    voiceover_cache = read_tts_cache_stats(tts_stats_path, cache_voiceover, tts_dry_run_stats_path)
+                return {
+                    "success": True,
+                    "logs": "",
+                    "stderr": "",
+                    "output_path": output_path,
+                    "output_type": "video",
+                    "animation_cache": animation_cache,
+                    "voiceover_cache": voiceover_cache,
+                    "tex_cache": tex_cache,
+                    "parallel_sections": section_report,
+                    "preflight": preflight_report,
+                    "uploads": uploads
+                }
+        
         # Try rendering with voiceover
         try:
             # Build Manim command with dynamic parameters
             manim_cmd = [
                 "manim", 
-                "--disable_caching", 
+                *manim_flags, 
                 "scene.py", 
                 scene_name, 
                 quality_flag,  # Dynamic quality flag
@@ -426,13 +1917,20 @@ def render_manim(request_body: dict) -> dict:
             elif style == 'clean':
                 manim_cmd.extend(["--background_color", "WHITE"])
             
+            if dry_run:
+                dry_run_report, dry_run_stderr = dry_run_scene(manim_cmd, "scene.py", work_dir, dict(os.environ, **dict(tts_env, MANIM_TTS_STATS=tts_dry_run_stats_path)))
+                if not dry_run_report["passed"]:
+                    raise Exception(f"Manim dry run failed: {dry_run_stderr}")
+            
             print(f"🔧 Running Manim command: {' '.join(manim_cmd)}")
             
             result = subprocess.run(
                 manim_cmd,
                 capture_output=True,
                 text=True,
-                timeout=1200  # 20 minutes
+                timeout=1200,  # 20 minutes
+                env=dict(os.environ, **tts_env),
+                cwd=work_dir
             )
             
             if result.returncode != 0:
@@ -882,13 +2380,13 @@ def render_manim(request_body: dict) -> dict:
                             print(f"{marker}{i+1:3d}: {lines[i]}")
                         break
             
-            with open("fallback_scene.py", "w", encoding='utf-8') as f:
+            with open(os.path.join(work_dir, "fallback_scene.py"), "w", encoding='utf-8') as f:
                 f.write(fallback_code)
             
             # Use same dynamic parameters for fallback render
             fallback_cmd = [
                 "manim", 
-                "--disable_caching", 
+                *manim_flags, 
                 "fallback_scene.py", 
                 fallback_class_name, 
                 quality_flag,  # Dynamic quality flag
@@ -902,13 +2400,20 @@ def render_manim(request_body: dict) -> dict:
             elif style == 'clean':
                 fallback_cmd.extend(["--background_color", "WHITE"])
             
+            if dry_run:
+                fallback_report, dry_run_stderr = dry_run_scene(fallback_cmd, "fallback_scene.py", work_dir)
+                dry_run_report = dict(dry_run_report or {}, fallback=fallback_report)
+                if not fallback_report["passed"]:
+                    raise Exception(f"Fallback dry run failed: {dry_run_stderr}")
+            
             print(f"🔧 Running fallback Manim command: {' '.join(fallback_cmd)}")
             
             result = subprocess.run(
                 fallback_cmd,
                 capture_output=True,
                 text=True,
-                timeout=1200
+                timeout=1200,
+                cwd=work_dir
             )
             
             if result.returncode != 0:
@@ -916,135 +2421,45 @@ def render_manim(request_body: dict) -> dict:
             
             print("✅ Fallback render completed successfully")
 
-        # Find output file - try multiple possible locations for both MP4 and PNG
-        possible_video_paths = [
-            f"media/videos/scene/1080p60/{scene_name}.mp4",
-            f"media/videos/scene/720p30/{scene_name}.mp4",
-            f"media/videos/scene/2160p60/{scene_name}.mp4",
-            f"media/videos/scene/1440p60/{scene_name}.mp4",
-            f"media/videos/fallback_scene/1080p60/{scene_name}.mp4",
-            f"media/videos/fallback_scene/720p30/{scene_name}.mp4",
-            f"media/videos/fallback_scene/2160p60/{scene_name}.mp4",
-        ]
-
-        possible_image_paths = [
-            f"media/images/scene/{scene_name}_ManimCE_v0.18.1.png",
-            f"media/images/fallback_scene/{scene_name}_ManimCE_v0.18.1.png",
-        ]
-
-        # If we used fallback, also try with the detected fallback class name
-        if 'fallback_class_name' in locals() and fallback_class_name != scene_name:
-            possible_video_paths.extend([
-                f"media/videos/fallback_scene/1080p60/{fallback_class_name}.mp4",
-                f"media/videos/fallback_scene/720p30/{fallback_class_name}.mp4",
-                f"media/videos/fallback_scene/2160p60/{fallback_class_name}.mp4",
-            ])
-            possible_image_paths.extend([
-                f"media/images/fallback_scene/{fallback_class_name}_ManimCE_v0.18.1.png",
-            ])
-
-        # Search for any MP4 and PNG files in the media directory
-        import glob
-        all_mp4_files = glob.glob("media/videos/**/*.mp4", recursive=True)
-        all_png_files = glob.glob("media/images/**/*.png", recursive=True)
+        if "manim_voiceover" in code:
+            voiceover_cache = read_tts_cache_stats(tts_stats_path, cache_voiceover, tts_dry_run_stats_path)
         
-        print(f"🔍 Found {len(all_mp4_files)} MP4 files in media directory:")
-        for mp4_file in all_mp4_files:
-            print(f"  - {mp4_file}")
-            
-        print(f"🔍 Found {len(all_png_files)} PNG files in media directory:")
-        for png_file in all_png_files:
-            print(f"  - {png_file}")
-
-        output_path = None
-        output_type = None
+        if cache_tex:
+            try:
+                tex_cache = collect_tex_cache(work_dir)
+            except Exception as e:
+                print(f"⚠️ LaTeX cache update failed: {e}")
+                tex_cache = {"enabled": True, "error": str(e)}
         
-        # First try to find MP4 files
-        for path in possible_video_paths:
-            if os.path.exists(path):
-                output_path = path
-                output_type = "video"
-                print(f"📁 Found video output at: {path}")
-                break
-
-        # If no MP4 found, try to find PNG files
-        if output_path is None:
-            for path in possible_image_paths:
-                if os.path.exists(path):
-                    output_path = path
-                    output_type = "image"
-                    print(f"📁 Found image output at: {path}")
-                    break
-
-        # If still not found, try to find any file that might be our output
-        if output_path is None:
-            # Look for MP4 files that contain our scene name
-            for mp4_file in all_mp4_files:
-                if scene_name in mp4_file or (fallback_class_name in mp4_file if 'fallback_class_name' in locals() else False):
-                    output_path = mp4_file
-                    output_type = "video"
-                    print(f"📁 Found video by name match: {mp4_file}")
-                    break
-            
-            # If still no match, use the first MP4 file in the main output directory (exclude partial_movie_files)
-            if output_path is None:
-                main_mp4_files = [f for f in all_mp4_files if 'partial_movie_files' not in f]
-                if main_mp4_files:
-                    output_path = main_mp4_files[0]
-                    output_type = "video"
-                    print(f"📁 Using first available MP4 file: {output_path}")
-            
-            # Look for PNG files that contain our scene name
-            if output_path is None:
-                for png_file in all_png_files:
-                    if scene_name in png_file or (fallback_class_name in png_file if 'fallback_class_name' in locals() else False):
-                        output_path = png_file
-                        output_type = "image"
-                        print(f"📁 Found image by name match: {png_file}")
-                        break
-            
-            # If still no match, use the first PNG file
-            if output_path is None and all_png_files:
-                output_path = all_png_files[0]
-                output_type = "image"
-                print(f"📁 Using first available PNG file: {output_path}")
-
+        if cache_animations:
+            try:
+                animation_cache = collect_partial_movie_cache(work_dir)
+            except Exception as e:
+                print(f"⚠️ Animation cache update failed: {e}")
+                animation_cache = {"enabled": True, "error": str(e)}
+        
+        # Manim was told exactly where to write (video_dir/images_dir + -o)
+        output_path, output_type = render_output(work_dir)
         if output_path is None:
-            raise Exception(f"Output file not found. Tried video paths: {possible_video_paths}. Tried image paths: {possible_image_paths}. Available MP4 files: {all_mp4_files}. Available PNG files: {all_png_files}")
+            raise Exception(f"Output file not found: Manim wrote no {RENDER_OUTPUT_NAME}.mp4 or {RENDER_OUTPUT_NAME}.png in {os.path.join(work_dir, RENDER_OUTPUT_DIR)}")
+        print(f"📁 Found {output_type} output at: {output_path}")
         
-        # Upload to Supabase if URL provided
-        if upload_url:
-            print(f"☁️ Uploading to Supabase...")
-            with open(output_path, "rb") as f:
-                # Get file size for Content-Length header
-                f.seek(0, 2)  # Seek to end
-                file_size = f.tell()
-                f.seek(0)  # Seek back to beginning
-                
-                # Set appropriate content type based on output type
-                if output_type == "video":
-                    content_type = 'video/mp4'
-                elif output_type == "image":
-                    content_type = 'image/png'
-                else:
-                    content_type = 'application/octet-stream'
-                
-                # Upload with proper headers
-                headers = {
-                    'Content-Type': content_type,
-                    'Content-Length': str(file_size)
-                }
-                
-                response = requests.put(upload_url, data=f, headers=headers)
-                response.raise_for_status()
-            print(f"✅ Upload completed successfully ({output_type})")
+        # Upload to Supabase (and any extra artifacts) if URLs provided
+        uploads = upload_render_outputs(output_path, output_type, upload_url, artifact_upload_urls)
         
         return {
             "success": True,
             "logs": result.stdout,
             "stderr": result.stderr,
             "output_path": output_path,
-            "output_type": output_type
+            "output_type": output_type,
+            "animation_cache": animation_cache,
+            "voiceover_cache": voiceover_cache,
+            "tex_cache": tex_cache,
+            "parallel_sections": section_report,
+            "preflight": preflight_report,
+            "dry_run": dry_run_report,
+            "uploads": uploads
         }
         
     except Exception as e:
@@ -1054,6 +2469,220 @@ def render_manim(request_body: dict) -> dict:
             "success": False,
             "error": error_msg,
             "logs": getattr(result, 'stdout', ''),
-            "stderr": getattr(result, 'stderr', error_msg)
+            "stderr": getattr(result, 'stderr', error_msg),
+            "preflight": preflight_report,
+            "dry_run": dry_run_report
         }
 
+
+def available_cpus() -> float:
+    """CPUs this container may use: the cgroup quota if set, else the CPU affinity."""
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    return float(len(os.sched_getaffinity(0)))
+
+
+class CpuAdmission:
+    """Admit concurrent renders while the sum of their CPU weights fits the capacity."""
+
+    def __init__(self, capacity: float):
+        self.capacity = capacity
+        self.in_use = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self, weight: float, timeout: float = None) -> bool:
+        # A render heavier than the whole container still runs, just alone
+        weight = min(weight, self.capacity)
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.in_use + weight <= self.capacity, timeout):
+                return False
+            self.in_use += weight
+            return True
+
+    def release(self, weight: float):
+        with self.condition:
+            self.in_use -= min(weight, self.capacity)
+            self.condition.notify_all()
+
+
+render_admission = CpuAdmission(min(available_cpus(), RENDER_CPUS))
+
+
+def render_weight(request_body: dict) -> float:
+    """CPUs a render of this request's resolution needs (RENDER_CPU_WEIGHTS)."""
+    return RENDER_CPU_WEIGHTS.get(request_body.get("resolution", "720p"), RENDER_CPU_WEIGHTS["720p"])
+
+
+def renderer_for(request_body: dict):
+    """The ManimRenderer variant for the request: as many concurrent inputs as its renders fit the CPUs."""
+    max_inputs = max(1, int(RENDER_CPUS // render_weight(request_body)))
+    return ManimRenderer.with_concurrency(max_inputs=max_inputs)()
+
+
+def run_manim_render(request_body: dict, keep_output: bool = False) -> dict:
+    """
+    Render in a fresh temp work dir once the container has CPU for it.
+    The work dir is removed afterwards unless keep_output is set, in which
+    case the caller gets it back as "work_dir" and must remove it.
+    """
+    weight = render_weight(request_body)
+    waited = time.time()
+    if not render_admission.acquire(weight, RENDER_ADMISSION_TIMEOUT_SECONDS):
+        return {
+            "success": False,
+            "error": f"Render container busy: no CPU free after {RENDER_ADMISSION_TIMEOUT_SECONDS}s"
+        }
+    admission = {"cpu_weight": weight, "wait_seconds": round(time.time() - waited, 2)}
+    if admission["wait_seconds"] >= 1:
+        print(f"🚦 Waited {admission['wait_seconds']}s for {weight} CPU(s)")
+
+    work_dir = tempfile.mkdtemp(prefix="manim-render-")
+    try:
+        volume = cache_volume_users.enter()
+        try:
+            result = render_in_work_dir(request_body, work_dir)
+        finally:
+            cache_volume_users.leave()
+    finally:
+        render_admission.release(weight)
+        if not keep_output:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    if keep_output:
+        result["work_dir"] = work_dir
+    return dict(result, admission=admission, cache_volume=volume)
+
+
+def render_progressive(request_body: dict) -> dict:
+    """
+    Render a low-quality preview and return it (or upload it to
+    preview_upload_url) right away, then spawn the requested-quality render
+    to upload_url in the background. Preflight runs once, here: both passes
+    render its fixed code and detected scene, and the full pass skips the
+    dry run because the preview already ran construct() end to end.
+    The response's progressive.poll says how to fetch the full result.
+    """
+    requested_at = time.time()
+    preflight_mode = request_body.get("preflight", "strict")
+    if request_body.get("code") and preflight_mode != "off":
+        if preflight_mode not in PREFLIGHT_MODES:
+            return {"success": False, "error": f"preflight must be one of: {', '.join(PREFLIGHT_MODES)}"}
+        preflight, rejection = run_preflight(
+            sanitize_unicode(request_body["code"]),
+            request_body.get("scene_name", "GeneratedScene"),
+            request_body.get("style", "auto"),
+            preflight_mode,
+        )
+        if rejection:
+            return dict(rejection, progressive={"stage": "preflight"})
+        preflight_report = {key: value for key, value in preflight.items() if key != "code"}
+        request_body = dict(request_body, code=preflight["code"], scene_name=preflight["scene_name"], preflight="off")
+    else:
+        preflight_report = None
+
+    preview_body = dict(
+        request_body,
+        resolution=PREVIEW_RESOLUTION,
+        upload_url=request_body.get("preview_upload_url"),
+        artifact_upload_urls=None,
+        parallel_sections=False,
+        measure_speedup=False,
+    )
+    print(f"👀 Progressive render: preview at {PREVIEW_RESOLUTION} first")
+    preview = renderer_for(preview_body).render_preview.remote(preview_body)
+    preview_seconds = round(time.time() - requested_at, 2)
+    if preflight_report is not None:
+        preview["preflight"] = preflight_report
+    if not preview["success"]:
+        return dict(preview, progressive={"stage": "preview", "preview_seconds": preview_seconds})
+
+    full_body = dict(request_body, progressive=False, dry_run=False)
+    full_call = renderer_for(full_body).render_full.spawn(full_body, requested_at)
+    print(f"👀 Preview ready in {preview_seconds}s; full render running as {full_call.object_id}")
+    return dict(preview, progressive={
+        "stage": "preview",
+        "preview_seconds": preview_seconds,
+        "full_call_id": full_call.object_id,
+        "poll": progress_poll_contract(full_call.object_id),
+    })
+
+
+def progress_poll_contract(call_id: str) -> dict:
+    """How a client fetches the full render of a progressive request."""
+    try:
+        url = render_manim_progress.get_web_url()
+    except Exception:
+        url = None  # Not deployed (e.g. local runs)
+    return {
+        "url": url,
+        "method": "GET",
+        "params": {"call_id": call_id},
+        "interval_seconds": PROGRESS_POLL_INTERVAL_SECONDS,
+        # Until the full render finishes the endpoint answers with this body;
+        # afterwards with the full render's response (progressive.stage == "full")
+        "pending": {"success": None, "status": "rendering"},
+    }
+
+
+@app.cls(
+    image=image,
+    volumes={CACHE_ROOT: cache_volume},
+    timeout=RENDER_TIMEOUT_SECONDS,
+    cpu=RENDER_CPUS,
+    memory=8192,
+)
+class ManimRenderer:
+    """
+    Render containers. Reached through renderer_for(), whose variants take
+    only as many concurrent inputs as renders of one resolution fit the CPUs.
+    """
+
+    @modal.method()
+    def render(self, request_body: dict) -> dict:
+        return run_manim_render(request_body)
+
+    @modal.method()
+    def render_preview(self, request_body: dict) -> dict:
+        """Preview pass of a progressive request; the video comes back as preview_base64 unless uploaded."""
+        preview = run_manim_render(request_body, keep_output=True)
+        try:
+            if preview["success"] and not request_body.get("upload_url"):
+                with open(preview["output_path"], "rb") as f:
+                    preview["preview_base64"] = base64.b64encode(f.read()).decode("utf-8")
+        finally:
+            shutil.rmtree(preview.pop("work_dir", ""), ignore_errors=True)
+        return preview
+
+    @modal.method()
+    def render_full(self, request_body: dict, requested_at: float) -> dict:
+        """Requested-quality render of a progressive request, spawned once the preview is out."""
+        result = run_manim_render(request_body)
+        full_seconds = round(time.time() - requested_at, 2)
+        print(f"🎬 Full render finished {full_seconds}s after the request")
+        return dict(result, progressive={"stage": "full", "full_seconds": full_seconds})
+
+
+@app.function(image=image, timeout=RENDER_TIMEOUT_SECONDS + RENDER_DISPATCH_SLACK_SECONDS)
+@modal.concurrent(max_inputs=RENDER_DISPATCH_MAX_CONCURRENT_INPUTS)
+@modal.fastapi_endpoint(method="POST")
+def render_manim(request_body: dict) -> dict:
+    """Render Manim animation and optionally upload to Supabase. progressive=true returns a quick preview first."""
+    if request_body.get("progressive"):
+        return render_progressive(request_body)
+    return renderer_for(request_body).render.remote(request_body)
+
+
+@app.function(image=image)
+@modal.fastapi_endpoint(method="GET")
+def render_manim_progress(call_id: str) -> dict:
+    """Status of the background full render of a progressive request."""
+    try:
+        return modal.FunctionCall.from_id(call_id).get(timeout=0)
+    except (TimeoutError, modal.exception.TimeoutError):
+        return {"success": None, "status": "rendering"}
+    except Exception as e:
+        return {"success": False, "error": f"Full render failed: {e}"}